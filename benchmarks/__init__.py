@@ -0,0 +1 @@
+"""Music Sender benchmarks."""
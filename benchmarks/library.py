@@ -0,0 +1,109 @@
+"""Synthetic music libraries for the benchmarks.
+
+A library is laid out like a real one, with artist and album
+directories, and its music sizes follow a distribution given as a
+string:
+
+    fixed:SIZE              Every music has SIZE bytes.
+    uniform:MIN:MAX         Sizes are uniformly spread between MIN and
+                            MAX bytes.
+    lognormal:MEDIAN:SIGMA  Sizes are log-normally spread around MEDIAN
+                            bytes, like a real library, where most
+                            tracks are a few MiB and some are much
+                            larger.
+
+Sizes accept the K, M and G suffixes, like 4M. The same seed always
+generates the same library, so runs on different revisions are
+comparable.
+"""
+
+import math
+import os
+import random
+
+# Tracks of an album and albums of an artist
+ALBUM_TRACKS = 10
+ARTIST_ALBUMS = 4
+EXTENSIONS = (".mp3", ".mp3", ".mp3", ".flac", ".ogg", ".m4a")
+SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(size: str) -> int:
+    """Parses a size in bytes, with an optional K, M or G suffix.
+
+    Raises:
+        ValueError: When the size isn't valid.
+    """
+
+    size = size.strip().upper()
+    multiplier = SUFFIXES.get(size[-1:], 1)
+    if multiplier > 1:
+        size = size[:-1]
+    return int(float(size) * multiplier)
+
+
+def parse_distribution(spec: str):
+    """Parses a size distribution.
+
+    Args:
+        spec: The distribution, like "lognormal:4M:0.5".
+
+    Returns:
+        A function that takes a random.Random and returns a size.
+
+    Raises:
+        ValueError: When the distribution isn't valid.
+    """
+
+    kind, *params = spec.split(":")
+    if kind == "fixed" and len(params) == 1:
+        size = parse_size(params[0])
+        return lambda rng: size
+    if kind == "uniform" and len(params) == 2:
+        low, high = map(parse_size, params)
+        return lambda rng: rng.randint(low, high)
+    if kind == "lognormal" and len(params) == 2:
+        median, sigma = parse_size(params[0]), float(params[1])
+        mu = math.log(max(1, median))
+        return lambda rng: max(1, int(rng.lognormvariate(mu, sigma)))
+    raise ValueError(f"Bad size distribution {spec}.")
+
+
+def make_library(path: str, files: int, sizes: str = "fixed:256K",
+                 seed: int = 0) -> dict:
+    """Writes a synthetic library of random musics into path.
+
+    Args:
+        path: The library directory. It's created when missing.
+        files: The number of musics.
+        sizes: The size distribution of the musics.
+        seed: The seed of the sizes and of the music bytes.
+
+    Returns:
+        A dict with the number of musics, their total size and the size
+        of the largest one and its name.
+    """
+
+    rng = random.Random(seed)
+    size_of = parse_distribution(sizes)
+    total = 0
+    largest = (0, None)
+    for i in range(files):
+        album, track = divmod(i, ALBUM_TRACKS)
+        artist, album = divmod(album, ARTIST_ALBUMS)
+        directory = os.path.join(path, f"Artist {artist:03}",
+                                 f"Album {album:02}")
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.join(directory, f"{track + 1:02} Track {i:05}"
+                            + rng.choice(EXTENSIONS))
+        size = size_of(rng)
+        with open(name, "wb") as music:
+            left = size
+            while left:
+                chunk = min(left, 1024 * 1024)
+                music.write(rng.randbytes(chunk))
+                left -= chunk
+        total += size
+        largest = max(largest, (size, os.path.relpath(name, path)))
+    return {"files": files, "bytes": total, "largest_bytes": largest[0],
+            "largest": largest[1]}
@@ -0,0 +1,184 @@
+"""Load test of the Music Sender server engines.
+
+This script serves a synthetic music library on loopback with each
+server engine, opens many concurrent client sessions at once and has
+every client download the whole library. The clients speak the framed
+protocol directly and throw the data away, so only the server is
+measured.
+
+usage: python -m benchmarks.load_test [-h] [--engine ENGINE]
+       [--clients CLIENTS] [--files FILES] [--size SIZE]
+
+optional arguments:
+  -h, --help            show this help message and exit.
+
+  --engine ENGINE       threading, asyncio or both. Default both.
+
+  --clients CLIENTS     number of concurrent client sessions.
+
+  --files FILES         number of musics in the synthetic library.
+
+  --size SIZE           size in bytes of every music.
+
+For every engine it reports how many sessions were held at the same
+time, the download throughput and the server threads and peak memory.
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from music_sender import protocol
+from music_sender.aioserver import AsyncMusicSenderServer
+from music_sender.server import MusicSenderServer
+
+from .library import make_library
+
+ENGINES = {
+    "threading": MusicSenderServer,
+    "asyncio": AsyncMusicSenderServer,
+}
+
+
+def serve(engine: str, port: int, local: str) -> None:
+    """Runs a server engine on loopback. Target of the server process."""
+
+    class LoopbackServer(ENGINES[engine]):
+        HOST_PATTERN = r"127\.0\.0\.1"
+
+    server = LoopbackServer(("127.0.0.1", port), local, max_requests=0)
+    server.set_ambient()
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+    server.start()
+
+
+def server_status(pid: int) -> dict:
+    """Reads the thread count and peak memory of a process from /proc.
+
+    Returns:
+        A dict with "threads" and "peak_rss_kb". Empty when /proc isn't
+        available.
+    """
+
+    status = {}
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                key, _, value = line.partition(":")
+                if key == "Threads":
+                    status["threads"] = int(value)
+                elif key == "VmHWM":
+                    status["peak_rss_kb"] = int(value.split()[0])
+    except OSError:
+        pass
+    return status
+
+
+def run_client(port: int, files: int, barrier: threading.Barrier,
+               results: list) -> None:
+    """Opens a session, waits for every client to be connected and then
+    downloads every music."""
+
+    received = 0
+    try:
+        sock = socket.create_connection(("127.0.0.1", port))
+        protocol.send_frame(sock, protocol.HELLO,
+                            protocol.encode({"version": protocol.VERSION}))
+        protocol.recv_frame(sock)
+    except OSError:
+        barrier.wait()
+        results.append((False, 0))
+        return
+    barrier.wait()
+    try:
+        buffer = memoryview(bytearray(256 * 1024))
+        for i in range(1, files + 1):
+            protocol.send_frame(sock, protocol.COMMAND, f"--copy {i}".encode())
+            protocol.recv_frame(sock)
+            _, length = protocol.recv_header(sock)
+            while length:
+                count = sock.recv_into(buffer, min(length, len(buffer)))
+                if not count:
+                    raise ConnectionError("Connection closed by the server.")
+                length -= count
+                received += count
+        results.append((True, received))
+    except OSError:
+        results.append((False, received))
+    finally:
+        sock.close()
+
+
+def load_test(engine: str, clients: int, files: int, size: int) -> dict:
+    """Runs the load test against a server engine.
+
+    Returns:
+        A dict with the test results.
+    """
+
+    with tempfile.TemporaryDirectory() as local:
+        make_library(local, files, f"fixed:{size}")
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        process = multiprocessing.Process(target=serve,
+                                          args=(engine, port, local))
+        process.start()
+        try:
+            time.sleep(1)
+            barrier = threading.Barrier(clients + 1)
+            results = []
+            threads = [threading.Thread(target=run_client,
+                                        args=(port, files, barrier, results))
+                       for _ in range(clients)]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            held = server_status(process.pid)
+            started = time.monotonic()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - started
+            final = server_status(process.pid)
+        finally:
+            process.terminate()
+            process.join()
+    received = sum(size for _, size in results)
+    return {
+        "engine": engine,
+        "clients": clients,
+        "completed": sum(1 for ok, _ in results if ok),
+        "seconds": elapsed,
+        "mib_per_second": received / elapsed / 1024 / 1024,
+        "server_threads": held.get("threads"),
+        "server_peak_rss_kb": final.get("peak_rss_kb"),
+    }
+
+
+def main() -> None:
+    """Main Program"""
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--engine", default="both",
+                           choices=["threading", "asyncio", "both"])
+    argparser.add_argument("--clients", type=int, default=200)
+    argparser.add_argument("--files", type=int, default=20)
+    argparser.add_argument("--size", type=int, default=256 * 1024)
+    args = argparser.parse_args()
+    engines = list(ENGINES) if args.engine == "both" else [args.engine]
+    for engine in engines:
+        result = load_test(engine, args.clients, args.files, args.size)
+        print(f"{result['engine']:>10}: {result['completed']}/"
+              f"{result['clients']} clients in {result['seconds']:.2f}s, "
+              f"{result['mib_per_second']:.1f} MiB/s, "
+              f"{result['server_threads']} server threads, "
+              f"{result['server_peak_rss_kb']} KiB peak RSS")
+
+
+if __name__ == "__main__":
+    main()
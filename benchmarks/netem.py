@@ -0,0 +1,148 @@
+"""In-process network emulation for the benchmarks.
+
+NetemProxy forwards loopback connections to a server and adds, like
+Linux netem does on a real interface, a one-way delay with jitter,
+packet loss and an optional link rate, without root or kernel support.
+
+The proxy works on the chunks it reads, not on packets. A lost chunk
+isn't dropped, since TCP would retransmit it: it's delivered after a
+retransmission timeout, and the chunks behind it wait for it, like the
+head-of-line blocking of a real loss. The proxy buffers without limit,
+so the TCP window doesn't limit the throughput on long delays like it
+would on a real link.
+"""
+
+import queue
+import random
+import socket
+import threading
+import time
+
+# Largest chunk forwarded at once, about ten packets
+CHUNK_SIZE = 16 * 1024
+# Delay of a lost chunk, the minimum TCP retransmission timeout
+RTO = 0.2
+
+
+class NetemProxy:
+    """A loopback TCP proxy that degrades the connections it forwards.
+
+    Attributes:
+        target: The server host and port.
+        delay: The one-way delay in seconds.
+        jitter: The maximum random delay in seconds added to the delay.
+        loss: The probability of losing a chunk.
+        rate: The link rate in bytes per second of every direction of a
+              connection. None means unlimited.
+        address: The loopback host and port the proxy listens on.
+
+    Methods:
+        start(): Starts accepting connections.
+        stop(): Stops accepting connections.
+    """
+
+    def __init__(self, target: (str, int), delay: float = 0.0,
+                 jitter: float = 0.0, loss: float = 0.0,
+                 rate: float = None, seed: int = 0) -> None:
+        """Binds the proxy to a loopback port.
+
+        Args:
+            target: The server host and port.
+            delay: The one-way delay in seconds.
+            jitter: The maximum random delay in seconds added to the
+                    delay.
+            loss: The probability of losing a chunk.
+            rate: The link rate in bytes per second. None means
+                  unlimited.
+            seed: The seed of the jitter and of the losses.
+        """
+
+        self.target = target
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.rate = rate
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__listener = socket.create_server(("127.0.0.1", 0))
+        self.address = self.__listener.getsockname()
+
+    def start(self) -> None:
+        """Starts accepting connections on a daemon thread."""
+
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    def stop(self) -> None:
+        """Stops accepting connections. The open ones go on until they
+        are closed."""
+
+        self.__listener.close()
+
+    def __accept(self) -> None:
+        while True:
+            try:
+                client, _ = self.__listener.accept()
+            except OSError:
+                return
+            try:
+                server = socket.create_connection(self.target)
+            except OSError:
+                client.close()
+                continue
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            closed = threading.Barrier(2, action=lambda: (client.close(),
+                                                          server.close()))
+            self.__pipe(client, server, closed)
+            self.__pipe(server, client, closed)
+
+    def __pipe(self, source: socket.socket, destination: socket.socket,
+               closed: threading.Barrier) -> None:
+        """Forwards a direction of a connection with a reader and a
+        writer thread, so reading never waits for the delay."""
+
+        chunks = queue.SimpleQueue()
+
+        def read():
+            deliver = 0.0
+            while True:
+                try:
+                    chunk = source.recv(CHUNK_SIZE)
+                except OSError:
+                    chunk = b""
+                if not chunk:
+                    chunks.put((deliver, None))
+                    return
+                with self.__lock:
+                    delay = self.delay + self.__random.uniform(
+                        0, self.jitter)
+                    if self.__random.random() < self.loss:
+                        delay += RTO
+                # Chunks are delivered in order, like TCP does.
+                deliver = max(deliver, time.monotonic() + delay)
+                if self.rate:
+                    deliver += len(chunk) / self.rate
+                chunks.put((deliver, chunk))
+
+        def write():
+            while True:
+                deliver, chunk = chunks.get()
+                wait = deliver - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    if chunk is None:
+                        destination.shutdown(socket.SHUT_WR)
+                        break
+                    destination.sendall(chunk)
+                except OSError:
+                    # The other end has gone away, the reader stops.
+                    try:
+                        source.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    break
+            closed.wait()
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
@@ -0,0 +1,451 @@
+"""Reproducible loopback benchmarks of the Music Sender server and client.
+
+This script generates a synthetic library, serves it on loopback with a
+MusicSenderServer and measures the real client in these scenarios:
+
+    catalog     Latency of the catalog commands: --raw-available, a
+                --query page and the manifest.
+    throughput  Download rate of the largest music.
+    sync        Time of a full --automatic sync into an empty directory.
+    concurrent  Time of full syncs by many clients at once, each in its
+                own process.
+
+The results are written as JSON. Given the JSON of an earlier run with
+--baseline, the changes are reported and the script exits with 1 when
+one of them is a regression beyond --threshold.
+
+usage: python -m benchmarks.suite [-h] [--scenarios SCENARIO ...]
+       [--engine {threading,asyncio}] [--files FILES] [--sizes SIZES]
+       [--seed SEED] [--repeats REPEATS] [--jobs JOBS] [--batch BATCH]
+       [--clients CLIENTS] [--delay DELAY] [--jitter JITTER]
+       [--loss LOSS] [--rate RATE] [--output OUTPUT]
+       [--baseline BASELINE] [--threshold THRESHOLD]
+
+optional arguments:
+  -h, --help            show this help message and exit.
+
+  --scenarios SCENARIO ...
+                        scenarios to run. Default all of them.
+
+  --engine {threading,asyncio}
+                        server engine.
+
+  --files FILES         number of musics in the synthetic library.
+
+  --sizes SIZES         size distribution of the musics, like
+                        fixed:256K, uniform:1M:8M or lognormal:4M:0.5.
+
+  --seed SEED           seed of the synthetic library.
+
+  --repeats REPEATS     repetitions of the catalog and throughput
+                        measures.
+
+  --jobs JOBS           concurrent downloads of every sync.
+
+  --batch BATCH         musics requested at once by every sync.
+
+  --clients CLIENTS     clients of the concurrent scenario.
+
+  --delay DELAY         one-way delay in milliseconds added to every
+                        connection.
+
+  --jitter JITTER       maximum random delay in milliseconds added to
+                        the delay.
+
+  --loss LOSS           probability of losing a chunk of a connection.
+
+  --rate RATE           link rate in MiB/s of every connection.
+
+  --output OUTPUT       JSON file of the results. Default the standard
+                        output.
+
+  --baseline BASELINE   JSON file of an earlier run to compare with.
+
+  --threshold THRESHOLD
+                        relative change reported as a regression.
+                        Default 0.1.
+
+Examples:
+
+    python -m benchmarks.suite --output before.json
+
+    python -m benchmarks.suite --baseline before.json --output after.json
+
+    python -m benchmarks.suite --scenarios sync --delay 20 --loss 0.01
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+from music_sender.aioserver import AsyncMusicSenderServer
+from music_sender.client import MusicSenderClient
+from music_sender.server import MusicSenderServer
+from music_sender.sync import SyncEngine
+
+from .library import make_library
+from .netem import NetemProxy
+
+ENGINES = {
+    "threading": MusicSenderServer,
+    "asyncio": AsyncMusicSenderServer,
+}
+SCENARIOS = ("catalog", "throughput", "sync", "concurrent")
+# Version of the results format
+FORMAT = 1
+
+
+class LoopbackClient(MusicSenderClient):
+    """A MusicSenderClient that accepts the loopback address."""
+
+    HOST_PATTERN = r"127\.0\.0\.1"
+
+
+def serve(engine: str, port: int, local: str) -> None:
+    """Runs a server engine on loopback. Target of the server process."""
+
+    class LoopbackServer(ENGINES[engine]):
+        HOST_PATTERN = r"127\.0\.0\.1"
+
+    server = LoopbackServer(("127.0.0.1", port), local, max_requests=0)
+    server.set_ambient()
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+    server.start()
+
+
+def wait_for_port(address: (str, int), timeout: float = 30.0) -> None:
+    """Waits until a server accepts connections on the address.
+
+    Raises:
+        TimeoutError: When the server isn't up after the timeout.
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(address, timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"No server on {address}.")
+            time.sleep(0.05)
+
+
+def free_port() -> int:
+    """Returns a free loopback port."""
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def summarize(samples: [float]) -> dict:
+    """Summarizes latency samples in seconds.
+
+    Returns:
+        A dict with the count and the mean, median, 95th percentile and
+        maximum in milliseconds.
+    """
+
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": samples[len(samples) // 2] * 1000,
+        "p95_ms": samples[min(len(samples) - 1,
+                              int(len(samples) * 0.95))] * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    """Hides the colored prints of the client."""
+
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        yield
+
+
+def connect(address: (str, int), local: str) -> LoopbackClient:
+    """Creates a client working on a new directory and connects it.
+
+    Raises:
+        ConnectionError: When the client can't connect.
+    """
+
+    os.makedirs(local, exist_ok=True)
+    client = LoopbackClient(address, local)
+    if not client.set_ambient():
+        raise ConnectionError(f"Can't connect to {address}.")
+    return client
+
+
+def sync(address: (str, int), local: str, jobs: int, batch: int) -> dict:
+    """Downloads the whole library into an empty directory.
+
+    Returns:
+        A dict with the seconds, the downloaded and failed musics and
+        the bytes received.
+    """
+
+    shutil.rmtree(local, ignore_errors=True)
+    with quiet():
+        client = connect(address, local)
+        started = time.monotonic()
+        engine = SyncEngine(client, jobs, batch=batch)
+        for _ in engine.run(client.pending()):
+            pass
+        seconds = time.monotonic() - started
+    return {"seconds": seconds, "files": engine.done - engine.failed,
+            "failed": engine.failed, "bytes": engine.bytes_received}
+
+
+def bench_catalog(address: (str, int), work: str, repeats: int) -> dict:
+    """Measures the latency of the catalog commands."""
+
+    client = connect(address, os.path.join(work, "catalog"))
+    samples = {"raw_available": [], "query": [], "manifest": []}
+    with quiet():
+        for _ in range(repeats):
+            for name, command in (
+                    ("raw_available", client.raw_available),
+                    ("query", lambda: client.query("track", limit=50)),
+                    ("manifest", client.manifest)):
+                started = time.perf_counter()
+                command()
+                samples[name].append(time.perf_counter() - started)
+    return {name: summarize(values) for name, values in samples.items()}
+
+
+def bench_throughput(address: (str, int), work: str, repeats: int,
+                     music: str) -> dict:
+    """Measures the download rate of a music."""
+
+    local = os.path.join(work, "throughput")
+    client = connect(address, local)
+    manifest = client.manifest()
+    track_id = next(entry["id"] for entry in manifest
+                    if entry["name"] == music)
+    size = next(entry["size"] for entry in manifest
+                if entry["name"] == music)
+    seconds = []
+    with quiet():
+        for _ in range(repeats):
+            # A local copy would only get the changed bytes.
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(local, music))
+            started = time.perf_counter()
+            _, successful = client.copy(track_id, music)
+            seconds.append(time.perf_counter() - started)
+            if not successful:
+                raise RuntimeError(f"Downloading {music} has failed.")
+    best = min(seconds)
+    return {"bytes": size, "seconds": summarize(seconds),
+            "mib_per_second": size / statistics.median(seconds) / 1024 ** 2,
+            "best_mib_per_second": size / best / 1024 ** 2}
+
+
+def bench_sync(address: (str, int), work: str, jobs: int,
+               batch: int) -> dict:
+    """Measures a full sync."""
+
+    result = sync(address, os.path.join(work, "sync"), jobs, batch)
+    result["mib_per_second"] = result["bytes"] / result["seconds"] / 1024 ** 2
+    return result
+
+
+def bench_concurrent(address: (str, int), work: str, clients: int,
+                     jobs: int, batch: int) -> dict:
+    """Measures full syncs by many clients at once."""
+
+    arguments = [(address, os.path.join(work, f"client{i}"), jobs, batch)
+                 for i in range(clients)]
+    with multiprocessing.Pool(clients) as pool:
+        started = time.monotonic()
+        results = pool.starmap(sync, arguments)
+        seconds = time.monotonic() - started
+    received = sum(result["bytes"] for result in results)
+    return {
+        "clients": clients,
+        "seconds": seconds,
+        "failed": sum(result["failed"] for result in results),
+        "bytes": received,
+        "mib_per_second": received / seconds / 1024 ** 2,
+        "client_seconds": summarize(
+            [result["seconds"] for result in results]),
+    }
+
+
+def run(args) -> dict:
+    """Runs the benchmarks.
+
+    Returns:
+        The results dict written as JSON.
+    """
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work:
+        local = os.path.join(work, "library")
+        library = make_library(local, args.files, args.sizes, args.seed)
+        port = free_port()
+        server = multiprocessing.Process(target=serve,
+                                         args=(args.engine, port, local))
+        server.start()
+        proxy = None
+        try:
+            address = ("127.0.0.1", port)
+            wait_for_port(address)
+            if args.delay or args.jitter or args.loss or args.rate:
+                proxy = NetemProxy(address, args.delay / 1000,
+                                   args.jitter / 1000, args.loss,
+                                   args.rate and args.rate * 1024 ** 2,
+                                   args.seed)
+                proxy.start()
+                address = proxy.address
+            for scenario in args.scenarios:
+                print(f"[*] Running {scenario}...", file=sys.stderr)
+                if scenario == "catalog":
+                    results[scenario] = bench_catalog(address, work,
+                                                      args.repeats)
+                elif scenario == "throughput":
+                    results[scenario] = bench_throughput(
+                        address, work, args.repeats, library["largest"])
+                elif scenario == "sync":
+                    results[scenario] = bench_sync(address, work, args.jobs,
+                                                   args.batch)
+                elif scenario == "concurrent":
+                    results[scenario] = bench_concurrent(
+                        address, work, args.clients, args.jobs, args.batch)
+        finally:
+            if proxy is not None:
+                proxy.stop()
+            server.terminate()
+            server.join()
+            # The clients have changed into the work directory.
+            os.chdir(tempfile.gettempdir())
+    return {
+        "format": FORMAT,
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("output", "baseline", "threshold")},
+        "library": library,
+        "results": results,
+    }
+
+
+def metrics(results: dict, prefix: str = "") -> dict:
+    """Flattens the numeric results into a dict of dotted names."""
+
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(metrics(value, name + "."))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> [tuple]:
+    """Compares the timings and rates of two runs.
+
+    Times, in seconds or milliseconds, are better when lower and rates
+    are better when higher. Counts aren't compared.
+
+    Returns:
+        A list of (name, baseline, current, change, regression) tuples,
+        where change is relative to the baseline.
+    """
+
+    before = metrics(baseline["results"])
+    after = metrics(current["results"])
+    changes = []
+    for name in sorted(before.keys() & after.keys()):
+        if name.endswith("per_second"):
+            lower_is_better = False
+        elif name.endswith(("_ms", "seconds")):
+            lower_is_better = True
+        else:
+            continue
+        if not before[name]:
+            continue
+        change = (after[name] - before[name]) / before[name]
+        worse = change if lower_is_better else -change
+        changes.append((name, before[name], after[name], change,
+                        worse > threshold))
+    return changes
+
+
+def main() -> None:
+    """Main Program"""
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--scenarios", nargs="+", choices=SCENARIOS,
+                           default=list(SCENARIOS))
+    argparser.add_argument("--engine", default="threading",
+                           choices=list(ENGINES))
+    argparser.add_argument("--files", type=int, default=100)
+    argparser.add_argument("--sizes", default="lognormal:1M:0.8")
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument("--repeats", type=int, default=10)
+    argparser.add_argument("--jobs", type=int, default=4)
+    argparser.add_argument("--batch", type=int, default=8)
+    argparser.add_argument("--clients", type=int, default=8)
+    argparser.add_argument("--delay", type=float, default=0.0)
+    argparser.add_argument("--jitter", type=float, default=0.0)
+    argparser.add_argument("--loss", type=float, default=0.0)
+    argparser.add_argument("--rate", type=float, default=0.0)
+    argparser.add_argument("--output", default=None)
+    argparser.add_argument("--baseline", default=None)
+    argparser.add_argument("--threshold", type=float, default=0.1)
+    args = argparser.parse_args()
+    if args.output is not None:
+        args.output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    current = run(args)
+    if args.output is None:
+        json.dump(current, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as output:
+            json.dump(current, output, indent=2)
+    if baseline is None:
+        return
+    regressions = 0
+    for name, before, after, change, regression in compare(
+            baseline, current, args.threshold):
+        regressions += regression
+        if regression:
+            color = "31"
+        elif abs(change) > args.threshold:
+            color = "32"
+        else:
+            color = ""
+        print(f"\033[;{color}m{name}: {before:.3f} -> {after:.3f} "
+              f"({change:+.1%})\033[m", file=sys.stderr)
+    if regressions:
+        print(f"\033[;31m[*] {regressions} regressions.\033[m",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""Music Sender asyncio server engine.
+
+This module serves the same commands as the threaded MusicSenderServer,
+but all the client connections share a single thread running an asyncio
+event loop. Sockets are non-blocking and files are sent with
+loop.sock_sendfile(), so the number of connections isn't bound to the
+number of threads the system can hold.
+"""
+
+import asyncio
+import logging
+import socket
+
+from . import commands, protocol
+from .commands import CommandProcessor
+from .server import MusicSenderServer
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMusicSenderServer(MusicSenderServer):
+    """Music Sender server running on an asyncio event loop.
+
+    Blocking work, like the catalog lookups that may refresh the
+    catalog or hashing musics for a manifest, runs on the default
+    executor of the loop, so it never stalls other clients.
+
+    Clients watching the catalog wait on an asyncio event that the
+    library watching thread sets through the loop.
+
+    Methods:
+        start(): Starts the server and blocks until it's stopped.
+        stop(): Stops the server.
+        serve(): Coroutine that accepts and serves the clients.
+        wait_for_change_async(version, timeout): Coroutine that waits
+                                                 for a newer catalog
+                                                 version.
+    """
+
+    def _bind(self, address: (str, int)) -> None:
+        """Creates the non-blocking listening socket on the address."""
+
+        self.__listener = socket.create_server(address, backlog=1024,
+                                               reuse_port=self.reuse_port)
+        self.__listener.setblocking(False)
+        self.__loop = None
+        self.__task = None
+        self.__clients = set()
+        self.__changed = None
+
+    def start(self) -> None:
+        """Starts the server."""
+
+        self.start_watching()
+        try:
+            asyncio.run(self.serve())
+        except asyncio.CancelledError:
+            # Cancelled by stop().
+            pass
+
+    def stop(self) -> None:
+        """Stops the server. It may be called from any thread."""
+
+        self._stop_watching()
+        if self.__loop is not None and self.__task is not None:
+            try:
+                self.__loop.call_soon_threadsafe(self.__task.cancel)
+            except RuntimeError:
+                # The loop is already closed.
+                pass
+        self.__listener.close()
+        if self.hot_cache is not None:
+            self.hot_cache.close()
+        if self.compressor is not None:
+            self.compressor.close()
+
+    async def serve(self) -> None:
+        """Accepts the client connections and serves each of them in
+        its own task."""
+
+        self.__loop = asyncio.get_running_loop()
+        self.__task = asyncio.current_task()
+        self.__changed = asyncio.Event()
+        try:
+            while True:
+                connection, client_address = await self.__loop.sock_accept(
+                    self.__listener)
+                connection.setblocking(False)
+                task = asyncio.create_task(
+                    self.handle(connection, client_address))
+                self.__clients.add(task)
+                task.add_done_callback(self.__clients.discard)
+        finally:
+            for task in list(self.__clients):
+                task.cancel()
+
+    def _notify_change(self) -> None:
+        """Wakes up the clients watching the catalog. Called by the
+        library watching thread."""
+
+        if self.__loop is None:
+            return
+
+        def wake() -> None:
+            # Waiters keep the event they started waiting on.
+            changed, self.__changed = self.__changed, asyncio.Event()
+            changed.set()
+
+        try:
+            self.__loop.call_soon_threadsafe(wake)
+        except RuntimeError:
+            # The loop is already closed.
+            pass
+
+    async def wait_for_change_async(self, version: int,
+                                    timeout: float) -> bool:
+        """Waits until the catalog version is newer than the given one.
+
+        Args:
+            version: The catalog version the client has.
+            timeout: Maximum seconds to wait.
+
+        Returns:
+            True when there's a newer version, otherwise False.
+        """
+
+        if self.version <= version:
+            try:
+                await asyncio.wait_for(self.__changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.version > version
+
+    async def _recv_exact(self, connection, size: int) -> bytes:
+        """Receives exactly size bytes from a client connection.
+
+        Raises:
+            ConnectionError: When the client closes the connection
+                             before size bytes arrive.
+        """
+
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            count = await self.__loop.sock_recv_into(connection,
+                                                     view[received:])
+            if count == 0:
+                raise ConnectionError("Connection closed by the peer.")
+            received += count
+        return bytes(data)
+
+    async def _recv_frame(self, connection) -> (int, bytes):
+        """Receives a whole frame from a client connection.
+
+        Raises:
+            ProtocolError: When the header is malformed or the payload is
+                           larger than MAX_FRAME.
+        """
+
+        frame_type, length = protocol.unpack_header(
+            await self._recv_exact(connection, protocol.HEADER.size))
+        protocol.check_length(length)
+        return frame_type, await self._recv_exact(connection, length)
+
+    async def _recv_hello(self, connection, prefix) -> (int, bytes):
+        """Receives the rest of the first frame of a framed client, whose
+        magic bytes were already read.
+
+        Raises:
+            ProtocolError: When the header is malformed or the payload is
+                           larger than MAX_FRAME.
+        """
+
+        header = prefix + await self._recv_exact(
+            connection, protocol.HEADER.size - len(prefix))
+        frame_type, length = protocol.unpack_header(header)
+        protocol.check_length(length)
+        return frame_type, await self._recv_exact(connection, length)
+
+    async def handle(self, connection, client_address) -> None:
+        """Serves a client connection until it's closed.
+
+        Args:
+            connection: The non-blocking client socket.
+            client_address: The client host and port.
+        """
+
+        logger.debug("Connection at %s:%d", *client_address[:2])
+        try:
+            # A client that connects and sends nothing is dropped after
+            # the idle timeout too.
+            prefix = await asyncio.wait_for(
+                self._recv_exact(connection, len(protocol.MAGIC)),
+                self.idle_timeout)
+            framed = prefix == protocol.MAGIC
+            admitted = self.open_connection()
+            processor = CommandProcessor(self, client_address, framed)
+            try:
+                if framed:
+                    await self.handle_framed(connection, processor, prefix,
+                                             admitted)
+                elif admitted:
+                    processor.log.debug("Legacy client detected.")
+                    await self.handle_legacy(connection, processor, prefix)
+                else:
+                    await self.perform(connection, processor.busy())
+            finally:
+                if admitted:
+                    self.close_connection()
+        except asyncio.TimeoutError:
+            logger.debug("Idle session %s:%d closed.", *client_address[:2])
+        except (OSError, protocol.ProtocolError):
+            # The client has disconnected or is speaking nonsense.
+            pass
+        finally:
+            connection.close()
+
+    async def handle_legacy(self, connection, processor, prefix) -> None:
+        """Serves a client that sends bare commands without framing."""
+
+        msg = prefix
+        while connection.fileno() != -1:
+            chunk = await self.__loop.sock_recv(connection, 4096)
+            if chunk == b"":
+                break
+            await self.perform(connection, processor.execute(msg + chunk))
+            msg = b""
+
+    async def handle_framed(self, connection, processor, prefix,
+                            admitted: bool = True) -> None:
+        """Serves a client that speaks the framed protocol, with the same
+        session limits as the threaded engine. A connection that wasn't
+        admitted gets a BUSY frame instead of the server HELLO."""
+
+        frame_type, payload = await asyncio.wait_for(
+            self._recv_hello(connection, prefix), self.idle_timeout)
+        if frame_type != protocol.HELLO:
+            await self.perform(connection, processor.error(b"bad-handshake"))
+            return
+        if not admitted:
+            await self.perform(connection, processor.busy())
+            return
+        hello = processor.hello(payload)
+        await self.__loop.sock_sendall(connection, protocol.pack_header(
+            protocol.HELLO, len(hello)) + hello)
+        served = 0
+        while not self.max_requests or served < self.max_requests:
+            frame_type, payload = await asyncio.wait_for(
+                self._recv_frame(connection), self.idle_timeout)
+            served += 1
+            if frame_type != protocol.COMMAND:
+                await self.perform(connection,
+                                   processor.error(b"bad-parameter"))
+                continue
+            await self.perform(connection, processor.execute(payload))
+
+    async def perform(self, connection, actions) -> None:
+        """Performs the actions generated by a command.
+
+        Args:
+            connection: The non-blocking client socket.
+            actions: A generator of actions from the CommandProcessor.
+
+        Raises:
+            OSError: When an action fails and the command doesn't
+                     handle the error.
+        """
+
+        loop = self.__loop
+        try:
+            action = next(actions)
+            while True:
+                result = None
+                try:
+                    if action[0] == commands.SEND:
+                        await loop.sock_sendall(connection, action[1])
+                    elif action[0] == commands.SENDFILE:
+                        await loop.sock_sendfile(connection, *action[1:])
+                    elif action[0] == commands.SLEEP:
+                        await asyncio.sleep(action[1])
+                    elif action[0] == commands.CALL:
+                        result = await loop.run_in_executor(None, action[1])
+                    elif action[0] == commands.WAIT:
+                        result = await self.wait_for_change_async(
+                            *action[1:])
+                    elif action[0] == commands.CLOSE:
+                        connection.shutdown(socket.SHUT_RDWR)
+                        connection.close()
+                except OSError as error:
+                    if isinstance(error, BrokenPipeError):
+                        self.metrics.broken_pipe()
+                    action = actions.throw(error)
+                else:
+                    action = actions.send(result)
+        except StopIteration:
+            pass
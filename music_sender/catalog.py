@@ -0,0 +1,643 @@
+"""Music catalog.
+
+This module keeps the list of musics a server offers in memory, so the
+server doesn't need to query its library index on every client request.
+The catalog can also be published to an index file, which server worker
+processes share through memory maps, and it can be queried by pages
+through a search index.
+"""
+
+import bisect
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from .library import LibraryIndex
+
+
+class MusicCatalog:
+    """An in-memory, invalidation-aware music catalog.
+
+    The catalog is loaded from a LibraryIndex of the music directory and
+    its subdirectories. It's reconciled with the filesystem at most once
+    every poll_interval seconds, which costs a single stat() call per
+    directory, so a burst of requests doesn't rescan the library.
+
+    Every music is identified by its stable track ID. Catalog positions
+    are still offered to legacy clients: musics are kept in ID order, so
+    removed musics are dropped and new musics are appended to the end.
+
+    The catalog is safe to be shared by many handler threads: readers
+    always get an immutable snapshot and refreshes are serialized by a
+    lock.
+
+    Attributes:
+        path: The directory the catalog describes.
+        poll_interval: Minimum number of seconds between two
+                       reconciliations of the index.
+        index: The LibraryIndex the catalog is loaded from.
+        hits: How many times the catalog was served without reloading.
+        rebuilds: How many times the catalog was fully built.
+        refreshes: How many times the catalog was reloaded after a
+                   library change.
+
+    Methods:
+        build(): Reconciles the index and builds the catalog.
+        refresh(): Refreshes the catalog if the library changed.
+        names(): Returns the current music names.
+        entries(): Returns the current track IDs and music names.
+        get(option): Returns the music name at a catalog position.
+        track(track_id): Returns the music name of a track ID.
+        query(): Returns a page of the musics matching a search.
+        stats(): Returns the catalog counters.
+    """
+
+    def __init__(self, path: str = ".", poll_interval: float = 1.0,
+                 index: LibraryIndex = None) -> None:
+        """Initializes the catalog.
+
+        Args:
+            path: The directory path the catalog describes.
+            poll_interval: Minimum number of seconds between two
+                           reconciliations of the index.
+            index: The LibraryIndex of the directory. A LibraryIndex
+                   with the default database is opened by build() when
+                   it's None.
+        """
+
+        self.path = path
+        self.poll_interval = poll_interval
+        self.index = index
+        self.hits = 0
+        self.rebuilds = 0
+        self.refreshes = 0
+        self.__entries = ()
+        self.__names = ()
+        self.__tracks = {}
+        self.__search = None
+        self.__last_check = None
+        self.__lock = threading.Lock()
+
+    def __load(self) -> None:
+        """Loads the catalog from the index. Must hold the lock."""
+
+        self.__entries = tuple(self.index.tracks())
+        self.__names = tuple(name for _, name in self.__entries)
+        self.__tracks = dict(self.__entries)
+        self.__search = None
+
+    def build(self) -> None:
+        """Reconciles the index with the library and builds the whole
+        catalog."""
+
+        with self.__lock:
+            if self.index is None:
+                self.index = LibraryIndex(self.path)
+            self.index.reconcile()
+            self.__load()
+            self.__last_check = time.monotonic()
+            self.rebuilds += 1
+
+    def refresh(self, force: bool = False) -> bool:
+        """Refreshes the catalog if the library has changed.
+
+        Args:
+            force: Whether the library is reconciled even if it was
+                   reconciled less than poll_interval seconds ago.
+
+        Returns:
+            True whether the catalog was changed, otherwise False.
+        """
+
+        with self.__lock:
+            now = time.monotonic()
+            if self.__last_check is not None and not force \
+                    and now - self.__last_check < self.poll_interval:
+                self.hits += 1
+                return False
+            self.__last_check = now
+            if not self.index.reconcile():
+                self.hits += 1
+                return False
+            self.__load()
+            self.refreshes += 1
+            return True
+
+    def names(self) -> tuple:
+        """Returns the current music names.
+
+        Returns:
+            An immutable tuple of music name strings, in ID order.
+        """
+
+        self.refresh()
+        return self.__names
+
+    def entries(self) -> tuple:
+        """Returns the current tracks.
+
+        Returns:
+            An immutable tuple of (track ID, music name) tuples, in ID
+            order.
+        """
+
+        self.refresh()
+        return self.__entries
+
+    def get(self, option: int) -> str:
+        """Returns the music name at the given catalog position.
+
+        Args:
+            option: The zero-based catalog position.
+
+        Returns:
+            The music name string.
+
+        Raises:
+            IndexError: When the option is out of range.
+        """
+
+        if option < 0:
+            raise IndexError("Negative catalog position.")
+        return self.names()[option]
+
+    def track(self, track_id: int) -> str:
+        """Returns the music name of a track ID.
+
+        Args:
+            track_id: The stable track ID.
+
+        Returns:
+            The music name string.
+
+        Raises:
+            IndexError: When there's no such track.
+        """
+
+        self.refresh()
+        try:
+            return self.__tracks[track_id]
+        except KeyError:
+            raise IndexError(f"No track {track_id}.") from None
+
+    def query(self, search: str = None, prefix: bool = False,
+              extension: str = None, offset: int = 0,
+              limit: int = None) -> (int, list):
+        """Returns a page of the musics matching a search.
+
+        The search index is built once for every version of the
+        catalog, so queries don't scan the music names.
+
+        Args:
+            search: A text the music names must contain. None matches
+                    every music.
+            prefix: Whether the words of the search must start words of
+                    the music names instead of being a plain substring.
+            extension: A file extension the musics must have, like
+                       ".mp3".
+            offset: How many matching musics are skipped.
+            limit: The maximum number of musics returned. None returns
+                   every matching music.
+
+        Returns:
+            A tuple with the number of matching musics and a list with
+            the (track ID, music name) tuples of the page.
+        """
+
+        self.refresh()
+        with self.__lock:
+            if self.__search is None:
+                self.__search = SearchIndex(self.__entries)
+            search_index = self.__search
+        return search_index.query(search, prefix, extension, offset, limit)
+
+    def stats(self) -> dict:
+        """Returns the catalog counters.
+
+        Returns:
+            A dict with the size, hits, rebuilds and refreshes of the
+            catalog.
+        """
+
+        return {
+            "size": len(self.__names),
+            "hits": self.hits,
+            "rebuilds": self.rebuilds,
+            "refreshes": self.refreshes,
+        }
+
+
+INDEX_MAGIC = b"MSIX"
+INDEX_HEADER = struct.Struct("!4sQQ")
+INDEX_OFFSET = struct.Struct("!Q")
+INDEX_ENTRY = struct.Struct("!QH")
+
+
+def write_index(path: str, entries, generation: int) -> None:
+    """Writes the catalog tracks to an index file.
+
+    The index starts with a header holding a magic string, a generation
+    number and the number of musics, followed by a table with the file
+    offset of every music and then the track IDs with the
+    length-prefixed UTF-8 names. The file is replaced atomically, so
+    readers never see a partial index.
+
+    Args:
+        path: The index file path.
+        entries: The (track ID, music name) tuples, in ID order.
+        generation: A number that grows on every new index.
+    """
+
+    encoded = [(track_id, name.encode("utf8")) for track_id, name in entries]
+    offset = INDEX_HEADER.size + INDEX_OFFSET.size * len(encoded)
+    offsets = []
+    for _, name in encoded:
+        offsets.append(INDEX_OFFSET.pack(offset))
+        offset += INDEX_ENTRY.size + len(name)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as index_file:
+        index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, generation,
+                                           len(encoded)))
+        index_file.writelines(offsets)
+        for track_id, name in encoded:
+            index_file.write(INDEX_ENTRY.pack(track_id, len(name)) + name)
+    os.replace(temporary, path)
+
+
+class SharedCatalog:
+    """A read-only catalog backed by a memory-mapped index file.
+
+    It's used by server worker processes: a single supervisor scans the
+    music directory and publishes the catalog with write_index(), while
+    every worker maps the same index file instead of scanning the
+    directory again. Music positions are read straight from the offset
+    table, so get() doesn't need to decode the whole catalog, and track
+    IDs are found by a binary search over the same table.
+
+    It has the same interface as MusicCatalog.
+
+    Attributes:
+        index_path: The index file path.
+        poll_interval: Minimum number of seconds between two checks of
+                       the index file.
+        hits: How many times the catalog was served without remapping.
+        rebuilds: How many times the index file was mapped.
+        refreshes: How many times a new index was mapped after a change.
+
+    Methods:
+        build(): Maps the index file.
+        refresh(): Maps the index file again if it was replaced.
+        names(): Returns the current music names.
+        entries(): Returns the current track IDs and music names.
+        get(option): Returns the music name at a catalog position.
+        track(track_id): Returns the music name of a track ID.
+        query(): Returns a page of the musics matching a search.
+        stats(): Returns the catalog counters.
+    """
+
+    def __init__(self, index_path: str, poll_interval: float = 1.0) -> None:
+        """Initializes the catalog.
+
+        Args:
+            index_path: The index file path.
+            poll_interval: Minimum number of seconds between two checks
+                           of the index file.
+        """
+
+        self.index_path = index_path
+        self.poll_interval = poll_interval
+        self.hits = 0
+        self.rebuilds = 0
+        self.refreshes = 0
+        self.__map = None
+        self.__count = 0
+        self.__entries = None
+        self.__names = None
+        self.__search = None
+        self.__key = None
+        self.__last_check = 0.0
+        self.__lock = threading.Lock()
+
+    def __map_index(self) -> None:
+        """Maps the current index file. Must hold the lock."""
+
+        with open(self.index_path, "rb") as index_file:
+            stat = os.fstat(index_file.fileno())
+            index_map = mmap.mmap(index_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        magic, _, count = INDEX_HEADER.unpack_from(index_map)
+        if magic != INDEX_MAGIC:
+            index_map.close()
+            raise ValueError(f"{self.index_path} isn't a catalog index.")
+        if self.__map is not None:
+            self.__map.close()
+        self.__map = index_map
+        self.__count = count
+        self.__entries = None
+        self.__names = None
+        self.__search = None
+        self.__key = (stat.st_ino, stat.st_mtime_ns)
+        self.__last_check = time.monotonic()
+
+    def build(self) -> None:
+        """Maps the index file."""
+
+        with self.__lock:
+            self.__map_index()
+            self.rebuilds += 1
+
+    def refresh(self, force: bool = False) -> bool:
+        """Maps the index file again if it was replaced.
+
+        Args:
+            force: Whether the index file is checked even if it was
+                   checked less than poll_interval seconds ago.
+
+        Returns:
+            True whether a new index was mapped, otherwise False.
+        """
+
+        with self.__lock:
+            now = time.monotonic()
+            if self.__map is not None and not force \
+                    and now - self.__last_check < self.poll_interval:
+                self.hits += 1
+                return False
+            self.__last_check = now
+            stat = os.stat(self.index_path)
+            if (stat.st_ino, stat.st_mtime_ns) == self.__key:
+                self.hits += 1
+                return False
+            self.__map_index()
+            self.refreshes += 1
+            return True
+
+    def __read(self, option: int) -> (int, str):
+        """Reads the track ID and music name at a catalog position. Must
+        hold the lock."""
+
+        offset, = INDEX_OFFSET.unpack_from(
+            self.__map, INDEX_HEADER.size + INDEX_OFFSET.size * option)
+        track_id, length = INDEX_ENTRY.unpack_from(self.__map, offset)
+        start = offset + INDEX_ENTRY.size
+        return track_id, self.__map[start:start + length].decode("utf8")
+
+    def __read_id(self, option: int) -> int:
+        """Reads the track ID at a catalog position. Must hold the
+        lock."""
+
+        offset, = INDEX_OFFSET.unpack_from(
+            self.__map, INDEX_HEADER.size + INDEX_OFFSET.size * option)
+        return INDEX_ENTRY.unpack_from(self.__map, offset)[0]
+
+    def entries(self) -> tuple:
+        """Returns the current tracks.
+
+        Returns:
+            An immutable tuple of (track ID, music name) tuples, in ID
+            order.
+        """
+
+        self.refresh()
+        with self.__lock:
+            if self.__entries is None:
+                self.__entries = tuple(self.__read(option)
+                                       for option in range(self.__count))
+                self.__names = tuple(name for _, name in self.__entries)
+            return self.__entries
+
+    def names(self) -> tuple:
+        """Returns the current music names.
+
+        Returns:
+            An immutable tuple of music name strings, in ID order.
+        """
+
+        entries = self.entries()
+        with self.__lock:
+            if self.__entries is entries:
+                return self.__names
+        # The index was remapped meanwhile.
+        return tuple(name for _, name in entries)
+
+    def get(self, option: int) -> str:
+        """Returns the music name at the given catalog position.
+
+        Args:
+            option: The zero-based catalog position.
+
+        Returns:
+            The music name string.
+
+        Raises:
+            IndexError: When the option is out of range.
+        """
+
+        self.refresh()
+        with self.__lock:
+            if not 0 <= option < self.__count:
+                raise IndexError("Catalog position out of range.")
+            return self.__read(option)[1]
+
+    def track(self, track_id: int) -> str:
+        """Returns the music name of a track ID.
+
+        Args:
+            track_id: The stable track ID.
+
+        Returns:
+            The music name string.
+
+        Raises:
+            IndexError: When there's no such track.
+        """
+
+        self.refresh()
+        with self.__lock:
+            low, high = 0, self.__count
+            while low < high:
+                middle = (low + high) // 2
+                if self.__read_id(middle) < track_id:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low < self.__count:
+                found_id, name = self.__read(low)
+                if found_id == track_id:
+                    return name
+        raise IndexError(f"No track {track_id}.")
+
+    def query(self, search: str = None, prefix: bool = False,
+              extension: str = None, offset: int = 0,
+              limit: int = None) -> (int, list):
+        """Returns a page of the musics matching a search.
+
+        The search index is built once for every version of the
+        catalog, so queries don't scan the music names.
+
+        Args:
+            search: A text the music names must contain. None matches
+                    every music.
+            prefix: Whether the words of the search must start words of
+                    the music names instead of being a plain substring.
+            extension: A file extension the musics must have, like
+                       ".mp3".
+            offset: How many matching musics are skipped.
+            limit: The maximum number of musics returned. None returns
+                   every matching music.
+
+        Returns:
+            A tuple with the number of matching musics and a list with
+            the (track ID, music name) tuples of the page.
+        """
+
+        entries = self.entries()
+        with self.__lock:
+            if self.__search is None or self.__search.entries is not entries:
+                self.__search = SearchIndex(entries)
+            search_index = self.__search
+        return search_index.query(search, prefix, extension, offset, limit)
+
+    def stats(self) -> dict:
+        """Returns the catalog counters.
+
+        Returns:
+            A dict with the size, hits, rebuilds and refreshes of the
+            catalog.
+        """
+
+        return {
+            "size": self.__count,
+            "hits": self.hits,
+            "rebuilds": self.rebuilds,
+            "refreshes": self.refreshes,
+        }
+
+
+class SearchIndex:
+    """A search index of a catalog version.
+
+    Substring searches run on a single string holding every lowercase
+    music name, one per line, so they're done by str.find() instead of
+    a Python loop over the names. Prefix searches run on a sorted list
+    of the words of the names, without their extensions, with a binary
+    search. Musics are also
+    grouped by extension.
+
+    Attributes:
+        WORD_SEPARATORS: A regex that splits the music names in words.
+        entries: The (track ID, music name) tuples of the catalog.
+
+    Methods:
+        match(search, prefix): Returns the positions of the musics
+                               matching a search.
+        query(): Returns a page of the musics matching a search.
+    """
+
+    WORD_SEPARATORS = re.compile(r"[\s/_.()\[\]-]+")
+
+    def __init__(self, entries: tuple) -> None:
+        """Builds the index.
+
+        Args:
+            entries: The (track ID, music name) tuples of the catalog.
+        """
+
+        self.entries = entries
+        lowered = [name.lower() for _, name in entries]
+        self.__text = "\n".join(lowered)
+        self.__starts = []
+        start = 0
+        for name in lowered:
+            self.__starts.append(start)
+            start += len(name) + 1
+        words = sorted((word, position)
+                       for position, name in enumerate(lowered)
+                       for word in set(self.WORD_SEPARATORS.split(
+                           os.path.splitext(name)[0]))
+                       if word)
+        self.__words = [word for word, _ in words]
+        self.__word_positions = [position for _, position in words]
+        self.__extensions = {}
+        for position, name in enumerate(lowered):
+            extension = os.path.splitext(name)[1]
+            self.__extensions.setdefault(extension, []).append(position)
+
+    def __match_substring(self, search: str) -> list:
+        """Returns the positions of the names containing search."""
+
+        positions = []
+        start = 0
+        while True:
+            found = self.__text.find(search, start)
+            if found < 0:
+                return positions
+            position = bisect.bisect_right(self.__starts, found) - 1
+            positions.append(position)
+            # Skip the rest of the name. Its lowercase may be longer
+            # than the name, like "İ".lower(), so the next name start is
+            # used instead of the name length.
+            if position + 1 == len(self.__starts):
+                return positions
+            start = self.__starts[position + 1]
+
+    def __match_prefix(self, word: str) -> set:
+        """Returns the positions of the names with a word starting with
+        word."""
+
+        positions = set()
+        i = bisect.bisect_left(self.__words, word)
+        while i < len(self.__words) and self.__words[i].startswith(word):
+            positions.add(self.__word_positions[i])
+            i += 1
+        return positions
+
+    def match(self, search: str, prefix: bool = False) -> list:
+        """Returns the positions of the musics matching a search.
+
+        Args:
+            search: The search text. Case is ignored.
+            prefix: Whether every word of the search must start a word
+                    of the music name, instead of the search being a
+                    substring of the name.
+
+        Returns:
+            A sorted list of catalog positions.
+        """
+
+        search = search.lower()
+        if not prefix:
+            return self.__match_substring(search.replace("\n", " "))
+        words = [word for word in self.WORD_SEPARATORS.split(search) if word]
+        if not words:
+            return list(range(len(self.entries)))
+        positions = self.__match_prefix(words[0])
+        for word in words[1:]:
+            positions &= self.__match_prefix(word)
+        return sorted(positions)
+
+    def query(self, search: str = None, prefix: bool = False,
+              extension: str = None, offset: int = 0,
+              limit: int = None) -> (int, list):
+        """Returns a page of the musics matching a search.
+
+        See MusicCatalog.query().
+        """
+
+        if extension is not None:
+            extension = extension.lower()
+            if not extension.startswith("."):
+                extension = "." + extension
+            positions = self.__extensions.get(extension, [])
+            if search:
+                matched = set(self.match(search, prefix))
+                positions = [i for i in positions if i in matched]
+        elif search:
+            positions = self.match(search, prefix)
+        else:
+            positions = range(len(self.entries))
+        end = None if limit is None else offset + limit
+        return len(positions), [self.entries[i] for i in positions[offset:end]]
@@ -0,0 +1,127 @@
+"""Server catalog cache.
+
+This module keeps the last server manifest a client has seen cached on
+disk, with the catalog version it belongs to, so the client only asks
+the server for the changes since that version.
+"""
+
+import json
+import os
+
+
+class CatalogCache:
+    """An on-disk cache of a server manifest.
+
+    The cache belongs to a single server address. It's ignored when the
+    client talks to another server, and every server gets its own cache
+    file by default, so a client using many mirrors keeps all of them.
+
+    Attributes:
+        FILENAME: The default name of the cache file, formatted with the
+                  server host and port.
+        filename: The cache file path.
+        address: The server address of the cached manifest.
+        epoch: The epoch of the server library database.
+        version: The catalog version of the cached manifest. 0 when
+                 nothing is cached.
+
+    Methods:
+        load(): Loads the cache file.
+        save(): Saves the cache file.
+        manifest(): Returns the cached manifest.
+        entry(track_id): Returns the cached manifest entry of a track.
+        name(track_id): Returns the cached name of a track.
+        apply(answer): Applies a --changes answer to the manifest.
+    """
+
+    FILENAME = ".music_sender_catalog_{}_{}.json"
+
+    def __init__(self, address: (str, int), path: str = ".",
+                 filename: str = None) -> None:
+        """Initializes an empty cache.
+
+        Args:
+            address: The server host and port.
+            path: The directory of the cache file.
+            filename: The cache file name, relative to path. FILENAME
+                      is used when it's None.
+        """
+
+        if filename is None:
+            filename = CatalogCache.FILENAME.format(*address)
+        self.filename = os.path.join(path, filename)
+        self.address = list(address)
+        self.epoch = ""
+        self.version = 0
+        self.__entries = {}
+
+    def load(self) -> None:
+        """Loads the cache file. A missing or broken file, or a file of
+        another server, is ignored."""
+
+        try:
+            with open(self.filename) as cache_file:
+                cache = json.load(cache_file)
+            if cache["address"] != self.address:
+                return
+            entries = {entry["id"]: entry for entry in cache["manifest"]}
+            epoch, version = cache["epoch"], cache["version"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        self.__entries = entries
+        self.epoch = epoch
+        self.version = version
+
+    def save(self) -> None:
+        """Saves the cache file.
+
+        A read-only directory is ignored, the cache then only lives in
+        memory.
+        """
+
+        temporary = self.filename + ".tmp"
+        try:
+            with open(temporary, "w") as cache_file:
+                json.dump({"address": self.address, "epoch": self.epoch,
+                           "version": self.version,
+                           "manifest": self.manifest()}, cache_file)
+            os.replace(temporary, self.filename)
+        except OSError:
+            pass
+
+    def manifest(self) -> [dict]:
+        """Returns the cached manifest, in track ID order."""
+
+        return [self.__entries[track_id]
+                for track_id in sorted(self.__entries)]
+
+    def entry(self, track_id: int) -> dict:
+        """Returns the cached manifest entry of a track, or None when the
+        track isn't cached."""
+
+        return self.__entries.get(track_id)
+
+    def name(self, track_id: int) -> str:
+        """Returns the cached name of a track, or None when the track
+        isn't cached."""
+
+        entry = self.entry(track_id)
+        return entry["name"] if entry else None
+
+    def apply(self, answer: dict) -> None:
+        """Applies a --changes answer of the server to the manifest.
+
+        Args:
+            answer: The decoded answer, with the epoch, the version, the
+                    reset flag and the changed manifest entries.
+        """
+
+        if answer["reset"]:
+            self.__entries = {}
+        for entry in answer["changes"]:
+            if entry["name"] is None:
+                self.__entries.pop(entry["id"], None)
+            else:
+                self.__entries[entry["id"]] = entry
+        self.epoch = answer["epoch"]
+        self.version = answer["version"]
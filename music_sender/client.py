@@ -3,18 +3,44 @@
 This script allows the user to connect to the Music Sender server for
 getting music through command-line.
 
-usage: client.py [-h] [-v] [-c COPY] [-d] [-a] [-l LOCAL] [-hs HOST]
-       [-p PORT]
+usage: client.py [-h] [-v] [--search SEARCH] [--prefix] [--ext EXT]
+       [--page PAGE] [--page-size PAGE_SIZE] [-c COPY]
+       [-m COPY_MANY [COPY_MANY ...]] [-d]
+       [-a] [-w] [-s] [-j JOBS] [--mirrors HOST:PORT [HOST:PORT ...]]
+       [-b BATCH] [--retries RETRIES]
+       [--chunk-size CHUNK_SIZE] [--segments SEGMENTS]
+       [--segment-threshold SEGMENT_THRESHOLD] [--no-compression]
+       [-l LOCAL] [-hs HOST] [-p PORT] [--log-level {debug,info,warning,error}]
 
 optional arguments:
   -h, --help            show this help message and exit.
 
   -v, --available       shows the available music catalog and theirs
-                        code numbers.
+                        track IDs.
 
-  -c COPY, --copy COPY  download a music from a given option. In case
-                        of a wrong index, a simple error message is
-                        returned from the server.
+  --search SEARCH       shows only the musics whose name contains
+                        SEARCH. Used with --available.
+
+  --prefix              matches the words of --search against the
+                        beginning of the words of the names.
+
+  --ext EXT             shows only the musics with the EXT extension.
+                        Used with --available.
+
+  --page PAGE           shows only the given page of the catalog. Used
+                        with --available.
+
+  --page-size PAGE_SIZE
+                        number of musics of a page.
+
+  -c COPY, --copy COPY  download a music from a given track ID. In case
+                        of a wrong ID, a simple error message is
+                        returned from the server. An outdated copy of
+                        the music only gets the bytes that changed.
+
+  -m COPY_MANY [COPY_MANY ...], --copy-many COPY_MANY [COPY_MANY ...]
+                        download many musics from their track IDs in a
+                        single request.
 
   -d, --diff            This shows a list of musics that in server but
                         not in client music directory. It uses the path
@@ -23,6 +49,41 @@ optional arguments:
   -a, --automatic       downloads the list of musics that is not in
                         client directory.
 
+  -w, --watch           keeps downloading the new and changed musics
+                        as the server reports them, until Ctrl+C.
+
+  -s, --stats           shows the server counters and command
+                        latencies.
+
+  -j JOBS, --jobs JOBS  number of concurrent downloads used by
+                        --automatic.
+
+  --mirrors HOST:PORT [HOST:PORT ...]
+                        other servers with the same library that
+                        --automatic downloads from at once, in
+                        proportion to their throughput.
+
+  -b BATCH, --batch BATCH
+                        number of musics --automatic requests at once
+                        on a single stream.
+
+  --retries RETRIES     how many times --automatic retries a failed
+                        download.
+
+  --chunk-size CHUNK_SIZE
+                        size in bytes of the buffer used to receive
+                        musics.
+
+  --segments SEGMENTS   number of connections that download a large
+                        music at once.
+
+  --segment-threshold SEGMENT_THRESHOLD
+                        size in bytes from which a music is downloaded
+                        in segments.
+
+  --no-compression      never lets the server compress the WAV, PCM and
+                        AIFF musics.
+
   -l LOCAL, --local LOCAL
                         Path where musics will be stored. if not
                         specified the local is the current path.
@@ -34,22 +95,49 @@ optional arguments:
   -p PORT, --port PORT  Server port. if not specified the port is a
                         range between 1024 and 65432
 
+  --log-level {debug,info,warning,error}
+                        log level of the download warnings, like the
+                        retries of corrupt musics. Default warning.
+
 Examples:
 
     ms_client -hs 192.168.243.1 -p 7462 -l ~/home/user/Music/ -v
+
+    ms_client -hs 192.168.243.1 -p 7462 -v --search queen --page 2
     
     ms_client -hs 192.168.21.52 -p 5000 -l /Documents/Personal/ -c 345
+
+    ms_client -hs 192.168.21.52 -p 5000 -m 12 13 14 15
     
     ms_client -hs 192.168.1.1 -p 65432 -d
+
+    ms_client -hs 192.168.1.1 -p 65432 -a --jobs 8
+
+    ms_client -hs 192.168.1.1 -p 65432 -a --mirrors 192.168.1.2:65432
+
+    ms_client -hs 192.168.1.1 -p 65432 -w
+
+    ms_client -hs 192.168.1.1 -p 65432 -s
 """
 
 import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
 import os
 import random
 import re
 import socket
+import time
 
-from . import utils
+from . import compression, delta, log, protocol, utils
+from .catalogcache import CatalogCache
+from .hashcache import HASH_NAME, HashCache, hash_file
+from .swarm import SwarmEngine
+from .sync import SyncEngine, SyncResult
+
+logger = logging.getLogger(__name__)
 
 
 class MusicSenderClient:
@@ -63,73 +151,191 @@ class MusicSenderClient:
 
         * --copy <any integer non-negative> or
           -c <any integer non-negative>.
+        * --copy-many <any integers non-negative> or
+          -m <any integers non-negative>.
         * --available or -v.
         * --automatic or -a.
         * --diff or -d
+        * --watch or -w
+        * --stats or -s
 
     Attributes:
 
+        MAX_BUSY: How many BUSY answers in a row a request waits out
+                  before giving up.
+
+        INTEGRITY_RETRIES: How many times copy() downloads again a
+                           music that has arrived corrupt.
+
         address: Where the client should connect to.
 
         local: The path where the client will work on.
 
+        chunk_size: The size in bytes of the buffer used to receive
+                    music files.
+
+        segments: How many connections download a large music at once.
+
+        segment_threshold: The size in bytes from which a music is
+                           downloaded in segments.
+
+        compression: Whether the server may compress the musics, with
+                     the codecs of this Python.
+
+        hashes: The HashCache of the client music contents.
+
+        catalog: The CatalogCache with the last server manifest the
+                 client has seen.
+
         client: A python socket that will handle low-levels calls. May
-                be replaced by the automatic() method.
+                be replaced by the connect() method.
+
+        server_version: The protocol version the server answered with
+                        in the handshake.
+
+        session: The session limits the server answered with in the
+                 handshake, like idle_timeout and max_requests.
 
     Methods:
 
-        check_address(address): Static method that checks if the given
-                                address is valid.
+        clone(): Creates a new, not connected, client with the same
+                 settings.
 
-        checkit(message): Static method that checks the server message.
+        check_address(address): Class method that checks if the given
+                                address matches HOST_PATTERN.
 
         set_ambient(): Sets the ambient by changing directory and
                        connecting to the server.
 
+        connect(): Opens a new connection to the server.
+
+        handshake(): Negotiates the protocol version with the server.
+
+        ensure_session(): Reconnects when the current session was closed
+                          or is about to be closed by the server.
+
         copy(option): Sends a music request to the server.
 
+        copy_delta(option, music_name): Sends a request for the bytes
+                                        of a music that changed.
+
+        should_segment(option, music_name): Checks whether a music is
+                                            downloaded in segments.
+
+        copy_segmented(option, music_name): Downloads the segments of a
+                                            music on many connections.
+
+        copy_range(option, music_name, size, offset, length):
+            Downloads a byte range of a music.
+
+        copy_many(options): Sends a single request for many musics.
+
         raw_available(): Sends a request for the available musics on the
                          server and return the catalog as a list of
-                         strings.
+                         track IDs and names.
+
+        query(): Sends a query for a page of the server catalog.
 
         available(): Returns a formatted string containing the music
-                     catalog.
+                     catalog, or a page of it.
+
+        manifest(): Sends a request for the server manifest, with the
+                    name, size, mtime and content hash of every music.
+
+        compare(): Compares the client musics to the server manifest.
 
         diff(): Generates the musics name the client computer doesn't
                 have.
 
-        automatic(): Downloads all the needed musics.
+        pending(): Applies the server renames and returns the musics to
+                   be downloaded.
+
+        sync(engine): Downloads all the needed musics with an engine.
+
+        automatic(jobs, retries, batch): Downloads all the needed
+                                         musics concurrently.
+
+        watch(engine): Downloads the musics as the server reports
+                       their changes.
     """
 
     HOST_PATTERN = r"192.168.\d{1,3}.\d{1,3}"
-
-    def __init__(self, address: str, local: str) -> None:
+    # How many BUSY answers in a row a request waits out
+    MAX_BUSY = 10
+    # How many times a corrupt music is downloaded again
+    INTEGRITY_RETRIES = 2
+
+    def __init__(self, address: str, local: str,
+                 chunk_size: int = 256 * 1024, segments: int = 4,
+                 segment_threshold: int = 64 * 1024 * 1024,
+                 compression: bool = True) -> None:
         """Initialize the Music Sender server on a address and a path
         on the filesystem.
 
         Args:
             address: The host and port the client should connect to.
             local: The path where the client will work on.
+            chunk_size: The size in bytes of the buffer used to receive
+                        music files.
+            segments: How many connections download a large music at
+                      once. 1 never splits a music.
+            segment_threshold: The size in bytes from which a music is
+                               downloaded in segments.
+            compression: Whether the server may compress the musics.
 
         Raises:
             ValueError: When one of the arguments are invalid.
         """
 
-        if MusicSenderClient.check_address(address):
+        if self.check_address(address):
             self.address = address
         else:
             raise ValueError("Address is not valid or parameter are not in"
                              " range")
         self.local = local
+        self.chunk_size = chunk_size
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.compression = compression
+        self.hashes = HashCache()
+        self.catalog = CatalogCache(address)
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_version = None
+        self.session = {}
+        self.__served = 0
+        self.__last_request = 0.0
+        self.__buffer = bytearray(chunk_size)
+        self.__segment_clients = []
 
-    @staticmethod
-    def check_address(address: (str, int)) -> bool:
+    def clone(self):
+        """Creates a new client with the same settings.
+
+        The new client isn't connected. Its session is opened by the
+        first call to ensure_session().
+
+        Returns:
+            A MusicSenderClient instance.
+        """
+
+        client = type(self)(self.address, self.local, self.chunk_size,
+                            self.segments, self.segment_threshold,
+                            self.compression)
+        client.client.close()
+        # The hashes of the downloaded musics are kept in one place.
+        client.hashes = self.hashes
+        # So is the catalog, which the segments look their music up in.
+        client.catalog = self.catalog
+        return client
+
+    @classmethod
+    def check_address(cls, address: (str, int)) -> bool:
         """Checks the address.
 
         This checker is responsible to check if the given address is
         according to the IPV4 model. So, another type of connection
-        model like IPV6, results in an error.
+        model like IPV6, results in an error. Subclasses may accept
+        other hosts, like the loopback for tests, by overriding
+        HOST_PATTERN.
 
         Args:
             address:
@@ -141,7 +347,7 @@ class MusicSenderClient:
             whether the address is valid, otherwise False.
         """
 
-        matched = re.match(MusicSenderClient.HOST_PATTERN, address[0])
+        matched = re.match(cls.HOST_PATTERN, address[0])
         if matched:
             # Check if the last two token is on range. (0 < x < 255)
             host_tokens = address[0].split(".")[2:]
@@ -154,22 +360,6 @@ class MusicSenderClient:
             return False
         return True
 
-    @staticmethod
-    def checkit(message: str):
-        """Check if the returned message is a error message from the
-        server.
-
-        Args:
-            message: A string message from the server to be checked.
-
-        Returns:
-            True if the message is ok, otherwise is False.
-        """
-
-        if message in ("not-available", "bad-parameter"):
-            return False
-        return True
-
     def set_ambient(self) -> bool:
         """Sets the path where the client will work on and connects to
         the server.
@@ -182,108 +372,1120 @@ class MusicSenderClient:
 
         try:
             os.chdir(self.local)
-            self.client.connect(self.address)
+            self.hashes.load()
+            self.catalog.load()
+            self.client.close()
+            self.connect()
             return True
-        except OSError:
+        except (OSError, protocol.ProtocolError):
             return False
 
-    def copy(self, option: int) -> (str, False):
+    def connect(self) -> None:
+        """Replaces the client socket by a new connection to the
+        server and negotiates the protocol on it.
+
+        When the server is full, the client waits as long as the server
+        asked, with some jitter, before connecting again.
+
+        Raises:
+            OSError: When the server can't be reached.
+            ProtocolError: When the server doesn't answer the handshake.
+            ServerBusy: When the server is still full after MAX_BUSY
+                        tries.
+        """
+
+        for attempt in range(self.MAX_BUSY + 1):
+            self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.client.connect(self.address)
+            try:
+                self.handshake()
+                return
+            except protocol.ServerBusy as busy:
+                self.client.close()
+                if attempt == self.MAX_BUSY:
+                    raise
+                self._wait_busy(busy.retry_after)
+
+    def handshake(self) -> None:
+        """Sends a HELLO frame, with the codecs the client can
+        decompress, and waits for the server HELLO.
+
+        Raises:
+            ProtocolError: When the server doesn't answer with a HELLO.
+            ServerBusy: When the server is full.
+        """
+
+        codecs = compression.available() if self.compression else []
+        protocol.send_frame(self.client, protocol.HELLO, protocol.encode({
+            "version": protocol.VERSION, "compression": codecs}))
+        frame_type, payload = protocol.recv_frame(self.client,
+                                                  protocol.MAX_REPLY)
+        if frame_type == protocol.BUSY:
+            raise protocol.ServerBusy(
+                protocol.decode(payload)["retry_after"] / 1000)
+        if frame_type != protocol.HELLO:
+            raise protocol.ProtocolError("The server refused the handshake.")
+        self.session = protocol.decode(payload)
+        self.server_version = self.session.pop("version")
+        self.__served = 0
+        self.__last_request = time.monotonic()
+
+    def ensure_session(self) -> None:
+        """Makes sure the client socket holds a usable session.
+
+        A new connection is opened when the socket was closed, when the
+        session has been idle for longer than the server idle timeout
+        or when the server request limit was reached.
+
+        Raises:
+            OSError: When the server can't be reached.
+            ProtocolError: When the server doesn't answer the handshake.
+        """
+
+        idle_timeout = self.session.get("idle_timeout")
+        max_requests = self.session.get("max_requests")
+        closed = self.client.fileno() == -1
+        # Leave some margin so the server doesn't close the session
+        # while a request is on its way.
+        expired = idle_timeout is not None \
+            and time.monotonic() - self.__last_request >= 0.9 * idle_timeout
+        exhausted = bool(max_requests) and self.__served >= max_requests
+        if closed or expired or exhausted:
+            self.client.close()
+            self.connect()
+
+    def _send_command(self, command: str, data: bytes = b"") -> None:
+        """Sends a command frame.
+
+        Args:
+            command: The command string, like "--raw-available".
+            data: Binary data sent after the command string.
+        """
+
+        self.__served += 1
+        self.__last_request = time.monotonic()
+        protocol.send_frame(self.client, protocol.COMMAND,
+                            command.encode() + data)
+
+    @staticmethod
+    def _wait_busy(retry_after: float) -> None:
+        """Waits before retrying a request the server was too busy for.
+
+        The wait is up to half longer than the server asked, so the
+        clients it has rejected together don't come back together.
+
+        Args:
+            retry_after: The seconds the server asked to wait.
+        """
+
+        time.sleep(retry_after * random.uniform(1.0, 1.5))
+
+    def _request(self, command: str, data: bytes = b"") -> (int, bytes):
+        """Sends a command frame and receives the answer frame.
+
+        A BUSY answer is waited out and the command sent again, up to
+        MAX_BUSY times.
+
+        Args:
+            command: The command string, like "--raw-available".
+            data: Binary data sent after the command string.
+
+        Returns:
+            A tuple with the answer frame type and payload.
+        """
+
+        for attempt in range(self.MAX_BUSY + 1):
+            self._send_command(command, data)
+            frame_type, payload = protocol.recv_frame(self.client,
+                                                      protocol.MAX_REPLY)
+            if frame_type != protocol.BUSY or attempt == self.MAX_BUSY:
+                break
+            self._wait_busy(protocol.decode(payload)["retry_after"] / 1000)
+        return frame_type, payload
+
+    def copy(self, option: int, music_name: str = None) -> (str, False):
         """Executes the --copy command.
 
+        When the name of the music is known and a partial download of it
+        is left in the client directory, only the missing bytes are
+        requested. When an outdated copy of it is in the client
+        directory, only the bytes that have changed are requested, with
+        copy_delta(). A large music is downloaded in segments, with
+        copy_segmented().
+
+        Every music is checked against the size and content hash the
+        server announces. A corrupt music is discarded and downloaded
+        again, up to INTEGRITY_RETRIES times.
+
         Args:
-            option: A integer value corresponding to the music index.
+            option: A integer value corresponding to the track ID.
+            music_name: The expected music name, used to find a partial
+                        download to be resumed.
 
         Returns:
             A string containing the created music. The string may be
             empty if the copy didn't work.
         """
 
-        self.client.send(f"--copy {option}".encode())
-        music_name = self.client.recv(4096).decode()
-        if MusicSenderClient.checkit(music_name):
+        for _ in range(self.INTEGRITY_RETRIES):
             try:
-                with open(music_name, "wb") as music_file:
-                    client_file = self.client.makefile("rb")
-                    data = client_file.read()
-                    music_file.write(data)
-                    client_file.close()
-            except (KeyboardInterrupt, OSError):
-                return music_name, False
-        else:
+                return self._copy(option, music_name)
+            except protocol.IntegrityError as error:
+                logger.warning("%s Downloading it again.", error)
+                # The corrupt transfer has closed the session.
+                try:
+                    self.ensure_session()
+                except (OSError, protocol.ProtocolError):
+                    return error.name, False
+        try:
+            return self._copy(option, music_name)
+        except protocol.IntegrityError as error:
+            logger.warning("%s", error)
+            return error.name, False
+
+    def _copy(self, option: int, music_name: str = None) -> (str, bool):
+        """Downloads a music once.
+
+        Raises:
+            IntegrityError: When the music has arrived corrupt. It was
+                            discarded.
+        """
+
+        offset = 0
+        if music_name and os.path.exists(music_name + ".part"):
+            offset = os.path.getsize(music_name + ".part")
+        elif music_name and os.path.isfile(music_name) \
+                and os.path.getsize(music_name) >= delta.MIN_SIZE:
+            result = self.copy_delta(option, music_name)
+            if result is not None:
+                return result
+        if not offset and self.should_segment(option, music_name):
+            return self.copy_segmented(option, music_name)
+        command = f"--copy {option}" + (f" {offset}" if offset else "")
+        try:
+            frame_type, payload = self._request(command)
+        except (OSError, protocol.ProtocolError):
+            return "", False
+        if frame_type != protocol.REPLY:
             return "", False
-        return music_name, True
+        music_info = protocol.decode(payload)
+        encoding = music_info.get("encoding")
+        # Never let the server write outside the client directory.
+        name = utils.safe_path(music_info["name"])
+        try:
+            frame_type, length = protocol.recv_header(self.client)
+            if frame_type != protocol.FILE:
+                raise protocol.ProtocolError("Expected a FILE frame.")
+            if name is None:
+                self._discard(length, encoding)
+                return "", False
+            if offset and name != utils.safe_path(music_name):
+                # The catalog has changed and the data doesn't belong to
+                # the partial download.
+                raise protocol.ProtocolError("Unexpected music.")
+            if offset and music_info["offset"] >= music_info["size"]:
+                # A partial download can't be as large as the music, it
+                # was left by a crash after the preallocation.
+                self._discard(length, encoding)
+                os.remove(music_name + ".part")
+                return self._copy(option, music_name)
+            self._receive_file(name, music_info["size"],
+                               music_info["offset"], length,
+                               music_info.get("hash"), encoding)
+        except protocol.IntegrityError:
+            # A corrupt block stops the transfer before its end.
+            self.client.close()
+            raise
+        except (KeyboardInterrupt, OSError, protocol.ProtocolError):
+            # The session state is unknown after a failed transfer.
+            self.client.close()
+            return name or "", False
+        return name, True
+
+    def should_segment(self, option: int, music_name: str = None) -> bool:
+        """Checks whether a music is downloaded in segments.
+
+        The size of the music is taken from the catalog cache, so only
+        musics of the last manifest can be segmented.
+
+        Args:
+            option: A integer value corresponding to the track ID.
+            music_name: The expected music name.
+
+        Returns:
+            True when the music is at least segment_threshold bytes.
+        """
+
+        entry = self.catalog.entry(option)
+        return self.segments > 1 and entry is not None \
+            and entry["size"] is not None \
+            and entry["size"] >= self.segment_threshold \
+            and music_name in (None, entry["name"])
+
+    def copy_segmented(self, option: int, music_name: str = None) -> (
+            str, bool):
+        """Downloads a music in segments on many connections at once.
+
+        The music is split in byte ranges that are requested with ranged
+        --copy commands on parallel connections, and every range is
+        written at its offset of a preallocated temporary file. The
+        temporary file only replaces the music once its size and content
+        hash match the catalog cache. After a failure, the temporary file
+        keeps the data the first segment received, so the download can
+        be resumed by copy().
+
+        Args:
+            option: A integer value corresponding to the track ID.
+            music_name: The expected music name.
+
+        Returns:
+            A tuple with the created music name and whether it was
+            successfully created.
+
+        Raises:
+            IntegrityError: When every range has arrived but the music
+                            is corrupt. It was discarded.
+        """
+
+        entry = self.catalog.entry(option)
+        name = utils.safe_path(entry["name"])
+        if name is None:
+            return "", False
+        size = entry["size"]
+        part_name = name + ".part"
+        directory = os.path.dirname(name)
+        # An empty music, with a threshold of 0, is still one range.
+        count = max(1, min(self.segments, -(-size // self.chunk_size)))
+        length = max(1, -(-size // count))
+        ranges = [(offset, min(length, size - offset))
+                  for offset in range(0, size, length)] or [(0, 0)]
+        while len(self.__segment_clients) < len(ranges) - 1:
+            self.__segment_clients.append(self.clone())
+        clients = [self] + self.__segment_clients
+        try:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(part_name, "wb") as music_file:
+                utils.preallocate(music_file.fileno(), size)
+        except OSError:
+            return name, False
+        with concurrent.futures.ThreadPoolExecutor(len(ranges)) as executor:
+            futures = [executor.submit(client.copy_range, option, name,
+                                       size, offset, length)
+                       for client, (offset, length) in zip(clients, ranges)]
+            received = [future.result() for future in futures]
+        successful = all(count == length for count, (_, length)
+                         in zip(received, ranges))
+        try:
+            if not successful:
+                os.truncate(part_name, received[0])
+                return name, False
+            # The ranges arrive out of order, so they can only be hashed
+            # once all of them are written.
+            digest = hash_file(part_name)
+            if entry["hash"] is not None and digest != entry["hash"]:
+                os.remove(part_name)
+                raise protocol.IntegrityError(name)
+            os.replace(part_name, name)
+            self.hashes.store(name, digest)
+        except OSError:
+            return name, False
+        return name, True
+
+    def copy_range(self, option: int, music_name: str, size: int,
+                   offset: int, length: int) -> int:
+        """Downloads a byte range of a music into its temporary file,
+        which must be preallocated to the music size. The session is
+        opened when needed.
+
+        Args:
+            option: A integer value corresponding to the track ID.
+            music_name: The music name.
+            size: The expected music size.
+            offset: The first byte of the range.
+            length: The number of bytes of the range.
+
+        Returns:
+            The number of bytes received and written, from offset on.
+        """
+
+        view = memoryview(self.__buffer)
+        received = 0
+        try:
+            self.ensure_session()
+            frame_type, payload = self._request(
+                f"--copy {option} {offset} {length}")
+            if frame_type != protocol.REPLY:
+                return 0
+            music_info = protocol.decode(payload)
+            if utils.safe_path(music_info["name"]) != music_name \
+                    or music_info["size"] != size \
+                    or music_info["length"] != length:
+                # The music has changed since the manifest was sent.
+                self.client.close()
+                return 0
+            frame_type, count = protocol.recv_header(self.client)
+            if frame_type != protocol.FILE or count != length:
+                raise protocol.ProtocolError("Expected a FILE frame.")
+            with open(music_name + ".part", "r+b") as music_file:
+                music_file.seek(offset)
+                while received < length:
+                    count = self.client.recv_into(
+                        view, min(length - received, len(view)))
+                    if not count:
+                        raise ConnectionError("Connection closed by the "
+                                              "server.")
+                    music_file.write(view[:count])
+                    received += count
+        except (OSError, protocol.ProtocolError):
+            # The session state is unknown after a failed transfer.
+            self.client.close()
+        return received
+
+    def copy_delta(self, option: int, music_name: str) -> (str, bool):
+        """Executes the --delta command.
+
+        The signature of the client copy of the music is sent to the
+        server, which answers with the operations that rebuild its copy
+        from the client blocks and the bytes the client doesn't have.
+        The music is rebuilt in a temporary file that only replaces the
+        music once its content hash matches the server one.
 
-    def raw_available(self) -> [str]:
+        Args:
+            option: A integer value corresponding to the track ID.
+            music_name: The name of the client copy of the music.
+
+        Returns:
+            A tuple with the created music name and whether it was
+            successfully created, or None when a whole copy should be
+            requested instead, like when the server doesn't support
+            --delta or the rebuilt music is wrong.
+        """
+
+        try:
+            old_file = open(music_name, "rb")
+        except OSError:
+            return None
+        with old_file:
+            size = os.fstat(old_file.fileno()).st_size
+            block = delta.block_size(size)
+            if -(-size // block) > delta.MAX_BLOCKS:
+                # The server refuses signatures this large.
+                return None
+            signature = delta.signature(old_file, size, block)
+            try:
+                frame_type, payload = self._request(
+                    f"--delta {option} {block} {size}\n", signature)
+            except (OSError, protocol.ProtocolError):
+                return "", False
+            if frame_type == protocol.BUSY:
+                return "", False
+            if frame_type != protocol.REPLY:
+                return None
+            music_info = protocol.decode(payload)
+            name = utils.safe_path(music_info["name"])
+            try:
+                frame_type, length = protocol.recv_header(self.client)
+                if frame_type != protocol.FILE:
+                    raise protocol.ProtocolError("Expected a FILE frame.")
+                if name is None:
+                    # Never let the server write outside the client
+                    # directory.
+                    self._discard(length)
+                    return "", False
+                digest = self._receive_delta(
+                    name, old_file, size, block, music_info["operations"],
+                    length, music_info["size"], music_info["hash"])
+            except (KeyboardInterrupt, OSError, protocol.ProtocolError):
+                # The session state is unknown after a failed transfer.
+                self.client.close()
+                return name or "", False
+        # The music is copied whole when the delta didn't rebuild it.
+        return (name, True) if digest else None
+
+    def _receive_delta(self, music_name: str, old_file, old_size: int,
+                       block: int, operations: [list], length: int,
+                       size: int, digest: str) -> bool:
+        """Rebuilds a music from the blocks of its old copy and the data
+        of a FILE frame.
+
+        Args:
+            music_name: The music file name.
+            old_file: The old copy, opened in binary mode.
+            old_size: The size of the old copy.
+            block: The block size of the signature.
+            operations: The delta operations sent by the server.
+            length: The number of bytes announced by the FILE frame.
+            size: The music file size.
+            digest: The server content hash, or None when it's unknown.
+
+        Returns:
+            True when the music was rebuilt, False when the rebuilt
+            music doesn't match the server one. The whole FILE frame is
+            received either way.
+
+        Raises:
+            OSError: When the transfer or a file operation fails.
+            ProtocolError: When the operations are malformed.
+        """
+
+        temporary = music_name + ".delta"
+        view = memoryview(self.__buffer)
+        hasher = hashlib.new(HASH_NAME)
+        received = 0
+        directory = os.path.dirname(music_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            with open(temporary, "wb") as music_file:
+                for operation, start, count in operations:
+                    if operation == delta.COPY:
+                        if not 0 <= start * block < old_size:
+                            raise protocol.ProtocolError("Bad block.")
+                        old_file.seek(start * block)
+                        count = min(count * block, old_size - start * block)
+                        while count:
+                            chunk = old_file.readinto(
+                                view[:min(count, len(view))])
+                            if not chunk:
+                                raise protocol.ProtocolError("Bad block.")
+                            music_file.write(view[:chunk])
+                            hasher.update(view[:chunk])
+                            count -= chunk
+                        continue
+                    if received + count > length:
+                        raise protocol.ProtocolError("Bad delta.")
+                    received += count
+                    while count:
+                        chunk = self.client.recv_into(
+                            view, min(count, len(view)))
+                        if not chunk:
+                            raise ConnectionError("Connection closed by the "
+                                                  "server.")
+                        music_file.write(view[:chunk])
+                        hasher.update(view[:chunk])
+                        count -= chunk
+                if received != length:
+                    raise protocol.ProtocolError("Bad delta.")
+                rebuilt = music_file.tell() == size and (
+                    digest is None or hasher.hexdigest() == digest)
+            if rebuilt:
+                os.replace(temporary, music_name)
+                self.hashes.store(music_name, hasher.hexdigest())
+            else:
+                os.remove(temporary)
+            return rebuilt
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    def copy_many(self, options: [int]) -> (str, bool):
+        """Executes the --copy-many command.
+
+        All the musics are requested at once and the server streams them
+        back on the current session, one after the other, so there's a
+        single round trip for the whole list. Every music is written to
+        disk as soon as it arrives.
+
+        Args:
+            options: The track IDs of the musics.
+
+        Yields:
+            A tuple with the created music name and whether it was
+            successfully created, for every option in the given order.
+            The name may be empty if the music didn't exist.
+        """
+
+        try:
+            first = self._request("--copy-many " + " ".join(map(str, options)))
+        except (OSError, protocol.ProtocolError):
+            self.client.close()
+            yield from (("", False) for _ in options)
+            return
+        for i in range(len(options)):
+            name = ""
+            try:
+                frame_type, payload = protocol.recv_frame(
+                    self.client, protocol.MAX_REPLY) if i else first
+                if frame_type != protocol.REPLY:
+                    raise protocol.ProtocolError("Expected a REPLY frame.")
+                music_info = protocol.decode(payload)
+                if music_info["name"] is None:
+                    yield "", False
+                    continue
+                name = utils.safe_path(music_info["name"])
+                frame_type, length = protocol.recv_header(self.client)
+                if frame_type != protocol.FILE:
+                    raise protocol.ProtocolError("Expected a FILE frame.")
+                if name is None:
+                    # Never let the server write outside the client
+                    # directory.
+                    self._discard(length, music_info.get("encoding"))
+                    yield "", False
+                    continue
+                self._receive_file(name, music_info["size"], 0, length,
+                                   music_info.get("hash"),
+                                   music_info.get("encoding"))
+            except protocol.IntegrityError as error:
+                # The stream goes on, the music is retried alone.
+                logger.warning("%s", error)
+                yield name, False
+                continue
+            except (OSError, protocol.ProtocolError):
+                # The rest of the stream is lost.
+                self.client.close()
+                yield name or "", False
+                yield from (("", False) for _ in options[i + 1:])
+                return
+            yield name, True
+
+    def _discard(self, length: int, encoding: str = None) -> None:
+        """Receives and throws away the data of a FILE frame, or the
+        FILE frames of a compressed music.
+
+        Raises:
+            OSError: When the transfer fails.
+            ProtocolError: When a compressed music isn't made of FILE
+                           frames.
+        """
+
+        view = memoryview(self.__buffer)
+        while length:
+            count = self.client.recv_into(view, min(length, len(view)))
+            if not count:
+                raise ConnectionError("Connection closed by the server.")
+            length -= count
+            if not length and encoding is not None:
+                length = self._next_block()
+
+    def _next_block(self) -> int:
+        """Receives the header of the next block of a compressed music.
+
+        Returns:
+            The block length. 0 when the music has ended.
+
+        Raises:
+            ProtocolError: When it isn't a FILE frame.
+        """
+
+        frame_type, length = protocol.recv_header(self.client)
+        if frame_type != protocol.FILE:
+            raise protocol.ProtocolError("Expected a FILE frame.")
+        return length
+
+    def _receive_data(self, length: int, encoding: str = None,
+                      expected: int = None):
+        """Receives the data of a FILE frame in chunks, or the blocks of
+        a compressed music, decompressed as they arrive.
+
+        Args:
+            length: The number of bytes announced by the FILE frame.
+            encoding: The codec the data was compressed with. None when
+                      it wasn't.
+            expected: The number of bytes the compressed data should
+                      decompress to.
+
+        Yields:
+            The received bytes, as views that are only valid until the
+            next chunk.
+
+        Raises:
+            OSError: When the transfer fails.
+            ProtocolError: When a compressed music isn't made of FILE
+                           frames, the codec isn't supported, or a
+                           block decompresses to more than the block
+                           size or the rest of the music.
+            ValueError: When a compressed block is corrupt. The rest of
+                        the music was received, so the session can go
+                        on.
+        """
+
+        view = memoryview(self.__buffer)
+        decoder = None
+        if encoding is not None:
+            try:
+                decoder = compression.BlockDecoder(encoding)
+            except ValueError as error:
+                raise protocol.ProtocolError(str(error)) from None
+        error = None
+        while length:
+            count = self.client.recv_into(view, min(length, len(view)))
+            if not count:
+                raise ConnectionError("Connection closed by the server.")
+            length -= count
+            if decoder is None:
+                yield view[:count]
+                continue
+            if error is None:
+                try:
+                    data = decoder.decode(view[:count], expected)
+                except ValueError as decode_error:
+                    # The rest of the music is received all the same.
+                    error = decode_error
+                else:
+                    expected -= len(data)
+                    if data:
+                        yield data
+            if not length:
+                length = self._next_block()
+                decoder = compression.BlockDecoder(encoding)
+        if error is not None:
+            raise error
+
+    def _receive_file(self, music_name: str, size: int, offset: int,
+                      length: int, digest: str = None,
+                      encoding: str = None) -> None:
+        """Receives the file data of a FILE frame into a music file.
+
+        The data is received in chunks into a reusable buffer, so the
+        memory used doesn't depend on the file size. It is written to a
+        temporary file that only replaces the music file after the whole
+        file has arrived, so an interrupted transfer never leaves a
+        truncated music behind. The temporary file is kept truncated to
+        the bytes received, so the download can be resumed later.
+
+        The content hash is computed as the chunks arrive, so the music
+        isn't read again to be checked. Only the part of a resumed
+        download that was already on disk is read. A compressed music is
+        decompressed as its blocks arrive.
+
+        Args:
+            music_name: The music file name.
+            size: The music file size.
+            offset: The position of the first received byte.
+            length: The number of bytes announced by the FILE frame.
+            digest: The content hash the music must have. None when the
+                    server doesn't know it.
+            encoding: The codec the music was compressed with. None when
+                      it wasn't.
+
+        Raises:
+            OSError: When the transfer or a file operation fails.
+            ProtocolError: When a compressed music isn't made of FILE
+                           frames, or a block decompresses to too many
+                           bytes.
+            IntegrityError: When the music doesn't have the announced
+                            size or hash, or a compressed block is
+                            corrupt. The temporary file is removed.
+        """
+
+        part_name = music_name + ".part"
+        view = memoryview(self.__buffer)
+        hasher = hashlib.new(HASH_NAME)
+        received = 0
+        directory = os.path.dirname(music_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            with open(part_name, "r+b" if offset else "wb") as music_file:
+                utils.preallocate(music_file.fileno(), size)
+                left = offset
+                while left:
+                    count = music_file.readinto(view[:min(left, len(view))])
+                    if not count:
+                        raise protocol.IntegrityError(music_name)
+                    hasher.update(view[:count])
+                    left -= count
+                music_file.seek(offset)
+                try:
+                    for chunk in self._receive_data(length, encoding,
+                                                    size - offset):
+                        music_file.write(chunk)
+                        hasher.update(chunk)
+                        received += len(chunk)
+                except ValueError:
+                    raise protocol.IntegrityError(music_name) from None
+            if offset + received != size or (
+                    digest is not None and hasher.hexdigest() != digest):
+                raise protocol.IntegrityError(music_name)
+            os.replace(part_name, music_name)
+            self.hashes.store(music_name, hasher.hexdigest())
+        except protocol.IntegrityError:
+            if os.path.exists(part_name):
+                os.remove(part_name)
+            raise
+        except BaseException:
+            if os.path.exists(part_name):
+                os.truncate(part_name, offset + received)
+            raise
+
+    def raw_available(self) -> [(int, str)]:
         """Sends a --raw-available to the server.
 
         Returns:
-            A list of music names strings in the server.
+            A list of tuples with the track ID and the music name of
+            every music in the server.
         """
 
-        self.client.send(b"--raw-available")
-        server_musics = ""
-        while True:
-            music_name = self.client.recv(4096).decode()
-            if music_name == "end":
-                break
-            MusicSenderClient.checkit(music_name)
-            server_musics += music_name
-        return server_musics.split("|")
+        frame_type, payload = self._request("--raw-available")
+        if frame_type != protocol.REPLY:
+            return []
+        return [tuple(track) for track in protocol.decode(payload)]
 
-    def available(self) -> str:
+    def query(self, search: str = None, prefix: bool = False,
+              extension: str = None, offset: int = 0,
+              limit: int = None) -> (int, [(int, str)]):
+        """Sends a --query to the server.
+
+        Only the requested slice of the catalog is sent by the server.
+
+        Args:
+            search: A text the music names must contain.
+            prefix: Whether the words of the search must start words of
+                    the music names.
+            extension: A file extension the musics must have.
+            offset: How many matching musics are skipped.
+            limit: The maximum number of musics. The server may send
+                   less than that.
+
+        Returns:
+            A tuple with the number of matching musics and a list of
+            tuples with the track ID and name of the musics. None when
+            the server refuses the query.
+        """
+
+        query = {"search": search, "prefix": prefix, "extension": extension,
+                 "offset": offset, "limit": limit}
+        frame_type, payload = self._request("--query " + json.dumps(query))
+        if frame_type != protocol.REPLY:
+            return None
+        answer = protocol.decode(payload)
+        return answer["total"], [tuple(track) for track in answer["tracks"]]
+
+    def available(self, search: str = None, prefix: bool = False,
+                  extension: str = None, page: int = None,
+                  page_size: int = 50) -> str:
         """Executes the --available command.
 
+        Args:
+            search: A text the music names must contain.
+            prefix: Whether the words of the search must start words of
+                    the music names.
+            extension: A file extension the musics must have.
+            page: The one-based page to be shown. None shows every
+                  matching music.
+            page_size: The number of musics of a page.
+
         Returns:
             A string containing the music catalog in server.
         """
 
-        server_musics = self.raw_available()
-        music_catalog = ""
-        for i, msc in enumerate(server_musics):
-            music_catalog += f"{i + 1} -> {msc}\n"
-        return music_catalog
+        if page is None and not (search or extension):
+            server_musics = self.raw_available()
+        else:
+            offset = (page - 1) * page_size if page else 0
+            server_musics = []
+            while True:
+                limit = page_size if page else None
+                answer = self.query(search, prefix, extension,
+                                    offset + len(server_musics), limit)
+                if answer is None:
+                    return ""
+                total, tracks = answer
+                server_musics.extend(tracks)
+                if page or not tracks \
+                        or offset + len(server_musics) >= total:
+                    break
+        return "".join(f"{track_id} -> {msc}\n"
+                       for track_id, msc in server_musics)
+
+    def manifest(self) -> [dict]:
+        """Gets the server manifest.
+
+        The last manifest is cached on disk with its catalog version, so
+        only the changes since that version are requested with a
+        --changes. When nothing has changed, the answer is a small empty
+        list. Servers without --changes are sent a --manifest.
+
+        Returns:
+            A list of dicts with the track ID, name, size, mtime and
+            content hash of the server musics, in catalog order. None
+            when the server doesn't publish manifests.
+        """
+
+        frame_type, payload = self._request(
+            f"--changes {self.catalog.epoch or 'none'} {self.catalog.version}")
+        if frame_type == protocol.REPLY:
+            self.catalog.apply(protocol.decode(payload))
+            self.catalog.save()
+            return self.catalog.manifest()
+        frame_type, payload = self._request("--manifest")
+        if frame_type != protocol.REPLY:
+            return None
+        return protocol.decode(payload)
+
+    def stats(self) -> dict:
+        """Gets the server counters and metrics.
+
+        Returns:
+            The server stats() dict, with the process ID of the server
+            worker in "pid". None when the server doesn't publish them.
+        """
+
+        frame_type, payload = self._request("--stats")
+        if frame_type != protocol.REPLY:
+            return None
+        return protocol.decode(payload)
+
+    def compare(self, manifest: [dict] = None) -> dict:
+        """Compares the client musics to the server musics.
+
+        The content hashes of the server manifest are used, so a music
+        renamed on the server, changed on the server or truncated on the
+        client is detected. Local hashes are kept in the client
+        HashCache and a local file is only hashed when its size matches
+        the server music. Servers without manifests are compared by
+        name only. Subdirectories of the client directory are compared
+        too.
+
+        Args:
+            manifest: The server manifest. It's requested to the server
+                      when it's None.
+
+        Returns:
+            A dict with the lists of musics that are "missing" on the
+            client, "stale" (changed on the server), "corrupt" (with a
+            wrong size on the client), as tuples with the server track
+            ID and name, and "renamed", as tuples with the server track
+            ID, the client name and the server name.
+        """
+
+        changes = {"missing": [], "stale": [], "corrupt": [], "renamed": []}
+        client_mscs = utils.walk_music()
+        client_set = set(client_mscs)
+        if manifest is None:
+            manifest = self.manifest()
+        if manifest is None:
+            for track_id, name in self.raw_available():
+                if name not in client_set:
+                    changes["missing"].append((track_id, name))
+            return changes
+
+        server_names = set()
+        missing = {}
+        for entry in manifest:
+            track_id, name = entry["id"], entry["name"]
+            server_names.add(name)
+            if entry["hash"] is None or utils.safe_path(name) is None:
+                # Removed from the server while the manifest was built,
+                # or it can't be stored in the client directory.
+                continue
+            if name not in client_set:
+                missing.setdefault((entry["size"], entry["hash"]), []) \
+                    .append((track_id, name))
+            elif os.path.getsize(name) != entry["size"]:
+                changes["corrupt"].append((track_id, name))
+            elif self.hashes.digest(name) != entry["hash"]:
+                changes["stale"].append((track_id, name))
+
+        missing_sizes = {size for size, _ in missing}
+        for name in client_mscs:
+            if name in server_names:
+                continue
+            size = os.path.getsize(name)
+            if size not in missing_sizes:
+                continue
+            renamed = missing.get((size, self.hashes.digest(name)))
+            if renamed:
+                i, server_name = renamed.pop(0)
+                changes["renamed"].append((i, name, server_name))
+        for musics in missing.values():
+            changes["missing"].extend(musics)
+        changes["missing"].sort()
+
+        self.hashes.prune(client_mscs)
+        self.hashes.save()
+        return changes
 
     def diff(self) -> (int, str):
-        """Generates all the musics the client doesn't have.
+        """Generates all the musics the client doesn't have or has an
+        outdated or corrupt copy of. Musics that were only renamed on
+        the server aren't generated, see pending().
 
         Yields:
-            A tuple containing the song relative index to the server
-            musics index and his name.
+            A tuple containing the server track ID of the song and his
+            name.
+        """
+
+        changes = self.compare()
+        for key in ("missing", "stale", "corrupt"):
+            yield from changes[key]
+
+    def pending(self, changes: dict = None) -> [(int, str)]:
+        """Renames the client musics that were renamed on the server and
+        returns the musics that still need to be downloaded.
+
+        Args:
+            changes: The result of compare(). It's computed when it's
+                     None.
+
+        Returns:
+            A list of tuples with the server track ID and name of the
+            musics to be downloaded.
         """
 
-        server_mscs = self.raw_available()
-        client_mscs = list(filter(utils.is_music_file, os.listdir(".")))
-        missing_client_mscs = list(
-            set(server_mscs).difference(set(client_mscs))
-        )
-        for missing in missing_client_mscs:
-            relative_index = server_mscs.index(missing) + 1
-            yield relative_index, missing
+        if changes is None:
+            changes = self.compare()
+        musics = changes["missing"] + changes["stale"] + changes["corrupt"]
+        for i, client_name, server_name in changes["renamed"]:
+            local_name = utils.safe_path(server_name)
+            try:
+                directory = os.path.dirname(local_name)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                os.replace(client_name, local_name)
+            except OSError:
+                musics.append((i, server_name))
+        return musics
+
+    def sync(self, engine: SyncEngine) -> SyncResult:
+        """Downloads all the needed musics with an engine, like a
+        SyncEngine or a SwarmEngine.
+
+        Args:
+            engine: The engine used for the downloads.
 
-    def automatic(self) -> None:
+        Yields:
+            A SyncResult for every download.
+        """
+
+        yield from engine.run(self.pending())
+
+    def automatic(self, jobs: int = 1, retries: int = 3,
+                  batch: int = 1) -> None:
         """Executes the --automatic command. It generates the created
-        music name. In case of any errors, the function tries to
-        download the music again
+        music name. In case of any errors, the music is downloaded again
+        after a backoff, up to a maximum number of retries. Each of the
+        concurrent downloads keeps its own session with the server and
+        the first one reuses the client session.
+
+        Args:
+            jobs: The number of concurrent downloads.
+            retries: How many times a failed download is retried.
+            batch: How many musics are requested at once with a single
+                   --copy-many.
 
         Yields:
             A string representing the created music.
         """
 
-        musics_to_download = [info[0] for info in self.diff()]
+        engine = SyncEngine(self, jobs, retries, batch=batch)
+        for result in self.sync(engine):
+            if result.successful:
+                yield result.name
+
+    def watch(self, engine: SyncEngine) -> SyncResult:
+        """Executes the --watch command.
+
+        The client subscribes to the server catalog on its connection
+        and the server pushes the catalog changes as they happen. New
+        and changed musics are downloaded by the given engine, on its
+        own connections, as soon as they arrive. The server sends
+        heartbeats while nothing happens: when none arrives in three
+        heartbeat intervals, or the connection fails, the client
+        reconnects after a jittered exponential backoff and subscribes
+        again from the last catalog version it has seen.
+
+        Args:
+            engine: The SyncEngine used for the downloads. It must not
+                    use this client.
+
+        Yields:
+            A SyncResult for every download.
 
-        while len(musics_to_download) != 0:
-            code = musics_to_download.pop()
-            copy_client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        Raises:
+            CommandRefused: When the server doesn't support --watch.
+        """
+
+        failures = 0
+        while True:
             try:
-                copy_client.connect(self.address)
-            except ConnectionRefusedError:
-                return
-            self.client = copy_client
-            music_name, successfull = self.copy(code)
-            if not successfull:
-                musics_to_download.append(code)
-            self.client.close()
-            yield music_name
+                if self.client.fileno() == -1:
+                    self.connect()
+                self._send_command(f"--watch {self.catalog.epoch or 'none'} "
+                                   f"{self.catalog.version}")
+                heartbeat = self.session.get("heartbeat") or 10.0
+                self.client.settimeout(3 * heartbeat)
+                while True:
+                    frame_type, payload = protocol.recv_frame(
+                        self.client, protocol.MAX_REPLY)
+                    if frame_type == protocol.ERROR:
+                        raise protocol.CommandRefused(
+                            "--watch", payload.decode(errors="replace"))
+                    failures = 0
+                    if frame_type == protocol.HEARTBEAT:
+                        continue
+                    if frame_type != protocol.EVENT:
+                        raise protocol.ProtocolError("Expected an EVENT.")
+                    self.catalog.apply(protocol.decode(payload))
+                    self.catalog.save()
+                    changes = self.compare(self.catalog.manifest())
+                    yield from engine.run(self.pending(changes))
+            except protocol.CommandRefused:
+                self.client.close()
+                raise
+            except (OSError, ValueError, protocol.ProtocolError):
+                # A dead connection or a corrupt EVENT, which the next
+                # session sends again.
+                self.client.close()
+                failures += 1
+                delay = min(30.0, 0.5 * 2 ** failures)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+
+def print_result(engine: SyncEngine, result: SyncResult) -> None:
+    """Prints the result of a download of a sync engine.
+
+    Args:
+
+        engine: The SyncEngine that made the download.
+
+        result: The SyncResult of the download.
+    """
+
+    progress = f"[{engine.done}/{engine.total}]"
+    if result.successful:
+        rate = engine.throughput() / 1024 / 1024
+        print(f"\033[;32m{progress} {result.name} "
+              f"({rate:.2f} MiB/s)\033[m")
+    else:
+        print(f"\033[;31m{progress} Music {result.code} has failed "
+              f"after {result.attempts} attempts.\033[m")
+
+
+def create_mirrors(client: MusicSenderClient,
+                   mirrors: [str]) -> [MusicSenderClient]:
+    """Creates a client for every mirror of a swarm.
+
+    Args:
+
+        client: The MusicSenderClient of the first server, with the
+                ambient already set.
+
+        mirrors: The mirror addresses, like "192.168.0.2:5000".
+
+    Returns:
+        A list with the clients of the mirrors that could be reached.
+    """
+
+    clients = []
+    for mirror in mirrors:
+        host, _, port = mirror.rpartition(":")
+        try:
+            # The ambient of the first client has changed the directory.
+            mirror_client = type(client)(
+                (host, int(port)), os.getcwd(), client.chunk_size,
+                client.segments, client.segment_threshold,
+                client.compression)
+        except ValueError:
+            print(f"\033[;31mMirror {mirror} isn't a valid address.\033[m")
+            continue
+        if mirror_client.set_ambient():
+            clients.append(mirror_client)
+        else:
+            print(f"\033[;31mMirror {mirror} can't be reached.\033[m")
+    return clients
 
 
 def handle_args(client: MusicSenderClient, args) -> None:
@@ -295,21 +1497,36 @@ def handle_args(client: MusicSenderClient, args) -> None:
     """
 
     available = args.available and not (args.diff or args.copy \
-                                        or args.automatic)
-    copy = args.copy and not (args.diff or args.automatic or args.available)
+                                        or args.automatic or args.copy_many
+                                        or args.watch or args.stats)
+    copy = args.copy and not (args.diff or args.automatic or args.available
+                              or args.copy_many or args.watch or args.stats)
+    copy_many = args.copy_many and not (args.diff or args.automatic
+                                        or args.available or args.copy
+                                        or args.watch or args.stats)
     automatic = args.automatic and not (args.available or args.copy \
-        or args.diff)
-    diff = args.diff and not (args.available or args.copy or args.automatic)
+        or args.diff or args.copy_many or args.watch or args.stats)
+    diff = args.diff and not (args.available or args.copy or args.automatic
+                              or args.copy_many or args.watch or args.stats)
+    watch = args.watch and not (args.available or args.copy or args.diff
+                                or args.automatic or args.copy_many
+                                or args.stats)
+    stats = args.stats and not (args.available or args.copy or args.diff
+                                or args.automatic or args.copy_many
+                                or args.watch)
 
     if available:
-        catalog = client.available()
+        catalog = client.available(args.search, args.prefix, args.ext,
+                                   args.page, args.page_size)
         print("               Current catalog")
         print("=" * 30)
         print(catalog)
         print("=" * 30)
     elif copy:
         option = args.copy
-        created_music, was_successful = client.copy(option)
+        # The cached name finds an outdated copy to be updated.
+        created_music, was_successful = client.copy(
+            option, client.catalog.name(option))
         if was_successful:
             print(f"\033[;32mMusic {created_music} created.\033[m")
         elif created_music and not was_successful:
@@ -317,40 +1534,185 @@ def handle_args(client: MusicSenderClient, args) -> None:
                   + "file can be corrupted.\033[m")
         elif not (created_music and was_successful):
             print("\033[;31mThe music you're looking for doesn't exist\033[m")
+    elif copy_many:
+        results = client.copy_many(args.copy_many)
+        for option, (created_music, was_successful) in zip(args.copy_many,
+                                                           results):
+            if was_successful:
+                print(f"\033[;32mMusic {created_music} created.\033[m")
+            elif created_music:
+                print(f"\033[;31mMusic {created_music} was not created.\033[m")
+            else:
+                print(f"\033[;31mMusic {option} doesn't exist or has "
+                      "failed.\033[m")
     elif automatic:
         print("Please wait...")
-        for music_created in client.automatic():
-            print(f"\033[;32m{music_created}")
-        print("\033[mDone...")
+        if args.mirrors:
+            engine = SwarmEngine([client] + create_mirrors(client,
+                                                           args.mirrors),
+                                 args.jobs, args.retries)
+        else:
+            engine = SyncEngine(client, args.jobs, args.retries,
+                                batch=args.batch)
+        for result in client.sync(engine):
+            print_result(engine, result)
+        print(f"Done... {engine.done - engine.failed} downloaded, "
+              f"{engine.failed} failed, "
+              f"{engine.bytes_received / 1024 / 1024:.2f} MiB in "
+              f"{engine.elapsed():.2f}s.")
+        for mirror in engine.mirrors if args.mirrors else []:
+            state = "" if mirror.alive else ", dropped"
+            print(f"Mirror {mirror.address[0]}:{mirror.address[1]}: "
+                  f"{mirror.served / 1024 / 1024:.2f} MiB at "
+                  f"{mirror.throughput / 1024 / 1024:.2f} MiB/s{state}.")
     elif diff:
-        for i, mssng in client.diff():
+        changes = client.compare()
+        for i, mssng in changes["missing"]:
             print(f"{i} -> {mssng}")
+        for i, stale in changes["stale"]:
+            print(f"{i} -> {stale} (changed on the server)")
+        for i, corrupt in changes["corrupt"]:
+            print(f"{i} -> {corrupt} (corrupt on the client)")
+        for i, client_name, server_name in changes["renamed"]:
+            print(f"{i} -> {server_name} (renamed from {client_name})")
+    elif watch:
+        print("Watching the server catalog, press Ctrl+C to stop...")
+        engine = SyncEngine(client.clone(), args.jobs, args.retries,
+                            batch=args.batch)
+        try:
+            for result in client.watch(engine):
+                print_result(engine, result)
+        except protocol.ProtocolError as error:
+            print(f"\033[;31m{error}\033[m")
+        except KeyboardInterrupt:
+            print("Stopped watching.")
+    elif stats:
+        stats = client.stats()
+        if stats is None:
+            print("\033[;31mThe server doesn't publish its stats\033[m")
+            return
+        for key, value in stats.items():
+            if not isinstance(value, dict):
+                print(f"{key}: {value}")
+        for error, count in sorted(stats["errors"].items()):
+            print(f"error {error}: {count}")
+        for command, histogram in sorted(stats["commands"].items()):
+            mean = histogram["sum"] / histogram["count"] * 1000
+            print(f"{command}: {histogram['count']} commands, "
+                  f"{mean:.1f} ms on average")
     else:
         # Happens if the user try to mix options
         print("\033[;31mDon't mix options, only put the necessary\033[m")
 
 
+def positive_int(value: str) -> int:
+    """Converts an argument to a positive integer.
+
+    Args:
+        value: The argument.
+
+    Raises:
+        ArgumentTypeError: When it isn't an integer greater than 0.
+    """
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} isn't a positive "
+                                         "integer")
+    return number
+
+
+def non_negative_int(value: str) -> int:
+    """Converts an argument to an integer that isn't negative.
+
+    Args:
+        value: The argument.
+
+    Raises:
+        ArgumentTypeError: When it isn't an integer greater or equal to
+                           0.
+    """
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} isn't a non-negative "
+                                         "integer")
+    return number
+
+
 def add_arguments(parser: argparse.ArgumentParser) -> None:
     """Add the arguments for the client app.
 
+    The options that pick what the client does can't be mixed.
+
     Args:
 
         parser: The ArgumentParser instance.
     """
 
-    parser.add_argument("-v", "--available", help="shows the available "
-                        "music catalog and theirs code numbers",
+    actions = parser.add_mutually_exclusive_group()
+    actions.add_argument("-v", "--available", help="shows the available "
+                        "music catalog and theirs track IDs",
+                        action="store_true")
+    parser.add_argument("--search", help="shows only the musics whose name "
+                        "contains SEARCH. Used with --available", type=str)
+    parser.add_argument("--prefix", help="matches the words of --search "
+                        "against the beginning of the words of the names",
                         action="store_true")
-    parser.add_argument("-c", "--copy", help="download a music from a given "
-                        "option. In case of a wrong index, a simple error "
+    parser.add_argument("--ext", help="shows only the musics with the EXT "
+                        "extension. Used with --available", type=str)
+    parser.add_argument("--page", help="shows only the given page of the "
+                        "catalog. Used with --available", type=int)
+    parser.add_argument("--page-size", help="number of musics of a page",
+                        type=positive_int, default=50)
+    actions.add_argument("-c", "--copy", help="download a music from a given "
+                        "track ID. In case of a wrong ID, a simple error "
                         "message is returned from the server", type=int)
-    parser.add_argument("-d", "--diff", help="This shows a list of musics "
+    actions.add_argument("-m", "--copy-many", help="download many musics "
+                        "from their track IDs in a single request",
+                        type=int, nargs="+")
+    actions.add_argument("-d", "--diff", help="This shows a list of musics "
                         "that in server but not in client music directory. "
                         "It uses the path specified by --local.",
                         action="store_true")
-    parser.add_argument("-a", "--automatic", help="downloads the list of "
+    actions.add_argument("-a", "--automatic", help="downloads the list of "
                         "musics that is not in client directory.",
                         action="store_true")
+    actions.add_argument("-w", "--watch", help="keeps downloading the new "
+                        "and changed musics as the server reports them.",
+                        action="store_true")
+    actions.add_argument("-s", "--stats", help="shows the server counters and "
+                        "command latencies.", action="store_true")
+    parser.add_argument("-j", "--jobs", help="number of concurrent "
+                        "downloads used by --automatic.", type=positive_int,
+                        default=1)
+    parser.add_argument("--mirrors", help="other servers with the same "
+                        "library that --automatic downloads from at once.",
+                        nargs="+", metavar="HOST:PORT")
+    parser.add_argument("-b", "--batch", help="number of musics --automatic "
+                        "requests at once on a single stream.",
+                        type=positive_int, default=16)
+    parser.add_argument("--retries", help="how many times --automatic "
+                        "retries a failed download.", type=non_negative_int,
+                        default=3)
+    parser.add_argument("--chunk-size", help="size in bytes of the buffer "
+                        "used to receive musics.", type=positive_int,
+                        default=256 * 1024)
+    parser.add_argument("--segments", help="number of connections that "
+                        "download a large music at once.",
+                        type=positive_int, default=4)
+    parser.add_argument("--segment-threshold", help="size in bytes from "
+                        "which a music is downloaded in segments.",
+                        type=positive_int, default=64 * 1024 * 1024)
+    parser.add_argument("--no-compression", help="never lets the server "
+                        "compress the WAV, PCM and AIFF musics.",
+                        action="store_true")
     parser.add_argument("-l", "--local", help="Path where musics will be "
                         "stored. if not specified the local is the current "
                         "path.", default=".", type=str)
@@ -360,16 +1722,22 @@ def add_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("-p", "--port", help="Server port. if not specified the"
                         " port is a range between 1024 and 65432", type=int,
                         default=random.randrange(1024, 65432))
+    parser.add_argument("--log-level", help="log level of the download "
+                        "warnings, like the retries of corrupt musics.",
+                        default="warning", choices=list(log.LEVELS))
 
 
 def main() -> None:
     parser = argparse.ArgumentParser()
     add_arguments(parser)
     args = parser.parse_args()
+    log.setup(args.log_level)
     address = (args.host, args.port)
     client = None
     try:
-        client = MusicSenderClient(address, args.local)
+        client = MusicSenderClient(address, args.local, args.chunk_size,
+                                   args.segments, args.segment_threshold,
+                                   not args.no_compression)
     except ValueError:
         print("\033[;31Please put only valid host adresses.\033[m")
     else:
@@ -0,0 +1,974 @@
+"""Music Sender commands.
+
+This module executes the client commands independently of how a server
+engine talks to the network. Every command is a generator of actions
+that the engine performs on the client connection:
+
+    (SEND, data)                     Sends the data bytes.
+    (SENDFILE, file, offset, count)  Sends a byte range of a file.
+    (SLEEP, seconds)                 Waits before the next action.
+    (CALL, function)                 Runs a blocking function. Its
+                                     result is sent back into the
+                                     generator.
+    (CLOSE,)                         Closes the client connection.
+    (WAIT, version, timeout)         Waits for a catalog version other
+                                     than version. True, False on
+                                     timeout or None when the server
+                                     is stopping is sent back into the
+                                     generator.
+
+An OSError raised while performing an action is thrown back into the
+generator. The threaded engine performs the actions with blocking calls
+and the asyncio engine awaits them, so both serve the same commands.
+"""
+
+import functools
+import logging
+import os
+import re
+import time
+
+from . import compression, delta, protocol
+from .log import RequestLogger
+
+# Actions
+SEND = 1
+SENDFILE = 2
+SLEEP = 3
+CALL = 4
+CLOSE = 5
+WAIT = 6
+
+# Maximum number of musics of a --copy-many command
+MAX_BATCH = 1024
+# Maximum number of musics of a --query page
+MAX_PAGE = 1000
+# Share of a music that may be sent as literal bytes by --delta before
+# the whole music is sent instead
+MAX_LITERAL = 0.5
+logger = logging.getLogger(__name__)
+# Command names the metrics are kept by, others are "unknown"
+COMMANDS = {"--copy", "--copy-many", "--raw-available", "--manifest",
+            "--query", "--changes", "--watch", "--delta", "--stats"}
+
+
+class CommandProcessor:
+    """Executes the commands of a single client connection.
+
+    The following commands the class handles:
+
+        * --copy <any integer non-negative> [offset [length]]
+        * --copy-many <any integer non-negative> [...] (framed only)
+        * --raw-available
+        * --manifest
+        * --query <JSON object> (framed only)
+        * --changes <epoch> <version> (framed only)
+        * --watch <epoch> <version> (framed only)
+        * --delta <track ID> <block size> <size> + signature (framed
+          only)
+        * --stats (framed only)
+
+    Framed clients identify musics by their stable track IDs. Legacy
+    clients identify them by their one-based catalog positions.
+
+    Attributes:
+        server: The MusicSenderServer that holds the shared state, like
+                the catalog and the library index.
+        client_address: The client host and port.
+        framed: Whether the client speaks the framed protocol.
+        log: The RequestLogger of the current command, with the client
+             address and the command name.
+        codecs: The codecs the music data may be compressed with, the
+                ones the client has offered in its HELLO that the server
+                supports.
+
+    Methods:
+        get_option(msg):
+            Gets the music option from a --copy command.
+
+        get_range(msg):
+            Gets the byte range from a --copy command.
+
+        get_batch(msg):
+            Gets the track IDs from a --copy-many command.
+
+        get_query(msg):
+            Gets the query parameters from a --query command.
+
+        get_version(msg):
+            Gets the catalog version from a --changes or a --watch
+            command.
+
+        get_delta(msg):
+            Gets the track ID and the client signature from a --delta
+            command.
+
+        hello(payload):
+            Returns the HELLO payload with the session settings.
+
+        execute(msg):
+            Generates the actions of a client command.
+
+        error(error):
+            Generates the actions of an error message.
+
+        busy():
+            Generates the actions of a busy answer.
+    """
+
+    def __init__(self, server, client_address, framed: bool) -> None:
+        """Initializes the processor.
+
+        Args:
+            server: The MusicSenderServer instance.
+            client_address: The client host and port.
+            framed: Whether the client speaks the framed protocol.
+        """
+
+        self.server = server
+        self.client_address = client_address
+        self.framed = framed
+        self.__log = RequestLogger(logger, {
+            "client": f"{client_address[0]}:{client_address[1]}"})
+        self.log = self.__log
+        self.codecs = []
+
+    @staticmethod
+    def get_option(msg) -> int:
+        """Gets the requested music option from the client message.
+
+        Args:
+            msg: The client message command string.
+
+        Returns:
+            The option integer inside the client request message.
+
+        Raises:
+            ValueError: When the command is not valid.
+        """
+
+        msg = msg.decode()
+        matches = re.match(r"--copy \d+", msg)
+        if matches:
+            return int(re.search(r"\d+", msg).group()) - 1
+        raise ValueError("Bad command.")
+
+    @staticmethod
+    def get_range(msg) -> (int, int):
+        """Gets the requested byte range from a --copy command.
+
+        The command may carry an offset and a length after the option,
+        like b"--copy 3 1048576 65536". Both are optional.
+
+        Args:
+            msg: The client message command string.
+
+        Returns:
+            A tuple with the offset and the length integers. The length
+            is None when the rest of the file is requested.
+
+        Raises:
+            ValueError: When the command is not valid.
+        """
+
+        matches = re.match(r"--copy \d+(?: (\d+))?(?: (\d+))?$", msg.decode())
+        if not matches:
+            raise ValueError("Bad command.")
+        offset = int(matches.group(1) or 0)
+        length = int(matches.group(2)) if matches.group(2) else None
+        return offset, length
+
+    @staticmethod
+    def get_batch(msg) -> [int]:
+        """Gets the requested track IDs from a --copy-many command, like
+        b"--copy-many 4 8 15".
+
+        Args:
+            msg: The client message command string.
+
+        Returns:
+            A list with the track ID integers, in the requested order.
+
+        Raises:
+            ValueError: When the command is not valid or has more than
+                        MAX_BATCH track IDs.
+        """
+
+        matches = re.match(r"--copy-many((?: \d+)+)$", msg.decode())
+        if not matches:
+            raise ValueError("Bad command.")
+        track_ids = [int(track_id) for track_id in matches.group(1).split()]
+        if len(track_ids) > MAX_BATCH:
+            raise ValueError("Too many musics.")
+        return track_ids
+
+    @staticmethod
+    def get_query(msg) -> dict:
+        """Gets the query parameters from a --query command.
+
+        The command carries a JSON object, like
+        b'--query {"search": "queen", "offset": 50, "limit": 50}'. Every
+        parameter of MusicCatalog.query() is optional and the limit is
+        at most MAX_PAGE.
+
+        Args:
+            msg: The client message command string.
+
+        Returns:
+            A dict with the query keyword arguments.
+
+        Raises:
+            ValueError: When the command is not valid.
+        """
+
+        if not msg.startswith(b"--query "):
+            raise ValueError("Bad command.")
+        try:
+            query = protocol.decode(msg[len(b"--query "):])
+        except ValueError:
+            raise ValueError("Bad command.") from None
+        types = {"search": str, "prefix": bool, "extension": str,
+                 "offset": int, "limit": int}
+        if not isinstance(query, dict):
+            raise ValueError("Bad command.")
+        for key, value in query.items():
+            if key not in types or not (
+                    value is None or isinstance(value, types[key])):
+                raise ValueError(f"Bad query parameter {key}.")
+        query["offset"] = query.get("offset") or 0
+        query["limit"] = query.get("limit") or MAX_PAGE
+        if query["offset"] < 0 or not 0 < query["limit"] <= MAX_PAGE:
+            raise ValueError("Bad query range.")
+        return query
+
+    @staticmethod
+    def get_version(msg) -> (str, int):
+        """Gets the catalog version the client has seen from a
+        --changes or a --watch command, like b"--changes 3f2a...9c 1234".
+
+        Args:
+            msg: The client message command string.
+
+        Returns:
+            A tuple with the epoch string and the version integer.
+
+        Raises:
+            ValueError: When the command is not valid.
+        """
+
+        matches = re.match(r"--(?:changes|watch) (\w+) (\d+)$",
+                           msg.decode())
+        if not matches:
+            raise ValueError("Bad command.")
+        return matches.group(1), int(matches.group(2))
+
+    @staticmethod
+    def get_delta(msg) -> (int, int, int, [(int, bytes)]):
+        """Gets the track ID and the signature of the client copy from a
+        --delta command.
+
+        The command line, like b"--delta 12 4096 5242880", carries the
+        track ID, the block size and the size of the client copy. It's
+        followed by a newline and the binary block signature.
+
+        Args:
+            msg: The client message command bytes.
+
+        Returns:
+            A tuple with the track ID, the block size, the client copy
+            size and the (weak, strong) tuples of the blocks.
+
+        Raises:
+            ValueError: When the command is not valid, or its block size
+                        is out of the MIN_BLOCK to MAX_BLOCK range or it
+                        has more than MAX_BLOCKS blocks.
+        """
+
+        line, _, data = msg.partition(b"\n")
+        matches = re.match(r"--delta (\d+) (\d+) (\d+)$", line.decode())
+        if not matches:
+            raise ValueError("Bad command.")
+        track_id, block, size = map(int, matches.groups())
+        # The server searches every block of the client, so a tiny
+        # block or a huge signature would keep it busy for long.
+        if not delta.MIN_BLOCK <= block <= delta.MAX_BLOCK:
+            raise ValueError("Bad block size.")
+        count = -(-size // block)
+        if count > delta.MAX_BLOCKS \
+                or len(data) != count * delta.SIGNATURE.size:
+            raise ValueError("Bad signature.")
+        return track_id, block, size, delta.parse_signature(data)
+
+    def hello(self, payload: bytes = b"") -> bytes:
+        """Returns the HELLO payload, with the protocol version, the
+        session limits and the codecs the music data may be compressed
+        with.
+
+        Args:
+            payload: The client HELLO payload. The codecs it offers in
+                     "compression" that the server supports are kept in
+                     codecs.
+        """
+
+        try:
+            offered = protocol.decode(payload).get("compression")
+        except (ValueError, AttributeError):
+            # Clients that predate compression send no codecs.
+            offered = None
+        compressor = self.server.compressor
+        if compressor is not None and isinstance(offered, list):
+            self.codecs = [codec for codec in offered
+                           if codec in compressor.codecs]
+        return protocol.encode({
+            "version": protocol.VERSION,
+            "idle_timeout": self.server.idle_timeout,
+            "max_requests": self.server.max_requests,
+            "heartbeat": self.server.heartbeat,
+            "compression": self.codecs,
+        })
+
+    @staticmethod
+    def frame(frame_type: int, payload: bytes = b"") -> tuple:
+        """Returns the action that sends a frame."""
+
+        return SEND, protocol.pack_header(frame_type, len(payload)) + payload
+
+    def error(self, error: bytes):
+        """Sends an error message to the client.
+
+        Args:
+            error: The error message bytes, like b"not-available".
+        """
+
+        self.server.metrics.error(error)
+        if self.framed:
+            yield self.frame(protocol.ERROR, error)
+        else:
+            yield SEND, error
+
+    def busy(self):
+        """Tells the client the server is full.
+
+        Framed clients get a BUSY frame with the milliseconds they
+        should wait before trying again. Legacy clients get a bare
+        b"busy".
+        """
+
+        self.log.info("Server busy, client rejected.")
+        if self.framed:
+            yield self.frame(protocol.BUSY, protocol.encode({
+                "retry_after": int(self.server.retry_after * 1000)}))
+        else:
+            yield SEND, b"busy"
+
+    def execute(self, msg):
+        """Executes operations requested by the client.
+
+        The time the command takes, including the transfer, is recorded
+        in the server metrics.
+
+        Args:
+            msg: The client message command string.
+        """
+
+        # The binary signature of a --delta command isn't shown.
+        command = msg.partition(b"\n")[0]
+        name = command.partition(b" ")[0].decode("ascii", "replace")
+        if name not in COMMANDS:
+            name = "unknown"
+        self.log = self.__log.bind(command=name)
+        self.log.debug("Command received: %s", command)
+        start = time.perf_counter()
+        try:
+            yield from self._execute(msg)
+        finally:
+            self.server.metrics.observe(name, time.perf_counter() - start)
+
+    def _execute(self, msg):
+        """Generates the actions of a client command."""
+
+        if msg == b"--raw-available":
+            yield from self._send_available()
+        elif msg == b"--manifest" and self.framed:
+            yield from self._send_manifest()
+        elif msg == b"--stats" and self.framed:
+            yield from self._send_stats()
+        elif msg.startswith(b"--query") and self.framed:
+            try:
+                query = CommandProcessor.get_query(msg)
+            except ValueError:
+                self.log.warning("Bad client parameter.")
+                yield from self.error(b"bad-parameter")
+            else:
+                yield from self._send_query(query)
+        elif msg.startswith(b"--changes") and self.framed:
+            try:
+                epoch, version = CommandProcessor.get_version(msg)
+            except ValueError:
+                self.log.warning("Bad client parameter.")
+                yield from self.error(b"bad-parameter")
+            else:
+                yield from self._send_changes(epoch, version)
+        elif msg.startswith(b"--watch") and self.framed:
+            try:
+                epoch, version = CommandProcessor.get_version(msg)
+            except ValueError:
+                self.log.warning("Bad client parameter.")
+                yield from self.error(b"bad-parameter")
+            else:
+                yield from self._watch(epoch, version)
+        elif msg.startswith(b"--delta") and self.framed:
+            try:
+                arguments = CommandProcessor.get_delta(msg)
+            except (ValueError, UnicodeDecodeError):
+                self.log.warning("Bad client parameter.")
+                yield from self.error(b"bad-parameter")
+            else:
+                yield from self._transfer(self._send_delta(*arguments))
+        elif msg.startswith(b"--copy-many") and self.framed:
+            try:
+                track_ids = CommandProcessor.get_batch(msg)
+            except ValueError:
+                self.log.warning("Bad client parameter.")
+                yield from self.error(b"bad-parameter")
+            else:
+                yield from self._transfer(self._send_music_files(track_ids))
+        elif b"--copy" in msg:
+            try:
+                option = CommandProcessor.get_option(msg)
+                offset, length = CommandProcessor.get_range(msg)
+            except ValueError:
+                self.log.warning("Bad client parameter.")
+                yield from self.error(b"bad-parameter")
+            else:
+                self.log.debug("Requested option: %s", option)
+                yield from self._transfer(
+                    self._send_music_file(option + 1, offset, length))
+            if not self.framed:
+                # Legacy clients read the music until the connection is
+                # closed.
+                yield (CLOSE,)
+        elif self.framed:
+            yield from self.error(b"bad-parameter")
+
+    def _transfer(self, actions):
+        """Performs the actions of a transfer in one of the server
+        transfer slots. A busy answer is sent instead when every slot is
+        taken.
+
+        Args:
+            actions: The actions of the transfer command.
+        """
+
+        if not self.server.start_transfer():
+            yield from self.busy()
+            return
+        try:
+            yield from actions
+        finally:
+            self.server.end_transfer()
+
+    def _send_music_file(self, code: int, offset: int = 0,
+                         length: int = None):
+        """Sends the music file, or a byte range of it, to the client.
+
+        Framed clients receive a REPLY with the music name, the file
+        size, its content hash, the range being sent and the codec it's
+        compressed with, followed by a FILE frame with the range data,
+        or by the FILE frames of the compressed blocks. Legacy clients
+        receive the bare name and then the data until the connection is
+        closed.
+
+        Args:
+            code: The track ID of the choosen music, or its one-based
+                  catalog position for legacy clients.
+            offset: The first byte of the range to be sent.
+            length: The number of bytes to be sent. None sends the rest
+                    of the file.
+        """
+
+        try:
+            music_name, music_file = yield CALL, functools.partial(
+                self._open_track, code)
+        except OSError:
+            music_file = None
+        if music_file is None:
+            yield from self.error(b"not-available")
+            return
+        with music_file:
+            size = os.fstat(music_file.fileno()).st_size
+            offset = min(offset, size)
+            count = size - offset
+            if length is not None:
+                count = min(length, count)
+            encoding = None
+            if self.framed:
+                digest = None
+                if length is None:
+                    # The ranges of a segmented download are checked
+                    # against the manifest hash by the client, and they
+                    # are sent as they are.
+                    digest = yield from self._digest(music_name, size)
+                    encoding = yield from self._encoding(
+                        music_name, music_file, offset, count)
+                yield self.frame(protocol.REPLY, protocol.encode({
+                    "name": music_name, "size": size, "offset": offset,
+                    "length": count, "hash": digest,
+                    "encoding": encoding}))
+            else:
+                yield SEND, music_name.encode("utf8")
+                # Legacy clients expect the name alone in one recv().
+                yield SLEEP, 0.2
+            self.log.debug("Sending %s", music_name)
+            try:
+                if encoding is not None:
+                    yield from self._send_compressed(music_file, offset,
+                                                     count, encoding)
+                else:
+                    if self.framed:
+                        yield SEND, protocol.pack_header(protocol.FILE,
+                                                         count)
+                    if count:
+                        yield from self._send_range(music_file, offset,
+                                                    count)
+            except BrokenPipeError:
+                self.log.warning("Sending %s has failed.", music_name)
+            else:
+                self.log.debug("%s sent.", music_name)
+
+    def _send_music_files(self, track_ids: [int]):
+        """Streams many music files to the client as a single answer.
+
+        Every music is sent as a REPLY with its track ID, name, size,
+        content hash and the codec it's compressed with, followed by a
+        FILE frame with the whole file, or by the FILE frames of the
+        compressed blocks. A
+        music that isn't available gets a REPLY with a None name and no
+        FILE frame, so the client always receives one entry per track
+        ID, in the requested order.
+
+        Args:
+            track_ids: The track IDs of the choosen musics.
+        """
+
+        self.log.debug("Sending %d musics", len(track_ids))
+        for track_id in track_ids:
+            try:
+                music_name, music_file = yield CALL, functools.partial(
+                    self._open_track, track_id)
+            except OSError:
+                music_file = None
+            if music_file is None:
+                yield self.frame(protocol.REPLY, protocol.encode({
+                    "id": track_id, "name": None}))
+                continue
+            with music_file:
+                size = os.fstat(music_file.fileno()).st_size
+                digest = yield from self._digest(music_name, size)
+                encoding = yield from self._encoding(music_name,
+                                                     music_file, 0, size)
+                yield self.frame(protocol.REPLY, protocol.encode({
+                    "id": track_id, "name": music_name, "size": size,
+                    "hash": digest, "encoding": encoding}))
+                try:
+                    if encoding is not None:
+                        yield from self._send_compressed(music_file, 0,
+                                                         size, encoding)
+                        continue
+                    yield SEND, protocol.pack_header(protocol.FILE, size)
+                    if size:
+                        yield from self._send_range(music_file, 0, size)
+                except BrokenPipeError:
+                    self.log.warning("Sending %s has failed.", music_name)
+                    return
+        self.log.debug("%d musics sent.", len(track_ids))
+
+    def _send_delta(self, track_id: int, block: int, client_size: int,
+                    signatures: [(int, bytes)]):
+        """Sends the delta that turns the client copy of a music into
+        the server one.
+
+        The answer is a REPLY with the music name, size and content hash
+        and the delta operations, followed by a FILE frame with the
+        literal bytes of the DATA operations, in order. When the copies
+        are too different the delta is a single DATA operation, so the
+        music is still sent in the same round trip.
+
+        Args:
+            track_id: The track ID of the choosen music.
+            block: The block size of the signature.
+            client_size: The size of the client copy.
+            signatures: The (weak, strong) tuples of the client blocks.
+        """
+
+        try:
+            music_name, music_file = yield CALL, functools.partial(
+                self._open_track, track_id)
+        except OSError:
+            music_file = None
+        if music_file is None:
+            yield from self.error(b"not-available")
+            return
+        with music_file:
+            size = os.fstat(music_file.fileno()).st_size
+            digest = yield from self._digest(music_name, size)
+            try:
+                operations, literal = yield CALL, functools.partial(
+                    delta.delta, music_file, size, signatures, block,
+                    client_size, int(size * MAX_LITERAL))
+            except (OSError, ValueError, IndexError):
+                # The music was truncated while it was read.
+                yield from self.error(b"not-available")
+                return
+            yield self.frame(protocol.REPLY, protocol.encode({
+                "id": track_id, "name": music_name, "size": size,
+                "hash": digest, "operations": operations}))
+            self.log.debug("Sending %d of %d bytes of %s", literal, size,
+                           music_name)
+            try:
+                yield SEND, protocol.pack_header(protocol.FILE, literal)
+                for operation, offset, length in operations:
+                    if operation == delta.DATA:
+                        yield from self._send_range(music_file, offset,
+                                                    length)
+            except BrokenPipeError:
+                self.log.warning("Sending %s has failed.", music_name)
+            else:
+                self.log.debug("%s sent.", music_name)
+
+    def _open_track(self, code: int) -> (str, object):
+        """Looks a music up in the catalog and opens it. Looking it up
+        may refresh the catalog, which reads the library directories, so
+        it's performed as a CALL, like opening the music.
+
+        Args:
+            code: The track ID of the music, or its one-based catalog
+                  position for legacy clients.
+
+        Returns:
+            A tuple with the music name and the music file object, or
+            with two Nones when the catalog has no such music.
+
+        Raises:
+            OSError: When the music can't be opened.
+        """
+
+        try:
+            if self.framed:
+                music_name = self.server.catalog.track(code)
+            else:
+                music_name = self.server.catalog.get(code - 1)
+        except IndexError:
+            return None, None
+        return music_name, self.server.open_music(music_name)
+
+    def _digest(self, music_name: str, size: int):
+        """Gets the content hash of a music from the library index, so
+        it's only computed again when the music changes.
+
+        Args:
+            music_name: The music name.
+            size: The size of the opened music.
+
+        Returns:
+            The hexadecimal digest, or None when it's unknown.
+        """
+
+        try:
+            entry = yield CALL, functools.partial(self.server.library.entry,
+                                                  music_name)
+        except OSError:
+            return None
+        # The hash is only known when the music didn't change after it
+        # was opened.
+        return entry["hash"] if entry["size"] == size else None
+
+    def _send_range(self, music_file, offset: int, count: int):
+        """Sends a byte range of a music file.
+
+        When the server has bandwidth limits, the range is sent in
+        chunks and every chunk waits for its reservation in the client
+        bucket and then in the total one.
+
+        Args:
+            music_file: The music file object.
+            offset: The first byte of the range.
+            count: The number of bytes of the range.
+        """
+
+        shaper = self.server.shaper
+        if shaper is None:
+            # The first bytes only fill the socket buffer, the link rate
+            # is measured on the rest.
+            first = min(count, compression.LINK_SAMPLE)
+            yield SENDFILE, music_file, offset, first
+            start = time.perf_counter()
+            if count > first:
+                yield SENDFILE, music_file, offset + first, count - first
+            self.server.metrics.add_bytes(count)
+            self._observe_link(count - first, time.perf_counter() - start)
+            return
+        buckets = shaper.buckets(self.client_address[0])
+        sent, measured, seconds = 0, 0, 0.0
+        while count:
+            size = min(count, shaper.chunk_size)
+            for bucket in buckets:
+                delay = bucket.reserve(size)
+                if delay:
+                    yield SLEEP, delay
+            start = time.perf_counter()
+            yield SENDFILE, music_file, offset, size
+            if sent >= compression.LINK_SAMPLE:
+                measured += size
+                seconds += time.perf_counter() - start
+            self.server.metrics.add_bytes(size)
+            sent += size
+            offset += size
+            count -= size
+        self._observe_link(measured, seconds)
+
+    def _encoding(self, music_name: str, music_file, offset: int,
+                  count: int):
+        """Picks the codec a transfer is compressed with, when the client
+        supports compression and it makes the transfer faster.
+
+        Args:
+            music_name: The music name.
+            music_file: The music file object.
+            offset: The first byte to be sent.
+            count: The number of bytes to be sent.
+
+        Returns:
+            The codec name, or None when the data is sent as it is.
+        """
+
+        compressor = self.server.compressor
+        host = self.client_address[0]
+        if compressor is None or not self.codecs \
+                or not compressor.compressible(music_name, count, host):
+            return None
+        try:
+            encoding = yield CALL, functools.partial(
+                compressor.choose, music_file, offset, count, host,
+                self.codecs)
+        except OSError:
+            return None
+        if encoding is not None:
+            self.log.debug("Compressing %s with %s", music_name, encoding)
+        return encoding
+
+    def _send_compressed(self, music_file, offset: int, count: int,
+                         encoding: str):
+        """Sends a byte range of a music file compressed.
+
+        The blocks are compressed by the server compressor pool while
+        the previous ones are sent. Every block is sent as a FILE frame,
+        and an empty FILE frame ends the range. Like _send_range(), every
+        block waits for its reservation when the bandwidth is limited.
+
+        Args:
+            music_file: The music file object.
+            offset: The first byte of the range.
+            count: The number of bytes of the range.
+            encoding: The codec name.
+        """
+
+        shaper = self.server.shaper
+        buckets = []
+        if shaper is not None:
+            buckets = shaper.buckets(self.client_address[0])
+        sent, measured, seconds = 0, 0, 0.0
+        for block in self.server.compressor.blocks(music_file, offset,
+                                                   count, encoding):
+            data = yield CALL, block.result
+            for bucket in buckets:
+                delay = bucket.reserve(len(data))
+                if delay:
+                    yield SLEEP, delay
+            start = time.perf_counter()
+            yield SEND, protocol.pack_header(protocol.FILE, len(data)) + data
+            if sent >= compression.LINK_SAMPLE:
+                measured += len(data)
+                seconds += time.perf_counter() - start
+            self.server.metrics.add_bytes(len(data))
+            sent += len(data)
+        yield SEND, protocol.pack_header(protocol.FILE, 0)
+        self._observe_link(measured, seconds)
+
+    def _observe_link(self, count: int, seconds: float) -> None:
+        """Records how long sending count bytes to the client has
+        blocked, which tells the compressor how fast the link is. The
+        bytes that only filled the socket buffer must be left out."""
+
+        if self.server.compressor is not None:
+            self.server.compressor.observe_link(self.client_address[0],
+                                                count, seconds)
+
+    def _send_stats(self):
+        """Sends the server counters and metrics as a REPLY.
+
+        With many workers, they are the ones of the worker serving the
+        connection, identified by its process ID.
+        """
+
+        stats = self.server.stats()
+        stats["pid"] = os.getpid()
+        yield self.frame(protocol.REPLY, protocol.encode(stats))
+
+    def _send_available(self):
+        """Sends all the available music on the server directory."""
+
+        self.log.debug("Sending raw string available music list")
+        if self.framed:
+            # Framed clients get the track IDs along with the names.
+            tracks = yield CALL, self.server.catalog.entries
+            yield self.frame(protocol.REPLY, protocol.encode(list(tracks)))
+            self.log.debug("Raw string available music list sent")
+            return
+        available_musics = yield CALL, self._get_available
+        if available_musics:
+            yield SEND, "|".join(available_musics).encode()
+            self.log.debug("Raw string available music list sent")
+            # Legacy clients expect the sentinel alone in one recv().
+            yield SLEEP, 0.1
+            yield SEND, b"end"
+        else:
+            yield SEND, b"not-available"
+
+    def _send_query(self, query: dict):
+        """Sends a page of the musics matching a query.
+
+        The answer is a REPLY with the number of matching musics and the
+        track IDs and names of the page.
+
+        Args:
+            query: The keyword arguments of MusicCatalog.query().
+        """
+
+        self.log.debug("Sending query %s", query)
+        total, tracks = yield CALL, functools.partial(
+            self.server.catalog.query, **query)
+        yield self.frame(protocol.REPLY, protocol.encode({
+            "total": total, "offset": query["offset"], "tracks": tracks}))
+
+    def _send_manifest(self):
+        """Sends the manifest of the available musics.
+
+        The manifest is a list with the track ID, name, size, mtime and
+        content hash of every music, in catalog order. Hashes are stored
+        in the library index, so only new or changed musics are read.
+        """
+
+        self.log.debug("Sending manifest")
+        manifest = yield CALL, self._build_manifest
+        yield self.frame(protocol.REPLY, protocol.encode(manifest))
+
+    def _watch(self, epoch: str, since: int):
+        """Pushes the catalog changes to the client until it disconnects.
+
+        The changes since the given version are sent right away as an
+        EVENT frame with the same payload as a --changes answer. Then a
+        new EVENT is pushed whenever the catalog version changes, and a
+        HEARTBEAT frame is sent when nothing changes for a heartbeat
+        interval. The connection is closed when the server stops.
+
+        Args:
+            epoch: The epoch of the version the client has seen.
+            since: The catalog version the client has seen.
+        """
+
+        self.log.debug("Watching the catalog")
+        version = yield from self._send_changes(epoch, since, protocol.EVENT)
+        while True:
+            changed = yield WAIT, version, self.server.heartbeat
+            if changed is None:
+                yield (CLOSE,)
+                return
+            if changed:
+                version = yield from self._send_changes(
+                    self.server.library.epoch, version, protocol.EVENT)
+            else:
+                yield self.frame(protocol.HEARTBEAT)
+
+    def _send_changes(self, epoch: str, since: int,
+                      frame_type: int = protocol.REPLY):
+        """Sends the manifest entries of the musics changed after a
+        catalog version.
+
+        The answer is a REPLY with the epoch and the current version of
+        the catalog and the list of changes. A removed music has a None
+        name. When the changes aren't known, because the version is 0,
+        too old or from another epoch, the whole manifest is sent and
+        "reset" is true.
+
+        Args:
+            epoch: The epoch of the version the client has seen.
+            since: The catalog version the client has seen.
+            frame_type: The type of the answer frame.
+
+        Returns:
+            The catalog version that was sent.
+        """
+
+        library = self.server.library
+        version, changed = yield CALL, functools.partial(self._changes,
+                                                         since)
+        if epoch != library.epoch or changed is None:
+            self.log.debug("Sending manifest")
+            manifest = yield CALL, self._build_manifest
+            reset = True
+        else:
+            self.log.debug("Sending %d changes since version %d",
+                           len(changed), since)
+            manifest = yield CALL, functools.partial(self._build_manifest,
+                                                     changed)
+            reset = False
+        yield self.frame(frame_type, protocol.encode({
+            "epoch": library.epoch, "version": version, "reset": reset,
+            "changes": manifest}))
+        return version
+
+    def _changes(self, since: int) -> (int, list):
+        """Refreshes the catalog and gets the musics changed after a
+        catalog version from the library index. It reads the library
+        and queries the index, so it's performed as a CALL.
+
+        Returns:
+            The tuple of LibraryIndex.changes().
+        """
+
+        self.server.catalog.refresh()
+        return self.server.library.changes(since)
+
+    def _build_manifest(self, tracks=None) -> list:
+        """Builds the manifest of the available musics. It may need to
+        hash new musics, so it can block for a long time.
+
+        Args:
+            tracks: The (track ID, music name) tuples of the manifest.
+                    The whole catalog is used when it's None. Tracks
+                    with a None name get an entry with a None name.
+        """
+
+        library = self.server.library
+        manifest = []
+        if tracks is None:
+            tracks = self.server.catalog.entries()
+        for track_id, name in tracks:
+            if name is None:
+                manifest.append({"id": track_id, "name": None})
+                continue
+            try:
+                entry = library.entry(name)
+            except OSError:
+                # The music was removed after the catalog was refreshed.
+                entry = {"name": name, "size": None, "mtime": None,
+                         "hash": None}
+            entry["id"] = track_id
+            manifest.append(entry)
+        return manifest
+
+    def _get_available(self) -> tuple:
+        """Get all the available musics from the server catalog."""
+
+        return self.server.catalog.names()
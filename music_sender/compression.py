@@ -0,0 +1,427 @@
+"""Adaptive compression of the music data.
+
+Compressed formats, like MP3, OGG or FLAC, don't shrink any more, but
+raw PCM, like WAV, PCM and AIFF musics, often does by a fourth or more.
+A client offers the codecs it supports in its HELLO and the server
+decides, for every raw PCM music, whether to compress it: a sample of
+the music is compressed first, and the music is only compressed when
+the sample shrinks and the codec is faster than the link to the client,
+which is measured on every transfer. On a fast link, like a LAN,
+compressing would only slow the transfer down.
+
+A music is compressed in independent blocks by a thread pool, a few
+blocks ahead of the one being sent, so the handler threads and the
+event loop never wait for the compressor. zlib and lzma release the
+GIL, so the blocks are compressed in parallel. Every block is sent as a
+FILE frame and an empty FILE frame ends the music, so the client
+decompresses the blocks as they arrive.
+
+The codecs are zlib and lzma, from the standard library, and zstd when
+the zstandard package is installed.
+"""
+
+import collections
+import concurrent.futures
+import lzma
+import os
+import threading
+import time
+import zlib
+
+from .protocol import ProtocolError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Extensions of the raw PCM formats, the only ones worth compressing
+COMPRESSIBLE = (".wav", ".pcm", ".aiff")
+# Uncompressed size of a block, the most bytes a block may decompress to
+BLOCK_SIZE = 512 * 1024
+# Blocks of a transfer being compressed ahead of the one being sent
+PIPELINE = 4
+# Bytes of a music compressed to estimate its ratio
+SAMPLE_SIZE = 64 * 1024
+# Musics smaller than this are always sent as they are
+MIN_SIZE = 1024 * 1024
+# Bytes a transfer sends before its rate is measured, since they only
+# fill the socket buffer, and the fewest bytes the rate is measured on
+LINK_SAMPLE = 1024 * 1024
+# A compressed transfer must take at most this share of the time of the
+# plain one
+MIN_GAIN = 0.9
+# Weight of a new measure in the averages
+WEIGHT = 0.3
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 3
+# The delta filter subtracts the previous sample of the same channel of
+# a 16 bit stereo PCM, which lzma compresses much better than the
+# samples themselves.
+LZMA_FILTERS = [{"id": lzma.FILTER_DELTA, "dist": 4},
+                {"id": lzma.FILTER_LZMA2, "preset": 0}]
+
+
+def _compress_zstd(data: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def _compress_lzma(data: bytes) -> bytes:
+    return lzma.compress(data, lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+
+
+def _compress_zlib(data: bytes) -> bytes:
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+# Block compressors by codec name, the preferred ones first
+COMPRESSORS = {"lzma": _compress_lzma, "zlib": _compress_zlib}
+if zstandard is not None:
+    COMPRESSORS = {"zstd": _compress_zstd, **COMPRESSORS}
+
+
+def available() -> [str]:
+    """Returns the names of the codecs this Python supports, the
+    preferred ones first."""
+
+    return list(COMPRESSORS)
+
+
+class _BlockSink:
+    """The file a zstd block is decompressed into. It refuses to hold
+    more than limit bytes, which stops the decompression."""
+
+    def __init__(self) -> None:
+        self.limit = 0
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        if self.size > self.limit:
+            raise ProtocolError("Too large zstd block.")
+        self.chunks.append(bytes(data))
+        return len(data)
+
+
+class BlockDecoder:
+    """Decompresses a compressed block as its bytes arrive.
+
+    Attributes:
+        codec: The codec name.
+        block_size: The most bytes the block may decompress to.
+
+    Methods:
+        decode(data, limit): Decompresses the next bytes of the block.
+    """
+
+    def __init__(self, codec: str, block_size: int = BLOCK_SIZE) -> None:
+        """Initializes the decoder of a new block.
+
+        Args:
+            codec: The codec name, one of available().
+            block_size: The most bytes the block may decompress to.
+
+        Raises:
+            ValueError: When the codec isn't supported.
+        """
+
+        if codec not in COMPRESSORS:
+            raise ValueError(f"Unsupported codec {codec}.")
+        self.codec = codec
+        self.block_size = block_size
+        self.__decoded = 0
+        if codec == "zstd":
+            # The decompressor object of zstd has no output limit, the
+            # stream writer stops as soon as the sink is full.
+            self.__sink = _BlockSink()
+            self.__decoder = zstandard.ZstdDecompressor().stream_writer(
+                self.__sink, write_size=64 * 1024)
+        elif codec == "lzma":
+            self.__decoder = lzma.LZMADecompressor(lzma.FORMAT_RAW,
+                                                   filters=LZMA_FILTERS)
+        else:
+            self.__decoder = zlib.decompressobj()
+
+    def decode(self, data: bytes, limit: int) -> bytes:
+        """Decompresses the next bytes of the block. The decompressed
+        bytes are bounded, so a hostile block can't fill the memory.
+
+        Args:
+            data: The compressed bytes.
+            limit: The most bytes the music may still have.
+
+        Returns:
+            The decompressed bytes.
+
+        Raises:
+            ValueError: When the block is corrupt.
+            ProtocolError: When the block decompresses to more than
+                           block_size or limit bytes.
+        """
+
+        limit = min(limit, self.block_size - self.__decoded)
+        try:
+            if self.codec == "zstd":
+                self.__sink.limit = limit
+                self.__sink.size = 0
+                self.__decoder.write(data)
+                decoded = b"".join(self.__sink.chunks)
+                self.__sink.chunks.clear()
+            else:
+                decoded = self.__decoder.decompress(data, limit + 1)
+        except (zlib.error, lzma.LZMAError) as error:
+            raise ValueError(f"Corrupt {self.codec} block.") from error
+        except ProtocolError:
+            raise
+        except Exception as error:
+            if zstandard is not None \
+                    and isinstance(error, zstandard.ZstdError):
+                raise ValueError("Corrupt zstd block.") from error
+            raise
+        if len(decoded) > limit:
+            raise ProtocolError(f"Too large {self.codec} block.")
+        self.__decoded += len(decoded)
+        return decoded
+
+
+class Compressor:
+    """Decides which musics are compressed and compresses them on a
+    thread pool.
+
+    Attributes:
+        codecs: The names of the codecs the server may use.
+        workers: The number of compressing threads.
+
+    Methods:
+        compressible(name, count, host): Checks whether a transfer may
+                                         be worth compressing.
+        choose(music_file, offset, count, host, codecs): Picks the codec
+                                                         of a transfer.
+        blocks(music_file, offset, count, codec): Compresses a byte
+                                                  range in blocks.
+        observe_link(host, count, seconds): Records the rate of a
+                                            transfer.
+        link_rate(host): Returns the estimated link rate to a host.
+        stats(): Returns the compression counters.
+        close(): Stops the thread pool.
+    """
+
+    def __init__(self, codecs: [str] = None, workers: int = None,
+                 max_client_rate: float = None) -> None:
+        """Initializes the compressor.
+
+        Args:
+            codecs: The names of the codecs the server may use. Defaults
+                    to available().
+            workers: The number of compressing threads. Defaults to the
+                     number of CPUs, up to PIPELINE.
+            max_client_rate: The upload cap of every client host in
+                             bytes per second, which bounds the link
+                             rate. None means unlimited.
+        """
+
+        self.codecs = [codec for codec in codecs or available()
+                       if codec in COMPRESSORS]
+        self.workers = workers or min(PIPELINE, os.cpu_count() or 1)
+        self.__max_client_rate = max_client_rate
+        self.__pool = concurrent.futures.ThreadPoolExecutor(
+            self.workers, thread_name_prefix="compressor")
+        # Uncompressed bytes per second of a thread, by codec
+        self.__speeds = {}
+        # Bytes and seconds of the last transfers, by client host
+        self.__links = {}
+        self.__musics = 0
+        self.__bytes_in = 0
+        self.__bytes_out = 0
+        self.__lock = threading.Lock()
+
+    def compressible(self, name: str, count: int, host: str) -> bool:
+        """Checks whether a transfer may be worth compressing, without
+        reading the music.
+
+        Args:
+            name: The music name.
+            count: The number of bytes to be sent.
+            host: The client host.
+
+        Returns:
+            True when the music is a large enough raw PCM and the link
+            rate to the client is known.
+        """
+
+        return name.lower().endswith(COMPRESSIBLE) and count >= MIN_SIZE \
+            and self.link_rate(host) is not None
+
+    def choose(self, music_file, offset: int, count: int, host: str,
+               codecs: [str]) -> str:
+        """Picks the codec of a transfer. It compresses a sample of the
+        music, so it blocks for a few milliseconds.
+
+        Every codec the client supports is compared to sending the music
+        as it is. A compressed transfer takes as long as the slowest of
+        the compressor, with PIPELINE blocks in parallel, and the link,
+        with the compressed bytes.
+
+        Args:
+            music_file: The music file object.
+            offset: The first byte to be sent.
+            count: The number of bytes to be sent.
+            host: The client host.
+            codecs: The codecs the client supports.
+
+        Returns:
+            The codec name, or None when the music is sent as it is.
+        """
+
+        link = self.link_rate(host)
+        if link is None:
+            return None
+        parallel = min(PIPELINE, self.workers)
+        best, best_time = None, count / link * MIN_GAIN
+        sample = None
+        for codec in codecs:
+            if codec not in self.codecs:
+                continue
+            speed = self.__speeds.get(codec)
+            if speed is not None and count / (speed * parallel) >= best_time:
+                # The codec is known to be slower than the link.
+                continue
+            if sample is None:
+                size = min(SAMPLE_SIZE, count)
+                sample = os.pread(music_file.fileno(), size,
+                                  offset + (count - size) // 2)
+                if not sample:
+                    return None
+            start = time.perf_counter()
+            ratio = len(COMPRESSORS[codec](sample)) / len(sample)
+            speed = self.__observe_speed(codec, len(sample),
+                                         time.perf_counter() - start)
+            seconds = max(count / (speed * parallel), count * ratio / link)
+            if seconds < best_time:
+                best, best_time = codec, seconds
+        if best is not None:
+            with self.__lock:
+                self.__musics += 1
+        return best
+
+    def blocks(self, music_file, offset: int, count: int, codec: str):
+        """Compresses a byte range of a music in blocks on the thread
+        pool, PIPELINE blocks ahead of the one being consumed.
+
+        Args:
+            music_file: The music file object. It must stay open until
+                        the blocks are consumed.
+            offset: The first byte of the range.
+            count: The number of bytes of the range.
+            codec: The codec name.
+
+        Yields:
+            A Future of the compressed bytes of every block, in order.
+            It raises OSError when the music can't be read.
+        """
+
+        fd = music_file.fileno()
+        end = offset + count
+        pending = collections.deque()
+        try:
+            while offset < end or pending:
+                while offset < end and len(pending) < PIPELINE:
+                    size = min(BLOCK_SIZE, end - offset)
+                    pending.append(self.__pool.submit(
+                        self.__compress_block, codec, fd, offset, size))
+                    offset += size
+                yield pending.popleft()
+        finally:
+            # The transfer was abandoned, like when the client has gone
+            # away.
+            for future in pending:
+                future.cancel()
+
+    def __compress_block(self, codec: str, fd: int, offset: int,
+                         size: int) -> bytes:
+        """Reads and compresses a block. It runs on the thread pool."""
+
+        data = os.pread(fd, size, offset)
+        start = time.perf_counter()
+        compressed = COMPRESSORS[codec](data)
+        self.__observe_speed(codec, len(data), time.perf_counter() - start)
+        with self.__lock:
+            self.__bytes_in += len(data)
+            self.__bytes_out += len(compressed)
+        return compressed
+
+    def __observe_speed(self, codec: str, count: int,
+                        seconds: float) -> float:
+        """Records how fast a codec has compressed count bytes.
+
+        Returns:
+            The average speed of the codec.
+        """
+
+        speed = count / max(seconds, 1e-6)
+        with self.__lock:
+            previous = self.__speeds.get(codec)
+            if previous is not None:
+                speed = previous + WEIGHT * (speed - previous)
+            self.__speeds[codec] = speed
+        return speed
+
+    def observe_link(self, host: str, count: int, seconds: float) -> None:
+        """Records the rate of a transfer to a host.
+
+        Args:
+            host: The client host.
+            count: The number of bytes sent.
+            seconds: How long the sends blocked, without the waits for
+                     the compressor or the bandwidth shaper.
+        """
+
+        if count < LINK_SAMPLE:
+            return
+        with self.__lock:
+            link = self.__links.get(host)
+            if link is None:
+                if len(self.__links) > 1024:
+                    # Forget the clients, they are measured again.
+                    self.__links.clear()
+                link = self.__links[host] = [0, 0.0]
+            # The rate is averaged over the time, so a transfer that
+            # only filled the socket buffer barely counts.
+            link[0] = link[0] * (1 - WEIGHT) + count
+            link[1] = link[1] * (1 - WEIGHT) + seconds
+
+    def link_rate(self, host: str) -> float:
+        """Returns the estimated link rate to a host in bytes per
+        second, or None when it isn't known yet.
+
+        It's the average rate of the last transfers to the host, capped
+        by the upload cap of a client.
+        """
+
+        rate = None
+        with self.__lock:
+            link = self.__links.get(host)
+            if link is not None:
+                rate = link[0] / max(link[1], 1e-6)
+        if self.__max_client_rate:
+            rate = min(rate or self.__max_client_rate,
+                       self.__max_client_rate)
+        return rate
+
+    def stats(self) -> dict:
+        """Returns the compression counters.
+
+        Returns:
+            A dict with the number of compressed musics and the bytes
+            before and after being compressed.
+        """
+
+        with self.__lock:
+            return {"musics": self.__musics, "bytes_in": self.__bytes_in,
+                    "bytes_out": self.__bytes_out}
+
+    def close(self) -> None:
+        """Stops the thread pool, without waiting for it."""
+
+        self.__pool.shutdown(wait=False, cancel_futures=True)
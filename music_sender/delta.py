@@ -0,0 +1,200 @@
+"""Delta transfer of modified musics.
+
+This module implements an rsync-like delta algorithm. The client splits
+its outdated copy of a music in blocks and sends the signature of every
+block: a weak rolling checksum and a strong hash. The server slides a
+window over its own copy looking for blocks the client already has, and
+answers with a list of operations that rebuild the new music from the
+client blocks and the literal bytes that aren't found on the client.
+
+Retagging a music only changes a few KB at its start or end, so almost
+every block is found and the transfer is a small fraction of the file.
+
+The weak checksum is the one used by rsync. For a block x of n bytes:
+
+    a = (x[0] + ... + x[n - 1]) mod 2 ** 16
+    b = (n * x[0] + (n - 1) * x[1] + ... + 1 * x[n - 1]) mod 2 ** 16
+
+It can be rolled one byte forward in constant time, so every offset of
+the server file is tested without hashing every window.
+"""
+
+import hashlib
+import itertools
+import math
+import mmap
+import struct
+
+# Operations
+COPY = 0
+DATA = 1
+
+MIN_BLOCK = 2 * 1024
+MAX_BLOCK = 128 * 1024
+# Most blocks of a signature, as many as block_size() gives a 16 GiB
+# file. It bounds the table the server builds from a signature.
+MAX_BLOCKS = 128 * 1024
+# Musics smaller than this are copied whole
+MIN_SIZE = 64 * 1024
+# Weak checksum and strong hash of a block
+SIGNATURE = struct.Struct("!I16s")
+
+
+def block_size(size: int) -> int:
+    """Returns the block size used for a file.
+
+    Like rsync, the block size grows with the square root of the file
+    size, so the signature stays small for large files while a change
+    still costs a small block. It's a multiple of 1 KiB.
+
+    Args:
+        size: The file size in bytes.
+
+    Returns:
+        The block size in bytes.
+    """
+
+    size = -(-int(math.sqrt(size)) // 1024) * 1024
+    return max(MIN_BLOCK, min(MAX_BLOCK, size))
+
+
+def weak_checksum(block) -> (int, int):
+    """Computes the weak checksum of a block.
+
+    Args:
+        block: The block bytes.
+
+    Returns:
+        A tuple with the a and b halves of the checksum.
+    """
+
+    return sum(block) & 0xffff, sum(itertools.accumulate(block)) & 0xffff
+
+
+def strong_hash(block) -> bytes:
+    """Computes the strong hash of a block."""
+
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def signature(file, size: int, block: int) -> bytes:
+    """Computes the signature of a file.
+
+    Args:
+        file: A file object opened in binary mode.
+        size: The file size.
+        block: The block size.
+
+    Returns:
+        The SIGNATURE of every block, concatenated. The last block may
+        be shorter than the block size.
+    """
+
+    signatures = bytearray()
+    file.seek(0)
+    for _ in range(-(-size // block)):
+        data = file.read(block)
+        a, b = weak_checksum(data)
+        signatures += SIGNATURE.pack(b << 16 | a, strong_hash(data))
+    return bytes(signatures)
+
+
+def parse_signature(data: bytes) -> [(int, bytes)]:
+    """Parses a signature into a list of (weak, strong) tuples.
+
+    Raises:
+        ValueError: When the signature is malformed.
+    """
+
+    if len(data) % SIGNATURE.size:
+        raise ValueError("Bad signature.")
+    return list(SIGNATURE.iter_unpack(data))
+
+
+def delta(file, size: int, signatures: [(int, bytes)], block: int,
+          client_size: int, max_literal: int = None) -> ([list], int):
+    """Computes the operations that rebuild a file from the blocks of
+    another version of it.
+
+    The operations are lists like [COPY, first block, count], which
+    copy count consecutive blocks of the client file, and [DATA, offset,
+    length], which take length bytes of this file from offset on.
+
+    Args:
+        file: The new version, a file object opened in binary mode.
+        size: The size of the new version.
+        signatures: The (weak, strong) tuples of the client blocks.
+        block: The block size of the signatures.
+        client_size: The size of the client version.
+        max_literal: When more literal bytes than this are needed, the
+                     search stops and the whole file is sent as a single
+                     DATA operation. None never stops.
+
+    Returns:
+        A tuple with the operations and the number of literal bytes.
+    """
+
+    table = {}
+    tail = None
+    for index, (weak, strong) in enumerate(signatures):
+        if (index + 1) * block > client_size:
+            # The last block is shorter, it can only match the end.
+            tail = index, client_size - index * block, strong
+        else:
+            table.setdefault(weak, {}).setdefault(strong, index)
+    if not size:
+        return [], 0
+    if not table and tail is None:
+        return [[DATA, 0, size]], size
+    operations = []
+    literal = 0
+
+    def add_data(start, end):
+        nonlocal literal
+        if end > start:
+            operations.append([DATA, start, end - start])
+            literal += end - start
+
+    def add_copy(index):
+        last = operations[-1] if operations else None
+        if last and last[0] == COPY and last[1] + last[2] == index:
+            last[2] += 1
+        else:
+            operations.append([COPY, index, 1])
+
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        position = 0
+        start = 0
+        a, b = weak_checksum(view[0:block]) if size >= block else (0, 0)
+        while position + block <= size:
+            candidates = table.get(b << 16 | a)
+            if candidates is not None:
+                index = candidates.get(
+                    strong_hash(view[position:position + block]))
+                if index is not None:
+                    add_data(start, position)
+                    add_copy(index)
+                    position += block
+                    start = position
+                    if position + block <= size:
+                        a, b = weak_checksum(view[position:position + block])
+                    continue
+            if max_literal is not None \
+                    and literal + position - start > max_literal:
+                return [[DATA, 0, size]], size
+            if position + block < size:
+                out, new = view[position], view[position + block]
+                a = (a - out + new) & 0xffff
+                b = (b - block * out + a) & 0xffff
+            position += 1
+        if tail is not None:
+            index, length, strong = tail
+            if size - start >= length \
+                    and strong_hash(view[size - length:size]) == strong:
+                add_data(start, size - length)
+                add_copy(index)
+                start = size
+        add_data(start, size)
+    if max_literal is not None and literal > max_literal:
+        return [[DATA, 0, size]], size
+    return operations, literal
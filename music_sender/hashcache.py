@@ -0,0 +1,175 @@
+"""Content hash cache.
+
+This module computes the content hashes of music files and keeps them
+cached on disk, so a file is only read again after it has changed.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+HASH_NAME = "blake2b"
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Computes the content hash of a file.
+
+    Args:
+        path: The file path.
+        chunk_size: How many bytes are read at once.
+
+    Returns:
+        The hexadecimal digest string.
+    """
+
+    digest = hashlib.new(HASH_NAME)
+    with open(path, "rb") as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashCache:
+    """An on-disk cache of content hashes.
+
+    Every hash is stored with the inode, size and modification time the
+    file had when it was hashed. While these three don't change, the
+    cached hash is returned and the file isn't read.
+
+    Attributes:
+        FILENAME: The default name of the cache file.
+        path: The directory of the hashed files.
+        filename: The cache file path.
+
+    Methods:
+        load(): Loads the cache file.
+        save(): Saves the cache file if it has changed.
+        digest(name): Returns the content hash of a file.
+        store(name, digest): Records the content hash of a file.
+        entry(name): Returns the manifest entry of a file.
+        prune(names): Forgets the files that aren't in names.
+    """
+
+    FILENAME = ".music_sender_hashes.json"
+
+    def __init__(self, path: str = ".", filename: str = FILENAME) -> None:
+        """Initializes an empty cache.
+
+        Args:
+            path: The directory of the hashed files.
+            filename: The cache file name, relative to path.
+        """
+
+        self.path = path
+        self.filename = os.path.join(path, filename)
+        self.__hashes = {}
+        self.__dirty = False
+        self.__lock = threading.Lock()
+
+    def load(self) -> None:
+        """Loads the cache file. A missing or broken file is ignored."""
+
+        try:
+            with open(self.filename) as cache_file:
+                hashes = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        with self.__lock:
+            self.__hashes = hashes
+            self.__dirty = False
+
+    def save(self) -> None:
+        """Saves the cache file if it has changed.
+
+        A read-only directory is ignored, the cache then only lives in
+        memory.
+        """
+
+        with self.__lock:
+            if not self.__dirty:
+                return
+            hashes = dict(self.__hashes)
+            self.__dirty = False
+        temporary = self.filename + ".tmp"
+        try:
+            with open(temporary, "w") as cache_file:
+                json.dump(hashes, cache_file)
+            os.replace(temporary, self.filename)
+        except OSError:
+            pass
+
+    def entry(self, name: str) -> dict:
+        """Returns the manifest entry of a file.
+
+        Args:
+            name: The file name, relative to the cache path.
+
+        Returns:
+            A dict with the name, size, mtime and hash of the file.
+
+        Raises:
+            OSError: When the file can't be read.
+        """
+
+        path = os.path.join(self.path, name)
+        stat = os.stat(path)
+        key = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+        with self.__lock:
+            cached = self.__hashes.get(name)
+        if cached is not None and cached[:3] == key:
+            digest = cached[3]
+        else:
+            digest = hash_file(path)
+            with self.__lock:
+                self.__hashes[name] = key + [digest]
+                self.__dirty = True
+        return {"name": name, "size": stat.st_size, "mtime": stat.st_mtime,
+                "hash": digest}
+
+    def digest(self, name: str) -> str:
+        """Returns the content hash of a file.
+
+        Args:
+            name: The file name, relative to the cache path.
+
+        Returns:
+            The hexadecimal digest string.
+
+        Raises:
+            OSError: When the file can't be read.
+        """
+
+        return self.entry(name)["hash"]
+
+    def store(self, name: str, digest: str) -> None:
+        """Records the content hash of a file that was hashed elsewhere,
+        like while it was downloaded, so it isn't read again.
+
+        Args:
+            name: The file name, relative to the cache path.
+            digest: The hexadecimal digest string.
+
+        Raises:
+            OSError: When the file doesn't exist.
+        """
+
+        stat = os.stat(os.path.join(self.path, name))
+        with self.__lock:
+            self.__hashes[name] = [stat.st_ino, stat.st_size,
+                                   stat.st_mtime_ns, digest]
+            self.__dirty = True
+
+    def prune(self, names) -> None:
+        """Forgets the hashes of the files that aren't in names.
+
+        Args:
+            names: An iterable of the file names still in use.
+        """
+
+        names = set(names)
+        with self.__lock:
+            for name in list(self.__hashes):
+                if name not in names:
+                    del self.__hashes[name]
+                    self.__dirty = True
@@ -0,0 +1,192 @@
+"""Hot track cache.
+
+This module keeps local copies of the musics that were requested last,
+so a music that many clients download at once, like a new album, is only
+read once from a slow music directory, like a network filesystem. The
+copies are plain files, so they are sent with sendfile() like the
+musics themselves.
+"""
+
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+
+class HotCache:
+    """A size bounded LRU cache of local music copies.
+
+    A copy is valid while the music keeps the size and modification time
+    it had when it was copied. Concurrent requests for a music that
+    isn't cached are coalesced: the first one copies the music and the
+    others wait for the copy.
+
+    Attributes:
+        max_bytes: The maximum size of all the copies.
+        max_entry: Musics larger than this are never cached, so a single
+                   master can't flush the cache.
+        directory: The directory of the copies, created inside the
+                   cache directory and removed by close().
+        hits: How many requests were served by a copy.
+        misses: How many requests had to copy the music.
+        coalesced: How many requests waited for another one to copy the
+                   music.
+        evictions: How many copies were removed to make room.
+
+    Methods:
+        open(name): Opens a music, through its copy when possible.
+        stats(): Returns the cache counters.
+        close(): Removes the copies.
+    """
+
+    def __init__(self, max_bytes: int, directory: str = None,
+                 max_entry: int = None) -> None:
+        """Initializes an empty cache.
+
+        Args:
+            max_bytes: The maximum size of all the copies.
+            directory: Where the directory of the copies is created.
+                       Every cache gets its own, so server workers may
+                       share it. Defaults to the system temporary
+                       directory.
+            max_entry: Musics larger than this are never cached.
+                       Defaults to an eighth of max_bytes.
+        """
+
+        self.max_bytes = max_bytes
+        self.max_entry = max_entry or max_bytes // 8
+        if directory is not None:
+            directory = os.path.abspath(directory)
+            os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix="music_sender_cache_",
+                                          dir=directory)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.__entries = collections.OrderedDict()
+        self.__pending = {}
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    def open(self, name: str):
+        """Opens a music, through its copy when possible.
+
+        It may copy the music or wait for another request to copy it,
+        so it can block for a long time.
+
+        Args:
+            name: The music path.
+
+        Returns:
+            A file object opened in binary mode.
+
+        Raises:
+            OSError: When the music can't be opened.
+        """
+
+        stat = os.stat(name)
+        key = (stat.st_size, stat.st_mtime_ns)
+        if stat.st_size > self.max_entry:
+            return open(name, "rb")
+        while True:
+            with self.__lock:
+                entry = self.__entries.get(name)
+                if entry is not None and entry[1] == key:
+                    try:
+                        cached = open(entry[0], "rb")
+                    except OSError:
+                        self.__remove(name)
+                    else:
+                        self.__entries.move_to_end(name)
+                        self.hits += 1
+                        return cached
+                elif entry is not None:
+                    # The music has changed.
+                    self.__remove(name)
+                event = self.__pending.get(name)
+                if event is None:
+                    event = self.__pending[name] = threading.Event()
+                    self.misses += 1
+                    break
+                self.coalesced += 1
+            event.wait()
+            # The copy may have failed, then it's tried again.
+        try:
+            cached = self.__fill(name, key)
+        finally:
+            with self.__lock:
+                self.__pending.pop(name).set()
+        return cached or open(name, "rb")
+
+    def __fill(self, name: str, key: (int, int)):
+        """Copies a music to the cache and opens the copy.
+
+        Returns:
+            The copy opened in binary mode, or None when the music
+            couldn't be copied.
+        """
+
+        digest = hashlib.blake2b(name.encode("utf8", "surrogateescape"),
+                                 digest_size=16).hexdigest()
+        path = os.path.join(self.directory,
+                            digest + os.path.splitext(name)[1])
+        temporary = path + ".tmp"
+        try:
+            shutil.copyfile(name, temporary)
+            stat = os.stat(name)
+            if (stat.st_size, stat.st_mtime_ns) != key:
+                # The music has changed while it was copied.
+                os.remove(temporary)
+                return None
+            with self.__lock:
+                os.replace(temporary, path)
+                self.__entries[name] = (path, key)
+                self.__size += key[0]
+                while self.__size > self.max_bytes \
+                        and len(self.__entries) > 1:
+                    self.__remove(next(iter(self.__entries)))
+                    self.evictions += 1
+                return open(path, "rb")
+        except OSError:
+            # Like a full cache disk, the music is sent uncached.
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return None
+
+    def __remove(self, name: str) -> None:
+        """Removes the copy of a music. Must hold the lock.
+
+        A copy being sent stays readable until it's closed.
+        """
+
+        path, key = self.__entries.pop(name)
+        self.__size -= key[0]
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        """Returns the cache counters.
+
+        Returns:
+            A dict with the hits, misses, coalesced requests, evictions,
+            the number of copies and their size.
+        """
+
+        with self.__lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "coalesced": self.coalesced,
+                    "evictions": self.evictions,
+                    "entries": len(self.__entries), "size": self.__size}
+
+    def close(self) -> None:
+        """Removes the copies and their directory."""
+
+        with self.__lock:
+            self.__entries.clear()
+            self.__size = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,399 @@
+"""Music library index.
+
+This module keeps a persistent index of a music library in a SQLite
+database. The library may be organized in subdirectories, like
+Artist/Album/Track.mp3, and every track gets an ID that never changes
+while the track exists, so adding or removing musics doesn't shift the
+codes of the other musics.
+
+The index stores the modification time of every directory. When the
+index is reconciled with the filesystem, only the directories whose
+mtime has changed are scanned again, so a server restart doesn't need a
+full rescan of the library.
+
+Every added, changed or removed track is recorded in a change log with
+a growing catalog version, so clients can ask only for the changes
+since the last version they have seen.
+"""
+
+import os
+import sqlite3
+import threading
+import uuid
+
+from . import utils
+from .hashcache import hash_file
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL UNIQUE,
+    directory TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT
+);
+CREATE INDEX IF NOT EXISTS tracks_directory ON tracks (directory);
+CREATE TABLE IF NOT EXISTS changes (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    track_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Number of changes kept in the change log
+MAX_CHANGES = 100000
+
+
+class LibraryIndex:
+    """A persistent, recursive index of a music library.
+
+    Paths are stored relative to the library root, with "/" as the
+    separator. The root directory itself is stored as "". Hidden
+    directories are skipped.
+
+    The index is safe to be shared by many threads and several processes
+    may open the same database.
+
+    Every database has a random epoch, so a client can tell that a
+    version belongs to another database, for instance after the
+    database was deleted and built again.
+
+    Attributes:
+        FILENAME: The default name of the database file.
+        root: The library root directory.
+        filename: The database file path.
+        epoch: The random identifier of the database.
+
+    Methods:
+        reconcile(): Updates the index from the filesystem.
+        update(paths): Updates the given tracks from the filesystem.
+        tracks(): Returns the IDs and paths of every track.
+        entry(path): Returns the manifest entry of a track.
+        version(): Returns the current catalog version.
+        changes(since): Returns the tracks changed after a version.
+        close(): Closes the database.
+    """
+
+    FILENAME = ".music_sender.db"
+
+    def __init__(self, root: str = ".", filename: str = None) -> None:
+        """Opens the index database, creating it when needed.
+
+        Args:
+            root: The library root directory.
+            filename: The database file path. Relative paths are
+                      relative to root. Defaults to FILENAME in root.
+        """
+
+        self.root = root
+        self.filename = os.path.join(root, filename or self.FILENAME)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(self.filename, timeout=30,
+                                    check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.executescript(SCHEMA)
+        self.__db.execute("INSERT OR IGNORE INTO meta (key, value) "
+                          "VALUES ('epoch', ?)", (uuid.uuid4().hex,))
+        self.__db.commit()
+        self.epoch = self.__meta("epoch")
+
+    def __meta(self, key: str) -> str:
+        """Reads a value of the meta table."""
+
+        row = self.__db.execute("SELECT value FROM meta WHERE key = ?",
+                                (key,)).fetchone()
+        return row[0] if row else None
+
+    def __log(self, track_ids) -> None:
+        """Records changed tracks in the change log. Must hold the lock
+        and be committed by the caller."""
+
+        self.__db.executemany("INSERT INTO changes (track_id) VALUES (?)",
+                              [(track_id,) for track_id in track_ids])
+
+    def close(self) -> None:
+        """Closes the database."""
+
+        with self.__lock:
+            self.__db.close()
+
+    def __full_path(self, path: str) -> str:
+        """Returns the filesystem path of an index path."""
+
+        if not path:
+            return self.root
+        return os.path.join(self.root, *path.split("/"))
+
+    def reconcile(self) -> bool:
+        """Updates the index from the filesystem.
+
+        Every known directory is checked with a single stat() call. Only
+        the directories whose mtime has changed, and new directories,
+        are scanned: their tracks are added, updated or removed.
+        Directories that no longer exist are removed with their tracks.
+
+        Returns:
+            True whether the index has changed, otherwise False.
+        """
+
+        with self.__lock:
+            known = dict(self.__db.execute(
+                "SELECT path, mtime_ns FROM directories"))
+            children = {}
+            for path, parent in self.__db.execute(
+                    "SELECT path, parent FROM directories"):
+                children.setdefault(parent, []).append(path)
+        changed = False
+        seen = set()
+        pending = [""]
+        while pending:
+            path = pending.pop()
+            try:
+                mtime = os.stat(self.__full_path(path)).st_mtime_ns
+            except OSError:
+                continue
+            seen.add(path)
+            if known.get(path) == mtime:
+                pending.extend(children.get(path, ()))
+                continue
+            changed = True
+            pending.extend(self.__scan_directory(path, mtime))
+        removed = set(known) - seen
+        if removed:
+            changed = True
+            with self.__lock:
+                for path in removed:
+                    self.__log(track_id for track_id, in self.__db.execute(
+                        "SELECT id FROM tracks WHERE directory = ?",
+                        (path,)).fetchall())
+                self.__db.executemany(
+                    "DELETE FROM directories WHERE path = ?",
+                    [(path,) for path in removed])
+                self.__db.executemany(
+                    "DELETE FROM tracks WHERE directory = ?",
+                    [(path,) for path in removed])
+                self.__trim()
+                self.__db.commit()
+        return changed
+
+    def __scan_directory(self, path: str, mtime: int) -> list:
+        """Scans a directory and updates its tracks.
+
+        Args:
+            path: The directory index path.
+            mtime: The directory mtime in nanoseconds.
+
+        Returns:
+            The index paths of the subdirectories.
+        """
+
+        prefix = path + "/" if path else ""
+        subdirectories = []
+        found = {}
+        try:
+            with os.scandir(self.__full_path(path)) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith("."):
+                            subdirectories.append(prefix + entry.name)
+                    elif utils.is_music_file(entry.name):
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        found[prefix + entry.name] = (
+                            stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            return []
+        with self.__lock:
+            indexed = {row[0]: row[1:] for row in self.__db.execute(
+                "SELECT path, id, inode, size, mtime_ns FROM tracks "
+                "WHERE directory = ?", (path,))}
+            removed = [track for track in indexed if track not in found]
+            changed = [track for track in found if track in indexed
+                       and tuple(indexed[track][1:]) != found[track]]
+            self.__db.executemany(
+                "DELETE FROM tracks WHERE path = ?",
+                [(track,) for track in removed])
+            self.__db.executemany(
+                "UPDATE tracks SET inode = ?, size = ?, mtime_ns = ?, "
+                "hash = NULL WHERE path = ?",
+                [found[track] + (track,) for track in changed])
+            self.__log(indexed[track][0] for track in removed + changed)
+            for track, key in found.items():
+                if track not in indexed:
+                    cursor = self.__db.execute(
+                        "INSERT INTO tracks (path, directory, inode, size, "
+                        "mtime_ns) VALUES (?, ?, ?, ?, ?)",
+                        (track, path) + key)
+                    self.__log([cursor.lastrowid])
+            self.__trim()
+            self.__db.execute(
+                "INSERT OR REPLACE INTO directories (path, parent, mtime_ns) "
+                "VALUES (?, ?, ?)",
+                (path, path.rpartition("/")[0] if path else None, mtime))
+            self.__db.commit()
+        return subdirectories
+
+    def update(self, paths) -> bool:
+        """Updates the given tracks from the filesystem.
+
+        reconcile() only notices the tracks of the directories that
+        changed, so the tracks rewritten in place, which don't change
+        their directory, are given by a watcher.
+
+        Args:
+            paths: The index paths of the tracks that may have changed.
+                   Paths that aren't tracks are ignored.
+
+        Returns:
+            True whether the index has changed, otherwise False.
+        """
+
+        changed = []
+        for path in paths:
+            try:
+                stat = os.stat(self.__full_path(path))
+            except OSError:
+                # Removed, reconcile() will notice it.
+                continue
+            key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            with self.__lock:
+                row = self.__db.execute(
+                    "SELECT id, inode, size, mtime_ns FROM tracks "
+                    "WHERE path = ?", (path,)).fetchone()
+            if row is not None and row[1:] != key:
+                changed.append(key + (None, row[0]))
+        if not changed:
+            return False
+        with self.__lock:
+            self.__db.executemany(
+                "UPDATE tracks SET inode = ?, size = ?, mtime_ns = ?, "
+                "hash = ? WHERE id = ?", changed)
+            self.__log(track_id for *_, track_id in changed)
+            self.__trim()
+            self.__db.commit()
+        return True
+
+    def tracks(self) -> list:
+        """Returns every track of the index.
+
+        Returns:
+            A list of tuples with the track ID and path, sorted by ID.
+        """
+
+        with self.__lock:
+            return self.__db.execute(
+                "SELECT id, path FROM tracks ORDER BY id").fetchall()
+
+    def entry(self, path: str) -> dict:
+        """Returns the manifest entry of a track.
+
+        The content hash is stored in the index with the inode, size and
+        mtime of the track, and it's only computed again when one of
+        them changes.
+
+        Args:
+            path: The track index path.
+
+        Returns:
+            A dict with the name, size, mtime and hash of the track.
+
+        Raises:
+            OSError: When the track can't be read.
+        """
+
+        full_path = self.__full_path(path)
+        stat = os.stat(full_path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT id, inode, size, mtime_ns, hash FROM tracks "
+                "WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[1:4] == key and row[4] is not None:
+            digest = row[4]
+        else:
+            digest = hash_file(full_path)
+            if row is not None:
+                with self.__lock:
+                    self.__db.execute(
+                        "UPDATE tracks SET inode = ?, size = ?, "
+                        "mtime_ns = ?, hash = ? WHERE path = ?",
+                        key + (digest, path))
+                    if row[1:4] != key:
+                        # Rewritten in place, the directory didn't
+                        # change.
+                        self.__log([row[0]])
+                    self.__db.commit()
+        return {"name": path, "size": stat.st_size, "mtime": stat.st_mtime,
+                "hash": digest}
+
+    def __trim(self) -> None:
+        """Drops the oldest changes of the change log, keeping the last
+        MAX_CHANGES. Must hold the lock and be committed by the
+        caller."""
+
+        row = self.__db.execute("SELECT MAX(version) FROM changes").fetchone()
+        if row[0] is None or row[0] <= MAX_CHANGES:
+            return
+        trimmed = row[0] - MAX_CHANGES
+        if trimmed > int(self.__meta("trimmed") or 0):
+            self.__db.execute("DELETE FROM changes WHERE version <= ?",
+                              (trimmed,))
+            self.__db.execute("INSERT OR REPLACE INTO meta (key, value) "
+                              "VALUES ('trimmed', ?)", (str(trimmed),))
+
+    def version(self) -> int:
+        """Returns the current catalog version.
+
+        Returns:
+            The version of the last change, or 0 when nothing changed
+            yet.
+        """
+
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT MAX(version) FROM changes").fetchone()
+        return row[0] or 0
+
+    def changes(self, since: int) -> (int, list):
+        """Returns the tracks changed after a catalog version.
+
+        A track that changed many times is returned once.
+
+        Args:
+            since: The catalog version the client has seen.
+
+        Returns:
+            A tuple with the current version and a list of tuples with
+            the track ID and path of the changed tracks, in change
+            order. The path is None for removed tracks. The list is
+            None when the changes since that version aren't known, so
+            the whole catalog must be sent. It's always None for the
+            version 0.
+        """
+
+        with self.__lock:
+            version = self.__db.execute(
+                "SELECT MAX(version) FROM changes").fetchone()[0] or 0
+            if not 0 < since <= version \
+                    or since < int(self.__meta("trimmed") or 0):
+                return version, None
+            changed = self.__db.execute(
+                "SELECT changed.track_id, tracks.path FROM ("
+                "SELECT track_id, MAX(version) AS version FROM changes "
+                "WHERE version > ? GROUP BY track_id) AS changed "
+                "LEFT JOIN tracks ON tracks.id = changed.track_id "
+                "ORDER BY changed.version", (since,)).fetchall()
+        return version, changed
@@ -0,0 +1,113 @@
+"""Music Sender logging.
+
+Every module logs to its own child of the "music_sender" logger. setup()
+hands the records to a queue that a background thread formats and
+writes, so a slow terminal or journal never stalls a transfer.
+
+The per-command records are logged at the DEBUG level with %-style
+arguments, so while DEBUG is disabled they cost a level check and the
+message is never built. The records of a request carry structured
+fields, like the client address and the command, added by a
+RequestLogger and written as key=value pairs.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOGGER = "music_sender"
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+# Structured fields written after the message, in this order
+FIELDS = ("client", "command")
+COLORS = {
+    logging.DEBUG: "33",
+    logging.INFO: "36",
+    logging.WARNING: "31",
+    logging.ERROR: "31",
+}
+
+
+class RequestLogger(logging.LoggerAdapter):
+    """A logger adapter that adds structured fields to every record.
+
+    Methods:
+        bind(**fields): Returns an adapter with more fields.
+    """
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = {**self.extra, **kwargs.get("extra", {})}
+        return msg, kwargs
+
+    def bind(self, **fields):
+        """Returns an adapter of the same logger with more fields."""
+
+        return RequestLogger(self.logger, {**self.extra, **fields})
+
+
+class Formatter(logging.Formatter):
+    """Formats a record as a "[*]" line with its structured fields,
+    colored by level on terminals."""
+
+    def __init__(self, color: bool = False) -> None:
+        super().__init__("%(asctime)s %(levelname)s %(message)s",
+                         "%H:%M:%S")
+        self.color = color
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(f"{field}={getattr(record, field)}"
+                          for field in FIELDS if hasattr(record, field))
+        line = f"[*] {record.getMessage()}"
+        if fields:
+            line += f" [{fields}]"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        if self.color:
+            return f"\033[;{COLORS.get(record.levelno, '0')}m{line}\033[m"
+        return f"{self.formatTime(record, self.datefmt)} " \
+               f"{record.levelname} {line}"
+
+
+def setup(level="info", stream=None, color: bool = None):
+    """Configures the "music_sender" logger to write from a background
+    thread.
+
+    It may be called again, like in a forked worker process, where the
+    thread of the parent doesn't exist.
+
+    Args:
+        level: A LEVELS name or a logging level number.
+        stream: Where the records are written. Defaults to stderr.
+        color: Whether the lines are colored. Defaults to whether the
+               stream is a terminal.
+
+    Returns:
+        The started QueueListener. It's stopped at exit, after writing
+        the pending records.
+    """
+
+    if stream is None:
+        stream = sys.stderr
+    if color is None:
+        color = hasattr(stream, "isatty") and stream.isatty()
+    if isinstance(level, str):
+        level = LEVELS[level]
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(Formatter(color))
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    logger = logging.getLogger(LOGGER)
+    for old_handler in logger.handlers:
+        logger.removeHandler(old_handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.setLevel(level)
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
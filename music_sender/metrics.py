@@ -0,0 +1,276 @@
+"""Server metrics.
+
+This module keeps the counters and latency histograms of a server and
+renders them in the Prometheus text format, which is served by a small
+HTTP exporter. Updating a metric only takes a lock and a few additions,
+so it's cheap enough for the transfer path.
+"""
+
+import bisect
+import collections
+import http.server
+import threading
+import time
+
+# Upper bounds in seconds of the command latency buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0,
+                   30.0, 60.0, 300.0)
+# Seconds of sent bytes averaged by the send rate
+RATE_WINDOW = 10
+# Counters that are gauges, every other one only grows
+GAUGES = {"open_connections", "transfers", "bytes_per_second", "uptime",
+          "workers", "catalog_size", "cache_entries", "cache_size"}
+# Counters that are the same for every worker, so they aren't summed
+SHARED = {"catalog_size", "uptime"}
+
+
+class Metrics:
+    """The counters and latency histograms of a server.
+
+    Attributes:
+        started: The monotonic time the server started.
+        bytes_sent: How many bytes of music were sent.
+        broken_pipes: How many sends failed because the client went
+                      away.
+
+    Methods:
+        observe(command, seconds): Records the latency of a command.
+        error(error): Counts an error answer.
+        add_bytes(count): Counts bytes of music sent.
+        broken_pipe(): Counts a send that failed with a broken pipe.
+        bytes_per_second(): Returns the recent send rate.
+        snapshot(): Returns all the metrics.
+    """
+
+    def __init__(self) -> None:
+        """Initializes the metrics at zero."""
+
+        self.started = time.monotonic()
+        self.bytes_sent = 0
+        self.broken_pipes = 0
+        self.__commands = {}
+        self.__errors = collections.Counter()
+        # Bytes sent in each of the last seconds, oldest first.
+        self.__window = collections.deque(maxlen=RATE_WINDOW + 1)
+        self.__lock = threading.Lock()
+
+    def observe(self, command: str, seconds: float) -> None:
+        """Records the latency of a command.
+
+        Args:
+            command: The command name, like "--copy".
+            seconds: How long it took, including the transfer.
+        """
+
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.__lock:
+            histogram = self.__commands.get(command)
+            if histogram is None:
+                histogram = self.__commands[command] = {
+                    "count": 0, "sum": 0.0,
+                    "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["buckets"][index] += 1
+
+    def error(self, error: bytes) -> None:
+        """Counts an error answer, like b"not-available"."""
+
+        with self.__lock:
+            self.__errors[error.decode("ascii", "replace")] += 1
+
+    def add_bytes(self, count: int) -> None:
+        """Counts bytes of music sent."""
+
+        second = int(time.monotonic())
+        with self.__lock:
+            self.bytes_sent += count
+            if self.__window and self.__window[-1][0] == second:
+                self.__window[-1][1] += count
+            else:
+                self.__window.append([second, count])
+
+    def broken_pipe(self) -> None:
+        """Counts a send that failed because the client went away."""
+
+        with self.__lock:
+            self.broken_pipes += 1
+
+    def bytes_per_second(self) -> float:
+        """Returns the average send rate of the last RATE_WINDOW
+        seconds, without the current one."""
+
+        second = int(time.monotonic())
+        with self.__lock:
+            sent = sum(count for start, count in self.__window
+                       if second - RATE_WINDOW <= start < second)
+        return sent / RATE_WINDOW
+
+    def snapshot(self) -> dict:
+        """Returns all the metrics.
+
+        Returns:
+            A dict with the uptime, the bytes sent, the send rate, the
+            broken pipes, the error answers by error in "errors" and
+            the latency histogram of every command in "commands". A
+            histogram is a dict with the count, the sum of the latencies
+            and the count of every LATENCY_BUCKETS bucket, plus the
+            slower ones.
+        """
+
+        rate = self.bytes_per_second()
+        with self.__lock:
+            return {
+                "uptime": round(time.monotonic() - self.started, 3),
+                "bytes_sent": self.bytes_sent,
+                "bytes_per_second": rate,
+                "broken_pipes": self.broken_pipes,
+                "errors": dict(self.__errors),
+                "commands": {
+                    command: {"count": histogram["count"],
+                              "sum": histogram["sum"],
+                              "buckets": list(histogram["buckets"])}
+                    for command, histogram in self.__commands.items()},
+            }
+
+
+def combine(stats: [dict]) -> dict:
+    """Combines the counters of many servers, like the workers.
+
+    Counters and histograms are summed, except the SHARED ones, which
+    are the same for every server.
+
+    Args:
+        stats: The stats() dicts of the servers.
+
+    Returns:
+        The combined dict.
+    """
+
+    combined = {}
+    for server_stats in stats:
+        for key, value in server_stats.items():
+            if isinstance(value, dict):
+                combined[key] = combine([combined.get(key, {}), value])
+            elif isinstance(value, list):
+                previous = combined.get(key, [0] * len(value))
+                combined[key] = [a + b for a, b in zip(previous, value)]
+            elif key in SHARED:
+                combined[key] = max(combined.get(key, value), value)
+            else:
+                combined[key] = combined.get(key, 0) + value
+    return combined
+
+
+def render(stats: dict, prefix: str = "music_sender") -> str:
+    """Renders server counters in the Prometheus text format.
+
+    Args:
+        stats: A stats() dict of a server, or combined ones.
+        prefix: The prefix of the metric names.
+
+    Returns:
+        The text exposition.
+    """
+
+    lines = []
+
+    def metric(name, kind, samples):
+        lines.append(f"# TYPE {prefix}_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{prefix}_{name}{labels} {value}")
+
+    for key, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if key in GAUGES:
+                metric(key, "gauge", [("", value)])
+            else:
+                metric(f"{key}_total", "counter", [("", value)])
+    if stats.get("errors"):
+        metric("errors_total", "counter", [
+            (f'{{error="{_escape(error)}"}}', count)
+            for error, count in sorted(stats["errors"].items())])
+    if stats.get("commands"):
+        samples = []
+        for command, histogram in sorted(stats["commands"].items()):
+            label = f'command="{_escape(command)}"'
+            cumulative = 0
+            bounds = [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]
+            for bound, count in zip(bounds, histogram["buckets"]):
+                cumulative += count
+                samples.append((f'_bucket{{{label},le="{bound}"}}',
+                                cumulative))
+            samples.append((f"_sum{{{label}}}", histogram["sum"]))
+            samples.append((f"_count{{{label}}}", histogram["count"]))
+        lines.append(f"# TYPE {prefix}_command_seconds histogram")
+        for suffix, value in samples:
+            lines.append(f"{prefix}_command_seconds{suffix} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    """Escapes a Prometheus label value."""
+
+    return value.replace("\\", r"\\").replace('"', r"\"").replace(
+        "\n", r"\n")
+
+
+class MetricsExporter:
+    """An HTTP server that serves the metrics of a server on /metrics.
+
+    It runs on a daemon thread, so it doesn't slow down the transfers
+    and stops with the program.
+
+    Attributes:
+        address: The host and port the exporter listens on.
+
+    Methods:
+        start(): Starts serving on a daemon thread.
+        stop(): Stops serving.
+    """
+
+    def __init__(self, source, address: (str, int)) -> None:
+        """Binds the exporter.
+
+        Args:
+            source: A function that returns the stats() dict to export,
+                    like MusicSenderServer.stats.
+            address: The host and port to listen on. Binding it to the
+                     loopback keeps the metrics local.
+
+        Raises:
+            OSError: When the address can't be bound.
+        """
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render(source()).encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = http.server.ThreadingHTTPServer(address, Handler)
+        self.__server.daemon_threads = True
+        self.address = self.__server.server_address[:2]
+
+    def start(self) -> None:
+        """Starts serving on a daemon thread."""
+
+        threading.Thread(target=self.__server.serve_forever,
+                         daemon=True).start()
+
+    def stop(self) -> None:
+        """Stops serving."""
+
+        self.__server.shutdown()
+        self.__server.server_close()
@@ -0,0 +1,239 @@
+"""Music Sender wire protocol.
+
+Every message is a frame made of a fixed size header followed by a
+payload. The header carries a magic string, the protocol version, the
+frame type and the payload length:
+
+    +-------+---------+------+----------------+-------------------+
+    | magic | version | type | payload length | payload           |
+    | 2 B   | 1 B     | 1 B  | 8 B            | payload length B  |
+    +-------+---------+------+----------------+-------------------+
+
+A connection starts with the client sending a HELLO frame. Clients that
+predate the framed protocol send bare commands like b"--copy 3", which
+never start with the magic string, so the server can tell them apart
+from the first two bytes.
+
+File data is sent as a FILE frame whose payload length is the file size,
+so the receiver knows exactly how many bytes belong to the file.
+
+The client HELLO may list the codecs it can decompress in
+"compression", and the server HELLO answers with the ones the server
+may use. A music the server decides to compress is announced with its
+codec in the "encoding" of its REPLY and sent as a FILE frame for every
+compressed block, ended by an empty FILE frame.
+
+A client watching the catalog receives EVENT frames pushed by the
+server whenever the catalog changes and empty HEARTBEAT frames while
+nothing happens, so a dead connection is noticed.
+
+A server that is full answers a HELLO or a transfer command with a BUSY
+frame, telling the client how many milliseconds to wait before trying
+again.
+"""
+
+import json
+import struct
+
+MAGIC = b"MS"
+VERSION = 1
+HEADER = struct.Struct("!2sBBQ")
+# Largest payload of a frame received by the server, enough for the
+# delta signature of a 100 GiB music. FILE data is streamed instead.
+MAX_FRAME = 16 * 1024 * 1024
+# Largest payload of a frame received by the client, like the manifest
+# of a huge library
+MAX_REPLY = 256 * 1024 * 1024
+
+# Frame types
+HELLO = 1
+COMMAND = 2
+REPLY = 3
+ERROR = 4
+FILE = 5
+EVENT = 6
+HEARTBEAT = 7
+BUSY = 8
+
+
+class ProtocolError(Exception):
+    """Raised when the peer doesn't follow the framed protocol."""
+
+
+class ServerBusy(ProtocolError):
+    """Raised when the server is still full after the client has waited
+    as long as it was told to.
+
+    Attributes:
+        retry_after: The seconds the server asked the client to wait.
+    """
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"The server is busy, retry after "
+                         f"{retry_after:.3f}s.")
+        self.retry_after = retry_after
+
+
+class CommandRefused(ProtocolError):
+    """Raised when the server answers a command with an ERROR frame.
+
+    Attributes:
+        reason: The error the server sent.
+    """
+
+    def __init__(self, command: str, reason: str) -> None:
+        super().__init__(f"The server refused {command}: {reason}.")
+        self.reason = reason
+
+
+class IntegrityError(ProtocolError):
+    """Raised when a received music doesn't have the size or the content
+    hash the server announced.
+
+    Attributes:
+        name: The music name.
+    """
+
+    def __init__(self, name: str) -> None:
+        super().__init__(f"{name} has arrived corrupt.")
+        self.name = name
+
+
+def encode(obj) -> bytes:
+    """Encodes a python object as a JSON payload."""
+
+    return json.dumps(obj).encode("utf8")
+
+
+def decode(payload: bytes):
+    """Decodes a JSON payload into a python object."""
+
+    return json.loads(payload.decode("utf8"))
+
+
+def recv_exact(sock, size: int) -> bytes:
+    """Receives exactly size bytes from a socket.
+
+    Args:
+        sock: The socket to read from.
+        size: The number of bytes to be read.
+
+    Returns:
+        The received bytes.
+
+    Raises:
+        ConnectionError: When the peer closes the connection before
+                         size bytes arrive.
+    """
+
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Connection closed by the peer.")
+        received += count
+    return bytes(data)
+
+
+def pack_header(frame_type: int, length: int) -> bytes:
+    """Builds a frame header.
+
+    Args:
+        frame_type: One of the frame type constants.
+        length: The payload length in bytes.
+
+    Returns:
+        The header bytes.
+    """
+
+    return HEADER.pack(MAGIC, VERSION, frame_type, length)
+
+
+def unpack_header(header: bytes) -> (int, int):
+    """Parses a frame header.
+
+    Args:
+        header: The HEADER.size bytes of a frame header.
+
+    Returns:
+        A tuple with the frame type and the payload length.
+
+    Raises:
+        ProtocolError: When the header is malformed.
+    """
+
+    magic, _, frame_type, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError("Bad frame magic.")
+    return frame_type, length
+
+
+def check_length(length: int, max_length: int = MAX_FRAME) -> None:
+    """Checks the payload length of a frame before it's received, so a
+    peer can't make the receiver allocate any amount of memory.
+
+    Raises:
+        ProtocolError: When the length is larger than max_length.
+    """
+
+    if length > max_length:
+        raise ProtocolError(f"Frame of {length} bytes is too large.")
+
+
+def recv_header(sock) -> (int, int):
+    """Receives a frame header.
+
+    Returns:
+        A tuple with the frame type and the payload length.
+    """
+
+    return unpack_header(recv_exact(sock, HEADER.size))
+
+
+def recv_frame(sock, max_length: int = MAX_FRAME) -> (int, bytes):
+    """Receives a whole frame.
+
+    Args:
+        sock: The socket to read from.
+        max_length: The largest payload length accepted.
+
+    Returns:
+        A tuple with the frame type and the payload bytes.
+
+    Raises:
+        ProtocolError: When the header is malformed or the payload is
+                       larger than max_length.
+    """
+
+    frame_type, length = recv_header(sock)
+    check_length(length, max_length)
+    return frame_type, recv_exact(sock, length)
+
+
+def send_frame(sock, frame_type: int, payload: bytes = b"") -> None:
+    """Sends a whole frame.
+
+    Args:
+        sock: The socket to write to.
+        frame_type: One of the frame type constants.
+        payload: The frame payload bytes.
+    """
+
+    sock.sendall(pack_header(frame_type, len(payload)) + payload)
+
+
+def send_file(sock, file, size: int, offset: int = 0) -> None:
+    """Sends a FILE frame using a range of the file as payload.
+
+    Args:
+        sock: The socket to write to.
+        file: A file object opened in binary mode.
+        size: The number of bytes of the file to be sent.
+        offset: The position of the first byte to be sent.
+    """
+
+    sock.sendall(pack_header(FILE, size))
+    if size:
+        sock.sendfile(file, offset, size)
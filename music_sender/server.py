@@ -3,60 +3,251 @@
 This script allows the user to estabilish the server for sending musics
 dynamically to the client.
 
-usage: server.py [-h] [-l LOCAL] [-hs HOST] [-p PORT]
+usage: server.py [-h] [-l LOCAL] [-hs HOST] [-p PORT] [--index INDEX]
+       [--engine {threading,asyncio}] [--workers WORKERS]
+       [--idle-timeout IDLE_TIMEOUT] [--max-requests MAX_REQUESTS]
+       [--heartbeat HEARTBEAT] [--max-rate MAX_RATE]
+       [--max-client-rate MAX_CLIENT_RATE]
+       [--max-connections MAX_CONNECTIONS]
+       [--max-transfers MAX_TRANSFERS] [--retry-after RETRY_AFTER]
+       [--cache-size CACHE_SIZE] [--cache-dir CACHE_DIR]
+       [--metrics-port METRICS_PORT] [--no-compression]
+       [--log-level {debug,info,warning,error}] [--log-file LOG_FILE]
 
 optional arguments:
   -h, --help                  show this help message and exit
 
-  -l LOCAL, --local LOCAL     Indicates where the script gets musics
+  -l LOCAL, --local LOCAL     Indicates where the script gets musics,
+                              including its subdirectories
+
+  --index INDEX               SQLite database of the library index. A
+                              relative path is relative to LOCAL.
+                              Default .music_sender.db
 
   -hs HOST, --host HOST       Server host
 
   -p PORT, --port PORT        Server port
 
+  --engine {threading,asyncio}
+                              Server engine. threading uses a thread per
+                              client, asyncio serves every client on a
+                              single event loop
+
+  --workers WORKERS           Number of server processes sharing the
+                              port through SO_REUSEPORT
+
+  --idle-timeout IDLE_TIMEOUT Seconds a client session may stay idle
+                              before being closed
+
+  --max-requests MAX_REQUESTS Maximum number of requests served in one
+                              client session. 0 means unlimited
+
+  --heartbeat HEARTBEAT       Seconds between two heartbeats sent to
+                              the clients watching the catalog
+
+  --max-rate MAX_RATE         Total upload cap in MiB/s, shared by the
+                              transfers in turns. 0 means unlimited
+
+  --max-client-rate MAX_CLIENT_RATE
+                              Upload cap of every client host in MiB/s.
+                              0 means unlimited
+
+  --max-connections MAX_CONNECTIONS
+                              Maximum number of open client connections.
+                              Other clients are told to retry later. 0
+                              means unlimited
+
+  --max-transfers MAX_TRANSFERS
+                              Maximum number of musics being sent at
+                              once. Other requests are told to retry
+                              later. 0 means unlimited
+
+  --retry-after RETRY_AFTER   Milliseconds a rejected client is told to
+                              wait before trying again
+
+  --cache-size CACHE_SIZE     Size in MiB of the local copies of the
+                              musics requested last, so a slow music
+                              directory is read once. 0 disables it
+
+  --cache-dir CACHE_DIR       Where the local copies are kept. Default
+                              the system temporary directory
+
+  --metrics-port METRICS_PORT
+                              Serves the server metrics in the
+                              Prometheus text format on
+                              http://127.0.0.1:METRICS_PORT/metrics
+
+  --no-compression            Never compresses the WAV, PCM and AIFF
+                              musics, even for clients on slow links
+
+  --log-level {debug,info,warning,error}
+                              Log level. debug logs every connection
+                              and command. Default info
+
+  --log-file LOG_FILE         Appends the log to LOG_FILE instead of
+                              writing it to stderr
+
 Examples:
 
     ms_server -hs 192.168.1.4 -p 6734 -l ~/Music/
 
     ms_server -hs 192.168.1.23 -p 3001
+
+    ms_server -hs 192.168.1.23 -p 3001 --engine asyncio
+
+    ms_server -hs 192.168.1.23 -p 3001 --workers 4
+
+    ms_server -hs 192.168.1.23 -p 3001 --max-rate 50 --max-client-rate 10
+
+    ms_server -hs 192.168.1.23 -p 3001 -l /mnt/nas/Music --cache-size 2048
+
+    ms_server -hs 192.168.1.23 -p 3001 --metrics-port 9101
+
+    ms_server -hs 192.168.1.23 -p 3001 --log-level debug --log-file ms.log
 """
 
 import argparse
+import logging
 import os
 import random
 import re
 import socket
 import socketserver
+import sqlite3
+import threading
 import time
 
-from . import utils
+from . import commands, log, protocol
+from .commands import CommandProcessor
+from .catalog import MusicCatalog
+from .compression import Compressor
+from .hotcache import HotCache
+from .library import LibraryIndex
+from .metrics import Metrics, MetricsExporter
+from .shaping import Shaper
+from .watcher import PollingWatcher, create_watcher
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadingServer(socketserver.ThreadingTCPServer):
+    """A ThreadingTCPServer with a listen backlog large enough for many
+    clients connecting at once, that can share its port with other
+    processes. The address is reused, so a restart isn't blocked by the
+    connections of watching clients in TIME_WAIT, and the handler
+    threads don't keep a stopping server waiting for idle sessions."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+    reuse_port = False
+
+    def server_bind(self) -> None:
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
 
 
 class MusicSenderServer:
     """Music Sender server.
 
     This is a simple TCP server. It is responsible for sending music
-    files to a MusicSenderClient.
+    files to a MusicSenderClient. Every client connection is handled by
+    its own thread.
 
     Attributes:
         HOST_PATTERN: Stores a regex pattern string for matching hosts.
         __address: A tuple that contains the server host and port.
         __local: A simple string that represents a directory path.
+        catalog: The MusicCatalog shared by all the client handlers.
+        library: The LibraryIndex of the music directory, with the
+                 content hashes of the musics. Opened by set_ambient().
+        idle_timeout: Seconds a framed session may stay idle before the
+                      server closes it.
+        max_requests: Maximum number of commands served in a single
+                      framed session. Zero means unlimited.
+        reuse_port: Whether other processes may listen on the same
+                    address, with the kernel balancing the connections.
+        heartbeat: Seconds between two heartbeats sent to the clients
+                   watching the catalog.
+        shaper: The Shaper with the bandwidth limits, or None when the
+                bandwidth isn't limited.
+        max_connections: Maximum number of open client connections.
+                         Zero means unlimited.
+        max_transfers: Maximum number of transfers at once. Zero means
+                       unlimited.
+        retry_after: Seconds a rejected client is told to wait.
+        hot_cache: The HotCache of the musics requested last, or None
+                   when they aren't cached.
+        compressor: The Compressor of the raw PCM musics, or None when
+                    they are never compressed.
+        metrics: The Metrics with the command latencies and the bytes
+                 sent.
+        version: The last catalog version seen by the library watcher.
+        connections: How many client connections were accepted.
+        rejected: How many connections and transfers were rejected
+                  because the server was full.
 
     Methods:
         set_ambient(): Sets the server ambient.
         start(): Starts the server.
         stop(): Shutdown and close the server.
+        start_watching(): Starts watching the library for changes.
+        wait_for_change(version, timeout): Waits for a newer catalog
+                                           version.
+        open_connection(): Admits a new client connection.
+        close_connection(): Releases a client connection.
+        start_transfer(): Admits a new transfer.
+        end_transfer(): Releases a transfer.
+        open_music(name): Opens a music, through the hot cache.
+        stats(): Returns the server counters.
     """
 
     HOST_PATTERN = r"192.168.\d{1,3}.\d{1,3}"
 
-    def __init__(self, address: (str, int), local: str) -> None:
+    def __init__(self, address: (str, int), local: str,
+                 idle_timeout: float = 30.0, max_requests: int = 1000,
+                 reuse_port: bool = False, catalog=None,
+                 index: str = None, heartbeat: float = 10.0,
+                 max_rate: float = None, max_client_rate: float = None,
+                 max_connections: int = 0, max_transfers: int = 0,
+                 retry_after: float = 1.0, cache_size: int = 0,
+                 cache_dir: str = None, compression: bool = True,
+                 shaping_state=None) -> None:
         """Initializes the MusicSender server.
 
         Args:
             address: A tuple containg a string host and a int port.
             local: The str path where the server gets musics.
+            idle_timeout: Seconds a framed session may stay idle.
+            max_requests: Maximum number of commands per framed
+                          session. Zero means unlimited.
+            reuse_port: Whether the address may be shared with other
+                        processes through SO_REUSEPORT.
+            catalog: The catalog of the server. A MusicCatalog of the
+                     library index is used when it's None.
+            index: The library index database path, relative to local.
+                   Defaults to LibraryIndex.FILENAME.
+            heartbeat: Seconds between two heartbeats sent to the
+                       clients watching the catalog.
+            max_rate: The total upload cap in bytes per second. None
+                      means unlimited.
+            max_client_rate: The upload cap of every client host in
+                             bytes per second. None means unlimited.
+            max_connections: Maximum number of open client connections.
+                             Zero means unlimited.
+            max_transfers: Maximum number of transfers at once. Zero
+                           means unlimited.
+            retry_after: Seconds a rejected client is told to wait.
+            cache_size: The size in bytes of the hot cache. Zero
+                        disables it.
+            cache_dir: Where the hot cache keeps its copies. Defaults
+                       to the system temporary directory.
+            compression: Whether the raw PCM musics may be compressed
+                         for the clients that support it.
+            shaping_state: The shaping.shared_state() of the bandwidth
+                           caps, shared by the worker processes. None
+                           enforces the caps in this process only.
 
         Raises:
             ValueError:
@@ -66,12 +257,41 @@ class MusicSenderServer:
 
         self.__address = address
         self.__local = local
-        MusicSenderServer.__check_address(address)
-        self.__sock_server = socketserver.ThreadingTCPServer(
-            address, DataHandler)
-
-    @staticmethod
-    def __check_address(address: (str, int)) -> None:
+        self.__check_address(address)
+        self.__index = index
+        self.catalog = catalog
+        self.library = None
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.reuse_port = reuse_port
+        self.heartbeat = heartbeat
+        self.shaper = None
+        if max_rate or max_client_rate:
+            self.shaper = Shaper(max_rate, max_client_rate,
+                                 state=shaping_state)
+        self.max_connections = max_connections
+        self.max_transfers = max_transfers
+        self.retry_after = retry_after
+        self.hot_cache = None
+        self.compressor = None
+        if compression:
+            self.compressor = Compressor(max_client_rate=max_client_rate)
+        self.metrics = Metrics()
+        self.version = 0
+        self.connections = 0
+        self.rejected = 0
+        self.__open_connections = 0
+        self.__transfers = 0
+        self.__stats_lock = threading.Lock()
+        self.__changed = threading.Condition()
+        self.__watcher = None
+        self.__stopping = False
+        self._bind(address)
+        if cache_size:
+            self.hot_cache = HotCache(cache_size, cache_dir)
+
+    @classmethod
+    def __check_address(cls, address: (str, int)) -> None:
         """Checks the address.
 
         Since Music Sender works with IPV4 adresses only, this method
@@ -93,7 +313,7 @@ class MusicSenderServer:
                 range.
         """
 
-        if re.match(MusicSenderServer.HOST_PATTERN, address[0]):
+        if re.match(cls.HOST_PATTERN, address[0]):
             # Check if the last two token is on range. (0 < x < 255)
             host_tokens = address[0].split(".")[2:]
             for token in host_tokens:
@@ -104,6 +324,20 @@ class MusicSenderServer:
         else:
             raise ValueError(f"Address {address} is invalid.")
 
+    def _bind(self, address: (str, int)) -> None:
+        """Creates the listening server on the address."""
+
+        self.__sock_server = ThreadingServer(address, DataHandler,
+                                             bind_and_activate=False)
+        self.__sock_server.reuse_port = self.reuse_port
+        self.__sock_server.music_server = self
+        try:
+            self.__sock_server.server_bind()
+            self.__sock_server.server_activate()
+        except OSError:
+            self.__sock_server.server_close()
+            raise
+
     def set_ambient(self) -> bool:
         """Sets the server ambient.
 
@@ -115,20 +349,178 @@ class MusicSenderServer:
 
         try:
             os.chdir(self.__local)
+            self.library = LibraryIndex(filename=self.__index)
+            if self.catalog is None:
+                self.catalog = MusicCatalog(index=self.library)
+                self.__watcher = create_watcher()
+            else:
+                # The catalog is kept by someone else, like the worker
+                # supervisor, it's only polled.
+                self.__watcher = PollingWatcher()
+            self.catalog.build()
+            self.version = self.library.version()
             return True
-        except (FileNotFoundError, NotADirectoryError, PermissionError):
+        except (FileNotFoundError, NotADirectoryError, PermissionError,
+                sqlite3.Error):
             return False
 
     def start(self) -> None:
         """Starts the server."""
 
+        self.start_watching()
         self.__sock_server.serve_forever()
 
     def stop(self) -> None:
         """Stops the server."""
 
+        self._stop_watching()
         self.__sock_server.shutdown()
         self.__sock_server.server_close()
+        if self.hot_cache is not None:
+            self.hot_cache.close()
+        if self.compressor is not None:
+            self.compressor.close()
+
+    def start_watching(self) -> None:
+        """Starts a thread that watches the library and wakes up the
+        clients watching the catalog when its version changes."""
+
+        threading.Thread(target=self.__watch_library, daemon=True).start()
+
+    def _stop_watching(self) -> None:
+        """Wakes up the clients watching the catalog, so they finish."""
+
+        with self.__changed:
+            self.__stopping = True
+            self.__changed.notify_all()
+
+    def __watch_library(self) -> None:
+        """Reconciles the catalog on every library change. Target of the
+        watching thread."""
+
+        while not self.__stopping:
+            changed, written = self.__watcher.wait(self.catalog.poll_interval)
+            try:
+                if written:
+                    self.library.update(written)
+                if changed:
+                    self.catalog.refresh(force=True)
+                version = self.library.version()
+            except (OSError, sqlite3.Error) as error:
+                logger.error("Watching the library has failed: %s", error)
+                continue
+            if version != self.version:
+                with self.__changed:
+                    self.version = version
+                    self.__changed.notify_all()
+                self._notify_change()
+
+    def _notify_change(self) -> None:
+        """Called after the catalog version has changed. Engines that
+        don't wait with wait_for_change() override it."""
+
+    def wait_for_change(self, version: int, timeout: float) -> bool:
+        """Waits until the catalog version is newer than the given one.
+
+        Args:
+            version: The catalog version the client has.
+            timeout: Maximum seconds to wait.
+
+        Returns:
+            True when there's a newer version, False when the timeout
+            has expired and None when the server is stopping.
+        """
+
+        with self.__changed:
+            self.__changed.wait_for(
+                lambda: self.version > version or self.__stopping, timeout)
+            if self.__stopping:
+                return None
+            return self.version > version
+
+    def open_connection(self) -> bool:
+        """Admits a new client connection. Called by the handlers, that
+        must call close_connection() when an admitted connection ends.
+
+        Returns:
+            False when the server already has max_connections open.
+        """
+
+        with self.__stats_lock:
+            if self.max_connections \
+                    and self.__open_connections >= self.max_connections:
+                self.rejected += 1
+                return False
+            self.__open_connections += 1
+            self.connections += 1
+            return True
+
+    def close_connection(self) -> None:
+        """Releases an admitted client connection."""
+
+        with self.__stats_lock:
+            self.__open_connections -= 1
+
+    def start_transfer(self) -> bool:
+        """Admits a new transfer. end_transfer() must be called when an
+        admitted transfer ends.
+
+        Returns:
+            False when max_transfers musics are already being sent.
+        """
+
+        with self.__stats_lock:
+            if self.max_transfers and self.__transfers >= self.max_transfers:
+                self.rejected += 1
+                return False
+            self.__transfers += 1
+            return True
+
+    def end_transfer(self) -> None:
+        """Releases an admitted transfer."""
+
+        with self.__stats_lock:
+            self.__transfers -= 1
+
+    def open_music(self, name: str):
+        """Opens a music, through the hot cache when there's one.
+
+        It may block while the music is copied to the cache.
+
+        Raises:
+            OSError: When the music can't be opened.
+        """
+
+        if self.hot_cache is None:
+            return open(name, "rb")
+        return self.hot_cache.open(name)
+
+    def stats(self) -> dict:
+        """Returns the server counters.
+
+        Returns:
+            A dict with the number of connections, the number of
+            rejections, the open connections and transfers, the metrics
+            snapshot, the catalog counters, prefixed by "catalog_", and
+            the hot cache counters, prefixed by "cache_", and the
+            compression counters, prefixed by "compression_".
+        """
+
+        with self.__stats_lock:
+            stats = {"connections": self.connections,
+                     "rejected": self.rejected,
+                     "open_connections": self.__open_connections,
+                     "transfers": self.__transfers}
+        stats.update(self.metrics.snapshot())
+        for key, value in self.catalog.stats().items():
+            stats[f"catalog_{key}"] = value
+        if self.hot_cache is not None:
+            for key, value in self.hot_cache.stats().items():
+                stats[f"cache_{key}"] = value
+        if self.compressor is not None:
+            for key, value in self.compressor.stats().items():
+                stats[f"compression_{key}"] = value
+        return stats
 
 
 class DataHandler(socketserver.BaseRequestHandler):
@@ -137,137 +529,161 @@ class DataHandler(socketserver.BaseRequestHandler):
 
     This is a subclass of socketserver.BaseRequestHandler, so some
     commands are overriden like the handle() method. It's inner workings
-    is command-based, so the main function is to execute procedures
-    according to already defined commands.
-
-    The following commands the class handles:
-
-        * --copy <any integer non-negative>
-        * --available
-        * --diff
-        * --automatic
-        * --raw-available
+    is command-based: the commands are executed by a CommandProcessor
+    and this class performs the resulting actions with blocking socket
+    calls.
 
     Methods:
         handle():
-            Handle the requests. It's overriden.
-
-        get_option():
-            Function that gets an option from command sent from the
-            client.
+            Handle the requests. It's overriden. Detects if the client
+            speaks the framed protocol or is a legacy client.
 
-        handle_client_commands():
-            Handle all the client commands.
+        handle_legacy():
+            Handle a legacy client that sends bare commands.
 
-        _send_music_file():
-            Sends the music binaries to the client.
+        handle_framed():
+            Handle a client that speaks the framed protocol.
 
-        _send_available():
-            Sends the available musics to the client.
-
-        _get_available():
-            Gets the available music on the directory the server is
-            working on.
+        perform(actions):
+            Performs the actions generated by a command.
     """
 
     def handle(self) -> None:
-        print(f"\033[;33m[*] CONNECTION AT {self.client_address}\033[m")
+        logger.debug("Connection at %s:%d", *self.client_address[:2])
+        music_server = self.server.music_server
+        # A client that connects and sends nothing, or stops in the
+        # middle of its HELLO, is dropped after the idle timeout too.
+        self.request.settimeout(music_server.idle_timeout)
+        try:
+            prefix = protocol.recv_exact(self.request, len(protocol.MAGIC))
+        except OSError:
+            return
+        framed = prefix == protocol.MAGIC
+        admitted = music_server.open_connection()
+        self.processor = CommandProcessor(music_server, self.client_address,
+                                          framed)
+        try:
+            if framed:
+                self.handle_framed(prefix, admitted)
+            elif admitted:
+                self.processor.log.debug("Legacy client detected.")
+                # Legacy clients keep their connection open between
+                # commands.
+                self.request.settimeout(None)
+                self.handle_legacy(prefix)
+            else:
+                self.perform(self.processor.busy())
+        except OSError:
+            pass
+        finally:
+            if admitted:
+                music_server.close_connection()
+
+    def handle_legacy(self, prefix: bytes) -> None:
+        """Handles a client that sends bare commands without framing.
+
+        Args:
+            prefix: The bytes already read from the first command.
+        """
+
+        msg = prefix
         while True:
             try:
-                msg = self.request.recv(4096)
-                if msg == b"":
+                chunk = self.request.recv(4096)
+                if chunk == b"":
                     break
-                self.handle_client_commands(msg)
+                self.perform(self.processor.execute(msg + chunk))
+                msg = b""
             except OSError:
                 # At this point, the client has disconnected the server.
                 # For now, I don't have a better solution.
                 break
 
-    @staticmethod
-    def get_option(msg) -> int:
-        """Gets the requested music option from the client message.
-
-        Args:
-            msg: The client message command string.
-
-        Returns:
-            The option integer inside the client request message.
-
-        Raises:
-            ValueError: When the command is not valid.
-        """
-
-        msg = msg.decode()
-        matches = re.match(r"--copy \d+", msg)
-        if matches:
-            return int(re.search(r"\d+", msg).group()) - 1
-        raise ValueError("Bad command.")
+    def handle_framed(self, prefix: bytes, admitted: bool = True) -> None:
+        """Handles a client that speaks the framed protocol.
 
-    def handle_client_commands(self, msg) -> None:
-        """Executes operations requested by the client.
+        The first frame must be a HELLO, which is answered with the
+        server protocol version, the session limits and the codecs the
+        music data may be compressed with. Then every COMMAND frame is
+        executed on the same connection until the client disconnects,
+        the session stays idle for longer than the idle timeout or the
+        maximum number of requests is served. A
+        connection that wasn't admitted gets a BUSY frame instead of the
+        server HELLO.
 
         Args:
-            msg: The client message command string.
+            prefix: The magic bytes already read from the first frame.
+            admitted: Whether the server has room for the connection.
         """
 
-        print(f"[*] Command Received -> {msg}")
-        if msg == b"--raw-available":
-            self._send_available()
-        elif b"--copy" in msg:
-            try:
-                option = DataHandler.get_option(msg)
-            except ValueError:
-                print("\033[;31m[*] BAD CLIENT PARAMETER.\033[m")
-                self.request.send(b"bad-parameter")
-            else:
-                print(f"[*] Requested Option: {option}")
-                self._send_music_file(option)
-            finally:
-                # Immediately close the client
-                self.request.shutdown(socket.SHUT_RDWR)
-                self.request.close()
-
-    def _send_music_file(self, option: int) -> None:
-        """Sends the music file to the client.
+        music_server = self.server.music_server
+        try:
+            header = prefix + protocol.recv_exact(
+                self.request, protocol.HEADER.size - len(prefix))
+            frame_type, length = protocol.unpack_header(header)
+            protocol.check_length(length)
+            payload = protocol.recv_exact(self.request, length)
+            if frame_type != protocol.HELLO:
+                self.perform(self.processor.error(b"bad-handshake"))
+                return
+            if not admitted:
+                self.perform(self.processor.busy())
+                return
+            protocol.send_frame(self.request, protocol.HELLO,
+                                self.processor.hello(payload))
+            max_requests = music_server.max_requests
+            served = 0
+            while not max_requests or served < max_requests:
+                frame_type, payload = protocol.recv_frame(self.request)
+                served += 1
+                if frame_type != protocol.COMMAND:
+                    self.perform(self.processor.error(b"bad-parameter"))
+                    continue
+                self.perform(self.processor.execute(payload))
+        except socket.timeout:
+            self.processor.log.debug("Idle session closed.")
+        except (OSError, protocol.ProtocolError):
+            # The client has disconnected or is speaking nonsense.
+            pass
+
+    def perform(self, actions) -> None:
+        """Performs the actions generated by a command.
 
         Args:
-            option: The choosen music option integer.
+            actions: A generator of actions from the CommandProcessor.
+
+        Raises:
+            OSError: When an action fails and the command doesn't
+                     handle the error.
         """
 
-        music_name = None
         try:
-            music_name = self._get_available()[option]
-            self.request.send(music_name.encode("utf8"))
-            with open(music_name, "rb") as music_file:
-                time.sleep(0.2)
-                print(f"\033[;33m[*] Sending {music_name}\033[m")
+            action = next(actions)
+            while True:
+                result = None
                 try:
-                    self.request.sendfile(music_file)
-                except BrokenPipeError:
-                    print(f"\033[;31m[*] Sending {music_name} has failed.\033[m")
+                    if action[0] == commands.SEND:
+                        self.request.sendall(action[1])
+                    elif action[0] == commands.SENDFILE:
+                        self.request.sendfile(*action[1:])
+                    elif action[0] == commands.SLEEP:
+                        time.sleep(action[1])
+                    elif action[0] == commands.CALL:
+                        result = action[1]()
+                    elif action[0] == commands.WAIT:
+                        result = self.server.music_server.wait_for_change(
+                            *action[1:])
+                    elif action[0] == commands.CLOSE:
+                        self.request.shutdown(socket.SHUT_RDWR)
+                        self.request.close()
+                except OSError as error:
+                    if isinstance(error, BrokenPipeError):
+                        self.server.music_server.metrics.broken_pipe()
+                    action = actions.throw(error)
                 else:
-                    print(f"\033[;92m[*] {music_name} sent.\033[m")
-        except IndexError:
-            self.request.send(b"not-available")
-
-    def _send_available(self) -> None:
-        """Sends all the available music on the server directory."""
-
-        print("\033[;36m[*] Sending raw string available music list\033[m")
-        available_musics = "|".join(DataHandler._get_available())
-        if bool(available_musics):
-            self.request.sendall(available_musics.encode())
-            print("\033[;96m[*] raw string available music list sent\033[m")
-            time.sleep(0.1)
-            self.request.send(b"end")
-        else:
-            self.request.send(b"not-available")
-
-    @staticmethod
-    def _get_available() -> list:
-        """Get all the available musics on the server computer."""
-
-        return list(filter(utils.is_music_file, os.listdir(".")))
+                    action = actions.send(result)
+        except StopIteration:
+            pass
 
 
 def main() -> None:
@@ -280,14 +696,121 @@ def main() -> None:
                            default=socket.gethostname())
     argparser.add_argument("-p", "--port", help="Server port", type=int,
                            default=random.randrange(1024, 65432))
+    argparser.add_argument("--index", help="SQLite database of the library "
+                           "index. A relative path is relative to LOCAL",
+                           type=str, default=None)
+    argparser.add_argument("--heartbeat", help="Seconds between two "
+                           "heartbeats sent to the clients watching the "
+                           "catalog", type=float, default=10.0)
+    argparser.add_argument("--engine", help="Server engine. threading uses "
+                           "a thread per client, asyncio serves every client "
+                           "on a single event loop", default="threading",
+                           choices=["threading", "asyncio"])
+    argparser.add_argument("--workers", help="Number of server processes "
+                           "sharing the port through SO_REUSEPORT", type=int,
+                           default=1)
+    argparser.add_argument("--idle-timeout", help="Seconds a client session "
+                           "may stay idle before being closed", type=float,
+                           default=30.0)
+    argparser.add_argument("--max-requests", help="Maximum number of "
+                           "requests served in one client session. 0 means "
+                           "unlimited", type=int, default=1000)
+    argparser.add_argument("--max-rate", help="Total upload cap in MiB/s, "
+                           "shared by the transfers in turns. 0 means "
+                           "unlimited", type=float, default=0)
+    argparser.add_argument("--max-client-rate", help="Upload cap of every "
+                           "client host in MiB/s. 0 means unlimited",
+                           type=float, default=0)
+    argparser.add_argument("--max-connections", help="Maximum number of "
+                           "open client connections. Other clients are told "
+                           "to retry later. 0 means unlimited", type=int,
+                           default=0)
+    argparser.add_argument("--max-transfers", help="Maximum number of musics "
+                           "being sent at once. Other requests are told to "
+                           "retry later. 0 means unlimited", type=int,
+                           default=0)
+    argparser.add_argument("--retry-after", help="Milliseconds a rejected "
+                           "client is told to wait before trying again",
+                           type=int, default=1000)
+    argparser.add_argument("--cache-size", help="Size in MiB of the local "
+                           "copies of the musics requested last, so a slow "
+                           "music directory is read once. 0 disables it",
+                           type=int, default=0)
+    argparser.add_argument("--cache-dir", help="Where the local copies are "
+                           "kept. Default the system temporary directory",
+                           type=str, default=None)
+    argparser.add_argument("--metrics-port", help="Serves the server metrics "
+                           "in the Prometheus text format on "
+                           "http://127.0.0.1:METRICS_PORT/metrics", type=int,
+                           default=None)
+    argparser.add_argument("--no-compression", help="Never compresses the "
+                           "WAV, PCM and AIFF musics, even for clients on "
+                           "slow links", action="store_true")
+    argparser.add_argument("--log-level", help="Log level. debug logs every "
+                           "connection and command", default="info",
+                           choices=list(log.LEVELS))
+    argparser.add_argument("--log-file", help="Appends the log to LOG_FILE "
+                           "instead of writing it to stderr",
+                           type=argparse.FileType("a"), default=None)
     args = argparser.parse_args()
+    log.setup(args.log_level, args.log_file)
+    # The worker processes share the bandwidth caps.
+    max_rate = args.max_rate * 1024 * 1024
+    max_client_rate = args.max_client_rate * 1024 * 1024
+    # Every worker process gets its share of the admission limits, at
+    # least one of each.
+    max_connections = args.max_connections and max(
+        1, args.max_connections // max(1, args.workers))
+    max_transfers = args.max_transfers and max(
+        1, args.max_transfers // max(1, args.workers))
+    cache_size = args.cache_size * 1024 * 1024 // max(1, args.workers)
+    server_class = MusicSenderServer
+    if args.engine == "asyncio":
+        from .aioserver import AsyncMusicSenderServer
+        server_class = AsyncMusicSenderServer
     server = None
     try:
-        server = MusicSenderServer((args.host, args.port), args.local)
-        if not server.set_ambient():
-            print("Bad path string or needs root.")
-            return
-        print("\033[;32m[*] Server Started.\033[m")
+        if args.workers > 1:
+            from .workers import WorkerSupervisor
+            server = WorkerSupervisor(server_class, (args.host, args.port),
+                                      args.local, args.workers,
+                                      idle_timeout=args.idle_timeout,
+                                      max_requests=args.max_requests,
+                                      index=args.index,
+                                      heartbeat=args.heartbeat,
+                                      max_rate=max_rate,
+                                      max_client_rate=max_client_rate,
+                                      max_connections=max_connections,
+                                      max_transfers=max_transfers,
+                                      retry_after=args.retry_after / 1000,
+                                      cache_size=cache_size,
+                                      cache_dir=args.cache_dir,
+                                      compression=not args.no_compression,
+                                      log_file=args.log_file
+                                      and args.log_file.name)
+            print(f"\033[;32m[*] Server Started with {args.workers} "
+                  "workers.\033[m")
+        else:
+            server = server_class((args.host, args.port), args.local,
+                                  args.idle_timeout, args.max_requests,
+                                  index=args.index, heartbeat=args.heartbeat,
+                                  max_rate=max_rate,
+                                  max_client_rate=max_client_rate,
+                                  max_connections=max_connections,
+                                  max_transfers=max_transfers,
+                                  retry_after=args.retry_after / 1000,
+                                  cache_size=cache_size,
+                                  cache_dir=args.cache_dir,
+                                  compression=not args.no_compression)
+            if not server.set_ambient():
+                print("Bad path string or needs root.")
+                return
+            print("\033[;32m[*] Server Started.\033[m")
+        if args.metrics_port is not None:
+            MetricsExporter(server.stats,
+                            ("127.0.0.1", args.metrics_port)).start()
+            print("\033[;32m[*] Metrics on http://127.0.0.1:"
+                  f"{args.metrics_port}/metrics\033[m")
         server.start()
     except ValueError:
         # Raised by the server.
@@ -299,3 +822,11 @@ def main() -> None:
         # When the user want to stop the server
         server.stop()
         print("\033[;32m\nServer shut and closed.\033[m")
+        stats = server.stats()
+        print("[*] Server stats: " + ", ".join(
+            f"{key}={value}" for key, value in stats.items()
+            if not isinstance(value, dict)))
+        for command, histogram in sorted(stats["commands"].items()):
+            mean = histogram["sum"] / histogram["count"] * 1000
+            print(f"[*] {command}: {histogram['count']} commands, "
+                  f"{mean:.1f} ms on average")
@@ -0,0 +1,184 @@
+"""Server bandwidth shaping.
+
+This module caps the rate at which the server sends music data, in
+total and to every client. Music data is sent in small chunks and every
+chunk reserves its share of the bandwidth before being sent, so the
+active transfers take turns and a single large transfer can't take the
+whole uplink. Control messages, like catalog answers, never wait for a
+reservation, so they go ahead of the music data.
+
+The worker processes of a server share their buckets through the
+shared memory of shared_state(), so the caps hold for the whole server
+and not for every worker.
+"""
+
+import multiprocessing
+import threading
+import time
+import zlib
+
+# Size of the chunks the music data is sent in when shaping
+CHUNK_SIZE = 64 * 1024
+# Client buckets of a shared state. Hosts whose hashes collide share a
+# bucket.
+CLIENT_SLOTS = 4096
+
+
+def shared_state(slots: int = CLIENT_SLOTS):
+    """Creates the bucket state shared by the worker processes.
+
+    Args:
+        slots: The number of client buckets.
+
+    Returns:
+        A multiprocessing Array with the total bucket and the client
+        buckets, to be given to the Shaper of every worker.
+    """
+
+    return multiprocessing.Array("d", 1 + slots)
+
+
+class TokenBucket:
+    """A rate limiter that hands out reservations in arrival order.
+
+    Every reservation moves the time the next byte may be sent forward,
+    so concurrent senders that reserve a chunk at a time are served in
+    turns, each getting a fair share of the rate.
+
+    Attributes:
+        rate: The rate in bytes per second.
+        burst: How many bytes may be sent at once after an idle time.
+
+    Methods:
+        reserve(size): Reserves the bandwidth of a chunk.
+        idle(): Returns whether nothing was reserved for a while.
+    """
+
+    def __init__(self, rate: float, burst: int = CHUNK_SIZE,
+                 state=None, slot: int = 0) -> None:
+        """Initializes an idle bucket.
+
+        Args:
+            rate: The rate in bytes per second.
+            burst: How many bytes may be sent at once after an idle
+                   time.
+            state: The shared_state() the bucket is kept in. None keeps
+                   it in this process.
+            slot: The position of the bucket in the shared state.
+        """
+
+        self.rate = rate
+        self.burst = burst
+        if state is None:
+            self.__state = [0.0]
+            self.__lock = threading.Lock()
+        else:
+            self.__state = state.get_obj()
+            self.__lock = state.get_lock()
+        self.__slot = slot
+
+    def reserve(self, size: int) -> float:
+        """Reserves the bandwidth of a chunk.
+
+        Args:
+            size: The chunk size in bytes.
+
+        Returns:
+            The seconds to wait before sending the chunk.
+        """
+
+        with self.__lock:
+            # The monotonic clock is the same for every process.
+            now = time.monotonic()
+            start = max(self.__state[self.__slot],
+                        now - self.burst / self.rate)
+            self.__state[self.__slot] = start + size / self.rate
+            return max(0.0, start - now)
+
+    def idle(self) -> bool:
+        """Returns whether nothing was reserved for a while."""
+
+        return self.__state[self.__slot] < time.monotonic() - 60.0
+
+
+class Shaper:
+    """The bandwidth limits of a server.
+
+    Attributes:
+        max_rate: The total rate cap in bytes per second. None means
+                  unlimited.
+        max_client_rate: The rate cap of every client host in bytes per
+                         second. None means unlimited.
+        chunk_size: The size of the chunks the music data is sent in.
+
+    Methods:
+        buckets(host): Returns the buckets a chunk sent to a host must
+                       reserve.
+    """
+
+    def __init__(self, max_rate: float = None, max_client_rate: float = None,
+                 chunk_size: int = CHUNK_SIZE, state=None) -> None:
+        """Initializes the limits.
+
+        Args:
+            max_rate: The total rate cap in bytes per second.
+            max_client_rate: The rate cap of every client host in bytes
+                             per second.
+            chunk_size: The size of the chunks the music data is sent
+                        in.
+            state: The shared_state() of the buckets, shared with the
+                   other worker processes. None keeps the buckets in
+                   this process.
+        """
+
+        self.max_rate = max_rate
+        self.max_client_rate = max_client_rate
+        self.chunk_size = chunk_size
+        self.__state = state
+        self.__total = None
+        if max_rate:
+            self.__total = TokenBucket(max_rate, chunk_size, state, 0)
+        self.__clients = {}
+        self.__lock = threading.Lock()
+
+    def buckets(self, host: str) -> [TokenBucket]:
+        """Returns the buckets a chunk sent to a host must reserve, the
+        client one first.
+
+        All the connections of a host share its bucket, so parallel
+        downloads don't get around the client cap, even when they are
+        served by different workers sharing the state.
+
+        Args:
+            host: The client host.
+
+        Returns:
+            A list with the TokenBuckets.
+        """
+
+        buckets = []
+        if self.max_client_rate:
+            with self.__lock:
+                bucket = self.__clients.get(host)
+                if bucket is None:
+                    if len(self.__clients) > 1024:
+                        # Forget the clients that went away.
+                        self.__clients = {
+                            key: value for key, value
+                            in self.__clients.items() if not value.idle()}
+                    bucket = TokenBucket(self.max_client_rate,
+                                         self.chunk_size, self.__state,
+                                         self.__slot(host))
+                    self.__clients[host] = bucket
+            buckets.append(bucket)
+        if self.__total is not None:
+            buckets.append(self.__total)
+        return buckets
+
+    def __slot(self, host: str) -> int:
+        """Returns the position of the bucket of a host in the shared
+        state. The hash is the same in every process."""
+
+        if self.__state is None:
+            return 0
+        return 1 + zlib.crc32(host.encode()) % (len(self.__state) - 1)
@@ -0,0 +1,464 @@
+"""Music Sender swarm engine.
+
+This module downloads a list of musics from many Music Sender servers
+with identical libraries, the mirrors, at once. Every mirror serves the
+musics its manifest has with the same content hash as the first one.
+"""
+
+import concurrent.futures
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from . import protocol, utils
+from .hashcache import hash_file
+from .sync import SyncResult
+
+logger = logging.getLogger(__name__)
+
+
+class Mirror:
+    """A server of the swarm.
+
+    Attributes:
+        address: The server host and port.
+        client: The MusicSenderClient the mirror was created from.
+        tracks: A dict with the manifest entry of every music name.
+        throughput: The measured download rate in bytes per second, as a
+                    moving average.
+        samples: How many transfers were measured.
+        failures: How many transfers in a row have failed.
+        served: How many bytes the mirror has sent.
+        alive: Whether the mirror is still used.
+    """
+
+    def __init__(self, client) -> None:
+        """Initializes a mirror with no measure.
+
+        Args:
+            client: A MusicSenderClient connected to the mirror.
+        """
+
+        self.address = client.address
+        self.client = client
+        self.tracks = {}
+        self.throughput = 0.0
+        self.samples = 0
+        self.failures = 0
+        self.served = 0
+        self.alive = True
+
+    def measure(self, size: int, elapsed: float) -> None:
+        """Adds a successful transfer to the throughput average."""
+
+        rate = size / max(elapsed, 1e-3)
+        if self.samples:
+            self.throughput = 0.7 * self.throughput + 0.3 * rate
+        else:
+            self.throughput = rate
+        self.samples += 1
+        self.failures = 0
+        self.served += size
+
+
+class Piece:
+    """A music, or a byte range of a large music, to be downloaded.
+
+    Attributes:
+        music: The dict with the state of the music.
+        offset: The first byte of the range, None for a whole music.
+        length: The number of bytes of the range.
+        attempts: How many times the piece was tried.
+    """
+
+    def __init__(self, music: dict, offset: int = None,
+                 length: int = None) -> None:
+        self.music = music
+        self.offset = offset
+        self.length = length
+        self.attempts = 0
+
+
+class SwarmEngine:
+    """Concurrent download engine over many mirrors.
+
+    The musics are split in pieces that the workers of every mirror take
+    from a shared queue, so a mirror gets new pieces as fast as it
+    serves them and the musics are spread across the mirrors in
+    proportion to their throughput. Large musics are split in byte
+    ranges, so even a single music is downloaded from every mirror.
+
+    A mirror is dropped, in the middle of the sync, after too many
+    failures in a row or when it's much slower than the fastest mirror.
+    Its pieces go back to the queue for the other mirrors.
+
+    Attributes:
+        mirrors: The Mirror of every server, the first one holds the
+                 reference manifest.
+        jobs: The number of concurrent downloads per mirror.
+        retries: How many times a failed piece is retried.
+        segment_size: The size in bytes of the ranges of a large music.
+        max_failures: How many failures in a row drop a mirror.
+        min_share: A mirror slower than this fraction of the fastest one
+                   is dropped.
+        timeout: Seconds without data before a transfer fails.
+        total: The number of musics of the current run.
+        done: How many musics of the current run were processed.
+        failed: How many musics of the current run have failed.
+        bytes_received: How many bytes were downloaded in the current
+                        run.
+
+    Methods:
+        run(musics): Downloads the musics and generates their results.
+        elapsed(): Returns the seconds since the run started.
+        throughput(): Returns the download rate in bytes per second.
+    """
+
+    def __init__(self, clients: list, jobs: int = 2, retries: int = 3,
+                 segment_size: int = 8 * 1024 * 1024, max_failures: int = 3,
+                 min_share: float = 0.1, timeout: float = 30.0) -> None:
+        """Initializes the engine.
+
+        Args:
+            clients: A MusicSenderClient with the ambient already set for
+                     every mirror. The first one is the reference.
+            jobs: The number of concurrent downloads per mirror.
+            retries: How many times a failed piece is retried.
+            segment_size: The size in bytes of the ranges of a large
+                          music.
+            max_failures: How many failures in a row drop a mirror.
+            min_share: A mirror slower than this fraction of the fastest
+                       one is dropped.
+            timeout: Seconds without data before a transfer fails.
+
+        Raises:
+            ValueError: When there's no client, jobs is lower than one
+                        or retries is negative.
+        """
+
+        if not clients:
+            raise ValueError("At least one mirror is needed.")
+        if jobs < 1:
+            raise ValueError("The number of jobs must be at least 1.")
+        if retries < 0:
+            raise ValueError("The number of retries can't be negative.")
+        self.mirrors = [Mirror(client) for client in clients]
+        self.jobs = jobs
+        self.retries = retries
+        self.segment_size = segment_size
+        self.max_failures = max_failures
+        self.min_share = min_share
+        self.timeout = timeout
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.bytes_received = 0
+        self.__started = None
+        self.__pieces = []
+        self.__remaining = 0
+        self.__stopping = False
+        self.__condition = threading.Condition()
+        self.__results = queue.SimpleQueue()
+
+    def elapsed(self) -> float:
+        """Returns the seconds since the current run started."""
+
+        if self.__started is None:
+            return 0.0
+        return time.monotonic() - self.__started
+
+    def throughput(self) -> float:
+        """Returns the download rate of the current run in bytes per
+        second."""
+
+        elapsed = self.elapsed()
+        return self.bytes_received / elapsed if elapsed else 0.0
+
+    def __load_manifest(self, mirror: Mirror) -> None:
+        """Gets the manifest of a mirror. A mirror whose manifest can't
+        be read is dropped."""
+
+        try:
+            mirror.client.ensure_session()
+            manifest = mirror.client.manifest()
+        except (OSError, protocol.ProtocolError):
+            manifest = None
+        if manifest is None:
+            mirror.alive = False
+            return
+        mirror.tracks = {entry["name"]: entry for entry in manifest
+                         if entry["name"] is not None}
+
+    def __plan(self, musics: [(int, str)]) -> None:
+        """Splits the musics in pieces and finds their mirrors."""
+
+        reference = self.mirrors[0]
+        by_id = {entry["id"]: entry for entry in reference.tracks.values()}
+        threshold = reference.client.segment_threshold
+        for code, name in musics:
+            entry = by_id.get(code)
+            if entry is None or entry["hash"] is None:
+                # Only the reference mirror is known to have the music.
+                sources = {reference: code}
+                size = entry["size"] if entry else None
+            else:
+                size = entry["size"]
+                sources = {}
+                for mirror in self.mirrors:
+                    track = mirror.tracks.get(entry["name"])
+                    if mirror.alive and track is not None \
+                            and track["hash"] == entry["hash"]:
+                        sources[mirror] = track["id"]
+            music = {"code": code, "name": name or "", "size": size,
+                     "hash": entry["hash"] if entry else None,
+                     "sources": sources, "left": 1, "finished": False,
+                     "attempts": 1}
+            if size and size >= threshold and len(sources) > 1 \
+                    and name and utils.safe_path(name):
+                ranges = range(0, size, self.segment_size)
+                music["left"] = len(ranges)
+                self.__pieces.extend(
+                    Piece(music, offset, min(self.segment_size,
+                                             size - offset))
+                    for offset in ranges)
+            else:
+                self.__pieces.append(Piece(music))
+
+    def __take(self, mirror: Mirror) -> Piece:
+        """Takes the next piece the mirror can serve.
+
+        Returns:
+            The piece, or None when the mirror was dropped or every
+            music is finished.
+        """
+
+        with self.__condition:
+            while mirror.alive and self.__remaining and not self.__stopping:
+                for i, piece in enumerate(self.__pieces):
+                    if piece.music["finished"]:
+                        del self.__pieces[i]
+                        break
+                    if mirror in piece.music["sources"]:
+                        del self.__pieces[i]
+                        return piece
+                else:
+                    self.__condition.wait()
+            return None
+
+    def __finish(self, music: dict, successful: bool) -> None:
+        """Reports the result of a music. Must hold the condition."""
+
+        if music["finished"]:
+            return
+        music["finished"] = True
+        self.__remaining -= 1
+        if not successful and music["left"] > 1:
+            # The ranges aren't contiguous, the download can't be resumed.
+            try:
+                os.remove(utils.safe_path(music["name"]) + ".part")
+            except (OSError, TypeError):
+                pass
+        size = music["size"] if successful else 0
+        self.__results.put(SyncResult(music["code"], music["name"],
+                                      successful, music["attempts"], size))
+        self.__condition.notify_all()
+
+    def __drop(self, mirror: Mirror, reason: str) -> None:
+        """Drops a mirror and fails the musics nobody else can serve.
+        Must hold the condition."""
+
+        mirror.alive = False
+        logger.warning("Mirror %s:%d dropped: %s.", mirror.address[0],
+                       mirror.address[1], reason)
+        for piece in self.__pieces:
+            if not any(source.alive for source in piece.music["sources"]):
+                self.__finish(piece.music, False)
+        self.__condition.notify_all()
+
+    def __needed(self, mirror: Mirror) -> bool:
+        """Checks whether a mirror is the only one left for a queued
+        piece. Must hold the condition."""
+
+        return any(
+            not any(source.alive for source in piece.music["sources"]
+                    if source is not mirror)
+            for piece in self.__pieces if mirror in piece.music["sources"])
+
+    def __fetch(self, client, mirror: Mirror, piece: Piece) -> bool:
+        """Downloads a piece from a mirror.
+
+        Returns:
+            Whether the piece was downloaded.
+        """
+
+        music = piece.music
+        track_id = music["sources"][mirror]
+        try:
+            client.ensure_session()
+            client.client.settimeout(self.timeout)
+        except (OSError, protocol.ProtocolError):
+            return False
+        if piece.offset is None:
+            name, successful = client.copy(track_id, music["name"] or None)
+            if successful:
+                music["name"] = name
+                music["size"] = os.path.getsize(name)
+            return successful
+        name = utils.safe_path(music["name"])
+        with self.__condition:
+            if not music.get("allocated"):
+                try:
+                    directory = os.path.dirname(name)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    with open(name + ".part", "wb") as music_file:
+                        utils.preallocate(music_file.fileno(),
+                                          music["size"])
+                except OSError:
+                    return False
+                music["allocated"] = True
+        received = client.copy_range(track_id, name, music["size"],
+                                     piece.offset, piece.length)
+        return received == piece.length
+
+    def __complete(self, music: dict) -> bool:
+        """Checks the content hash of a music downloaded in ranges and
+        replaces the music by it."""
+
+        name = utils.safe_path(music["name"])
+        try:
+            if hash_file(name + ".part") != music["hash"]:
+                return False
+            os.replace(name + ".part", name)
+            # The first client keeps the hashes of the client directory.
+            self.mirrors[0].client.hashes.store(name, music["hash"])
+        except OSError:
+            return False
+        return True
+
+    def __work(self, mirror: Mirror, client) -> None:
+        """Downloads pieces from a mirror until there's nothing left for
+        it. Target of the worker threads.
+
+        An unexpected error is handed to run(), which raises it.
+        """
+
+        try:
+            self.__serve(mirror, client)
+        except Exception as error:
+            self.__results.put(error)
+
+    def __serve(self, mirror: Mirror, client) -> None:
+        """Downloads pieces from a mirror until there's nothing left for
+        it."""
+
+        while True:
+            piece = self.__take(mirror)
+            if piece is None:
+                return
+            started = time.monotonic()
+            try:
+                successful = self.__fetch(client, mirror, piece)
+            except (OSError, ValueError, KeyError, protocol.ProtocolError):
+                # Like an answer the mirror shouldn't have sent.
+                successful = False
+            elapsed = time.monotonic() - started
+            music = piece.music
+            with self.__condition:
+                piece.attempts += 1
+                music["attempts"] = max(music["attempts"], piece.attempts)
+                if successful:
+                    mirror.measure(piece.length or music["size"] or 0,
+                                   elapsed)
+                    music["left"] -= 1
+                    completed = not music["left"]
+                else:
+                    client.client.close()
+                    mirror.failures += 1
+                    completed = False
+                    if piece.attempts > self.retries or not any(
+                            source.alive for source in music["sources"]):
+                        self.__finish(music, False)
+                    elif not music["finished"]:
+                        self.__pieces.append(piece)
+                        self.__condition.notify_all()
+                    if mirror.failures >= self.max_failures:
+                        self.__drop(mirror, "too many failures")
+                fastest = max(other.throughput for other in self.mirrors
+                              if other.alive)
+                alive = sum(other.alive for other in self.mirrors)
+                if alive > 1 and mirror.alive and mirror.samples >= 3 \
+                        and mirror.throughput < self.min_share * fastest \
+                        and not self.__needed(mirror):
+                    self.__drop(mirror, "too slow")
+            if completed:
+                if piece.offset is not None:
+                    successful = self.__complete(music)
+                with self.__condition:
+                    self.__finish(music, successful)
+            elif not successful:
+                time.sleep(min(8.0, 0.5 * 2 ** mirror.failures)
+                           * random.uniform(0.5, 1.0))
+
+    def run(self, musics: [(int, str)]) -> SyncResult:
+        """Downloads the given musics.
+
+        Args:
+            musics: Tuples with the music code on the reference mirror
+                    and the expected name of the musics.
+
+        Yields:
+            A SyncResult for every music, in completion order.
+
+        Raises:
+            ProtocolError: When the first mirror has no manifest.
+            Exception: The unexpected error of a worker thread, once the
+                       other workers have stopped.
+        """
+
+        musics = [music if isinstance(music, tuple) else (music, None)
+                  for music in musics]
+        self.total = len(musics)
+        self.done = 0
+        self.failed = 0
+        self.bytes_received = 0
+        self.__started = time.monotonic()
+        self.__pieces = []
+        self.__stopping = False
+        with concurrent.futures.ThreadPoolExecutor(len(self.mirrors)) \
+                as executor:
+            list(executor.map(self.__load_manifest, self.mirrors))
+        if not self.mirrors[0].alive:
+            raise protocol.ProtocolError("The first mirror has no manifest.")
+        self.__plan(musics)
+        self.__remaining = len(musics)
+        workers = []
+        for mirror in self.mirrors:
+            if not mirror.alive:
+                continue
+            for _ in range(self.jobs):
+                client = mirror.client.clone()
+                # The swarm splits the large musics itself.
+                client.segments = 1
+                workers.append((mirror, client))
+        with concurrent.futures.ThreadPoolExecutor(len(workers)) as executor:
+            for mirror, client in workers:
+                executor.submit(self.__work, mirror, client)
+            while self.done < self.total:
+                result = self.__results.get()
+                if isinstance(result, Exception):
+                    # The pieces of the failed worker would never be
+                    # finished, the others stop after their current one.
+                    with self.__condition:
+                        self.__stopping = True
+                        self.__condition.notify_all()
+                    raise result
+                self.done += 1
+                if result.successful:
+                    self.bytes_received += result.size
+                else:
+                    self.failed += 1
+                yield result
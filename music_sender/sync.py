@@ -0,0 +1,257 @@
+"""Music Sender sync engine.
+
+This module downloads a list of musics concurrently from a Music Sender
+server, keeping one server connection per worker thread.
+"""
+
+import collections
+import concurrent.futures
+import os
+import queue
+import random
+import time
+
+from . import protocol
+
+SyncResult = collections.namedtuple(
+    "SyncResult", ["code", "name", "successful", "attempts", "size"])
+
+
+class SyncEngine:
+    """Concurrent download engine.
+
+    The engine runs a pool of worker threads. Every worker owns a
+    MusicSenderClient, so every worker keeps its own session with the
+    server. The first worker reuses the client given to the engine.
+
+    A failed download is retried by the same worker after an exponential
+    backoff, up to a maximum number of retries, so a single bad file
+    can't keep the sync looping forever.
+
+    New downloads are grouped in batches that are requested with a
+    single --copy-many, so a whole album arrives on one stream. Musics
+    with a partial download or an outdated copy are requested one by
+    one, so they can be resumed or only their changes are sent, and so
+    are the large musics that are downloaded in segments and the
+    retries of a failed batch.
+
+    Attributes:
+        client: The MusicSenderClient the engine was created from.
+        jobs: The number of concurrent downloads.
+        retries: How many times a failed download is retried.
+        backoff: The delay in seconds before the first retry. It doubles
+                 on every new retry.
+        max_backoff: The maximum delay in seconds between two retries.
+        batch: How many new musics are requested at once.
+        total: The number of musics of the current run.
+        done: How many musics of the current run were processed.
+        failed: How many musics of the current run have failed.
+        bytes_received: How many bytes were downloaded in the current
+                        run.
+
+    Methods:
+        run(musics): Downloads the musics and generates their results.
+        delay(attempt): Returns the backoff delay of an attempt.
+        elapsed(): Returns the seconds since the run started.
+        throughput(): Returns the download rate in bytes per second.
+    """
+
+    def __init__(self, client, jobs: int = 1, retries: int = 3,
+                 backoff: float = 0.5, max_backoff: float = 8.0,
+                 batch: int = 1) -> None:
+        """Initializes the engine.
+
+        Args:
+            client: A MusicSenderClient with the ambient already set.
+            jobs: The number of concurrent downloads.
+            retries: How many times a failed download is retried.
+            backoff: The delay in seconds before the first retry.
+            max_backoff: The maximum delay in seconds between retries.
+            batch: How many new musics are requested at once.
+
+        Raises:
+            ValueError: When jobs or batch is lower than one or retries
+                        is negative.
+        """
+
+        if jobs < 1:
+            raise ValueError("The number of jobs must be at least 1.")
+        if retries < 0:
+            raise ValueError("The number of retries can't be negative.")
+        if batch < 1:
+            raise ValueError("The batch size must be at least 1.")
+        self.client = client
+        self.jobs = jobs
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.batch = batch
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.bytes_received = 0
+        self.__started = None
+        self.__clients = queue.SimpleQueue()
+        self.__clients.put(client)
+        for _ in range(jobs - 1):
+            self.__clients.put(client.clone())
+
+    def delay(self, attempt: int) -> float:
+        """Returns the backoff delay after a failed attempt.
+
+        A random jitter is applied, so workers that failed together
+        don't retry together.
+
+        Args:
+            attempt: The one-based number of the failed attempt.
+
+        Returns:
+            The delay in seconds.
+        """
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def elapsed(self) -> float:
+        """Returns the seconds since the current run started."""
+
+        if self.__started is None:
+            return 0.0
+        return time.monotonic() - self.__started
+
+    def throughput(self) -> float:
+        """Returns the download rate of the current run in bytes per
+        second."""
+
+        elapsed = self.elapsed()
+        return self.bytes_received / elapsed if elapsed else 0.0
+
+    def _download(self, code: int, name: str = None,
+                  first_attempt: int = 1) -> SyncResult:
+        """Downloads a music using a free worker client.
+
+        Args:
+            code: The music code on the server catalog.
+            name: The expected music name. Used to resume partial
+                  downloads.
+            first_attempt: The number of the first attempt. Greater than
+                           one when the music has already failed in a
+                           batch.
+
+        Returns:
+            The SyncResult of the download.
+        """
+
+        client = self.__clients.get()
+        try:
+            music_name = name or ""
+            attempt = first_attempt
+            for attempt in range(first_attempt, self.retries + 2):
+                try:
+                    client.ensure_session()
+                except (OSError, protocol.ProtocolError):
+                    successful = False
+                else:
+                    music_name, successful = client.copy(code, name)
+                if successful:
+                    return SyncResult(code, music_name, True, attempt,
+                                      os.path.getsize(music_name))
+                # The session state is unknown after a failed transfer.
+                client.client.close()
+                if attempt <= self.retries:
+                    time.sleep(self.delay(attempt))
+            return SyncResult(code, music_name, False, attempt, 0)
+        finally:
+            self.__clients.put(client)
+
+    def _download_batch(self, musics: [(int, str)]) -> [SyncResult]:
+        """Downloads many musics on a single stream using a free worker
+        client. The musics that fail are downloaded again one by one.
+
+        Args:
+            musics: Tuples with the music code on the server catalog and
+                    the expected music name.
+
+        Returns:
+            The SyncResults of the downloads.
+        """
+
+        results = []
+        failed = []
+        client = self.__clients.get()
+        try:
+            try:
+                client.ensure_session()
+            except (OSError, protocol.ProtocolError):
+                client.client.close()
+                streamed = [("", False)] * len(musics)
+            else:
+                streamed = client.copy_many([code for code, _ in musics])
+            for (code, name), (music_name, successful) in zip(musics,
+                                                              streamed):
+                if successful:
+                    results.append(SyncResult(code, music_name, True, 1,
+                                              os.path.getsize(music_name)))
+                else:
+                    failed.append((code, name))
+        finally:
+            self.__clients.put(client)
+        for code, name in failed:
+            if not self.retries:
+                results.append(SyncResult(code, name or "", False, 1, 0))
+                continue
+            time.sleep(self.delay(1))
+            results.append(self._download(code, name, first_attempt=2))
+        return results
+
+    def run(self, musics: [(int, str)]) -> SyncResult:
+        """Downloads the given musics.
+
+        Args:
+            musics: The music codes on the server catalog, or tuples
+                    with the code and the expected name of the musics.
+                    Partial downloads can only be resumed and outdated
+                    copies updated when the name is given, and only new
+                    musics that aren't segmented are batched.
+
+        Yields:
+            A SyncResult for every music, in completion order.
+        """
+
+        musics = [music if isinstance(music, tuple) else (music, None)
+                  for music in musics]
+        self.total = len(musics)
+        self.done = 0
+        self.failed = 0
+        self.bytes_received = 0
+        self.__started = time.monotonic()
+        single = []
+        batched = []
+        for code, name in musics:
+            local = name and (os.path.exists(name + ".part")
+                              or os.path.exists(name))
+            if self.batch > 1 and not local \
+                    and not self.client.should_segment(code, name):
+                batched.append((code, name))
+            else:
+                single.append((code, name))
+        # Smaller batches when there are few musics, so every job gets
+        # some of them.
+        size = max(1, min(self.batch, -(-len(batched) // self.jobs)))
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            futures = [executor.submit(self._download_batch,
+                                       batched[i:i + size])
+                       for i in range(0, len(batched), size)]
+            futures.extend(executor.submit(self._download, code, name)
+                           for code, name in single)
+            for future in concurrent.futures.as_completed(futures):
+                results = future.result()
+                if isinstance(results, SyncResult):
+                    results = [results]
+                for result in results:
+                    self.done += 1
+                    if result.successful:
+                        self.bytes_received += result.size
+                    else:
+                        self.failed += 1
+                    yield result
@@ -1,5 +1,8 @@
 """Utilities functions."""
 
+import os
+
+
 # Filters
 def is_music_file(filename):
     """Returns a True if the filename is a music file."""
@@ -10,3 +13,58 @@ def is_music_file(filename):
     ]
     is_music = [filename.endswith(extension) for extension in files_extensions]
     return any(is_music)
+
+
+# Files
+def preallocate(fd, size):
+    """Reserves size bytes on disk for the file descriptor fd.
+
+    Falls back to just setting the file size on systems or filesystems
+    that don't support preallocation.
+    """
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+
+def walk_music(path="."):
+    """Lists the music files under path and its subdirectories.
+
+    Hidden directories are skipped. The names are relative to path and
+    use "/" as separator, like the server library index.
+    """
+    musics = []
+    pending = [""]
+    while pending:
+        directory = pending.pop()
+        prefix = directory + "/" if directory else ""
+        try:
+            with os.scandir(os.path.join(path, directory)) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith("."):
+                            pending.append(prefix + entry.name)
+                    elif is_music_file(entry.name):
+                        musics.append(prefix + entry.name)
+        except OSError:
+            continue
+    return sorted(musics)
+
+
+def safe_path(name):
+    """Returns name as a local relative path, or None if it would point
+    outside the current directory.
+
+    Server names use "/" as separator and may have subdirectories, like
+    "Artist/Album/Track.mp3".
+    """
+    parts = name.replace("\\", "/").split("/")
+    if not name or name.startswith("/") or any(
+            part in ("", ".", "..") for part in parts):
+        return None
+    if os.path.splitdrive(parts[0])[0]:
+        return None
+    return os.path.join(*parts)
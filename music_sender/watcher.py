@@ -0,0 +1,229 @@
+"""Library change watchers.
+
+This module tells a server when its music library may have changed, so
+the catalog is reconciled right away instead of on the next poll. On
+Linux the library directories are watched with inotify, through ctypes.
+Everywhere else, or when inotify can't be used, the library is polled.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+# inotify event masks, from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ATTRIB
+              | IN_ONLYDIR)
+EVENT = struct.Struct("iIII")
+
+
+class PollingWatcher:
+    """A watcher that doesn't know when the library changes.
+
+    Every wait() lasts the whole timeout and reports a possible change,
+    so the caller reconciles its catalog once per timeout.
+
+    Methods:
+        wait(timeout): Waits for a possible library change.
+        close(): Releases the watcher.
+    """
+
+    def wait(self, timeout: float) -> (bool, set):
+        """Waits for a possible library change.
+
+        Args:
+            timeout: Seconds to wait.
+
+        Returns:
+            A tuple with True and an empty set.
+        """
+
+        time.sleep(timeout)
+        return True, set()
+
+    def close(self) -> None:
+        """Releases the watcher."""
+
+
+class InotifyWatcher:
+    """A watcher backed by Linux inotify.
+
+    Every directory of the library is watched, except hidden ones, and
+    new directories are watched as soon as they are created.
+
+    Attributes:
+        path: The library root directory.
+        settle: Seconds without events before a burst of events, like a
+                file being copied, is reported.
+
+    Methods:
+        wait(timeout): Waits for a library change.
+        close(): Closes the inotify descriptor.
+    """
+
+    def __init__(self, path: str = ".", settle: float = 0.2) -> None:
+        """Starts watching the library.
+
+        Args:
+            path: The library root directory.
+            settle: Seconds without events before a burst is reported.
+
+        Raises:
+            OSError: When inotify isn't available.
+        """
+
+        self.path = path
+        self.settle = settle
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                  use_errno=True)
+        self.__fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.__fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.__directories = {}
+        try:
+            self.__watch_tree("")
+        except OSError:
+            os.close(self.__fd)
+            raise
+
+    def __watch_tree(self, directory: str) -> None:
+        """Watches a directory and its subdirectories.
+
+        Raises:
+            OSError: When a directory can't be watched, like when the
+                     user watch limit is reached.
+        """
+
+        pending = [directory]
+        while pending:
+            directory = pending.pop()
+            full_path = os.path.join(self.path, directory)
+            wd = self.__libc.inotify_add_watch(
+                self.__fd, os.fsencode(full_path), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOENT:
+                    # Removed before it was watched.
+                    continue
+                raise OSError(error, os.strerror(error), full_path)
+            self.__directories[wd] = directory
+            try:
+                with os.scandir(full_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False) \
+                                and not entry.name.startswith("."):
+                            pending.append(os.path.join(directory,
+                                                        entry.name))
+            except OSError:
+                continue
+
+    def __read_events(self, written: set) -> bool:
+        """Reads the pending events.
+
+        Args:
+            written: A set where the paths of the files written in place
+                     are added.
+
+        Returns:
+            True whether the library has changed.
+        """
+
+        changed = False
+        while True:
+            try:
+                data = os.read(self.__fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                name = os.fsdecode(name)
+                directory = self.__directories.get(wd)
+                if mask & IN_IGNORED:
+                    self.__directories.pop(wd, None)
+                    continue
+                if mask & IN_Q_OVERFLOW:
+                    changed = True
+                    continue
+                if directory is None or name.startswith("."):
+                    continue
+                path = os.path.join(directory, name) if name else directory
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self.__watch_tree(path)
+                    except OSError:
+                        pass
+                if mask & (IN_CLOSE_WRITE | IN_ATTRIB) \
+                        and not mask & IN_ISDIR:
+                    written.add(path.replace(os.sep, "/"))
+                changed = True
+
+    def wait(self, timeout: float) -> (bool, set):
+        """Waits for a library change.
+
+        Args:
+            timeout: Maximum seconds to wait.
+
+        Returns:
+            A tuple with whether the library has changed and a set with
+            the paths of the files that were written, with "/" as the
+            separator, like the library index paths.
+        """
+
+        written = set()
+        readable, _, _ = select.select([self.__fd], [], [], timeout)
+        if not readable:
+            return False, written
+        changed = self.__read_events(written)
+        # Let a burst of events, like a file being copied, settle.
+        deadline = time.monotonic() + 10 * self.settle
+        while time.monotonic() < deadline:
+            readable, _, _ = select.select([self.__fd], [], [], self.settle)
+            if not readable:
+                break
+            changed = self.__read_events(written) or changed
+        return changed, written
+
+    def close(self) -> None:
+        """Closes the inotify descriptor."""
+
+        os.close(self.__fd)
+
+
+def create_watcher(path: str = "."):
+    """Returns the best watcher available for a library.
+
+    Args:
+        path: The library root directory.
+
+    Returns:
+        An InotifyWatcher, or a PollingWatcher when inotify can't be
+        used.
+    """
+
+    try:
+        return InotifyWatcher(path)
+    except (OSError, AttributeError, TypeError):
+        # Not Linux, no libc or too many directories to watch.
+        return PollingWatcher()
@@ -0,0 +1,248 @@
+"""Music Sender worker processes.
+
+This module runs a Music Sender server on several processes. Every
+worker binds the same address with SO_REUSEPORT, so the kernel balances
+the client connections between them and every worker runs on its own
+core, with its own interpreter lock.
+
+A supervisor process reconciles the library index and publishes the
+catalog to a memory-mapped index file shared by all the workers, so the
+workers never scan the directory themselves. The workers open the same
+library database only to read and store content hashes. The supervisor also
+restarts the workers that crash and combines their counters. The
+bandwidth caps are kept in shared memory, so they hold for all the
+workers together.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+from . import log, shaping
+from .catalog import MusicCatalog, SharedCatalog, write_index
+from .library import LibraryIndex
+from .metrics import combine
+from .watcher import create_watcher
+
+logger = logging.getLogger(__name__)
+# Worker exit codes
+BAD_ADDRESS = 2
+BAD_AMBIENT = 3
+
+
+def run_worker(server_class, address: (str, int), local: str,
+               options: dict, index_path: str, stats_queue,
+               report_interval: float, log_file: str = None,
+               shaping_state=None) -> None:
+    """Runs a server worker. Target of the worker processes.
+
+    Args:
+        server_class: The MusicSenderServer class of the engine.
+        address: The address shared by all the workers.
+        local: The music directory path.
+        options: Extra keyword arguments for the server.
+        index_path: The catalog index file published by the supervisor.
+        stats_queue: A multiprocessing queue where the worker reports
+                     its counters.
+        report_interval: Seconds between two reports.
+        log_file: The file the log is appended to. None writes it to
+                  stderr.
+        shaping_state: The bandwidth buckets shared by the workers.
+    """
+
+    # The log writer thread of the supervisor isn't in this process, so
+    # the worker opens the log file again and writes with its own.
+    stream = None
+    if log_file is not None:
+        try:
+            stream = open(log_file, "a")
+        except OSError:
+            sys.exit(BAD_AMBIENT)
+    log.setup(logging.getLogger(log.LOGGER).getEffectiveLevel(), stream)
+    try:
+        server = server_class(address, local, reuse_port=True,
+                              catalog=SharedCatalog(index_path),
+                              shaping_state=shaping_state, **options)
+    except (ValueError, OSError):
+        sys.exit(BAD_ADDRESS)
+    if not server.set_ambient():
+        sys.exit(BAD_AMBIENT)
+
+    def report() -> None:
+        while True:
+            time.sleep(report_interval)
+            stats_queue.put((os.getpid(), server.stats()))
+
+    threading.Thread(target=report, daemon=True).start()
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+    finally:
+        stats_queue.put((os.getpid(), server.stats()))
+
+
+class WorkerSupervisor:
+    """Starts, watches and stops the server worker processes.
+
+    Attributes:
+        workers: The number of worker processes.
+        restarts: How many workers were restarted after a crash.
+        catalog: The MusicCatalog reconciled by the supervisor.
+
+    Methods:
+        start(): Starts the workers and supervises them until stopped.
+        stop(): Stops the workers.
+        stats(): Returns the combined counters of the workers.
+    """
+
+    def __init__(self, server_class, address: (str, int), local: str,
+                 workers: int, poll_interval: float = 1.0,
+                 report_interval: float = 5.0, log_file: str = None,
+                 **options) -> None:
+        """Initializes the supervisor.
+
+        Args:
+            server_class: The MusicSenderServer class of the engine.
+            address: The address shared by all the workers.
+            local: The music directory path.
+            workers: The number of worker processes.
+            poll_interval: Seconds between two checks of the workers and
+                           of the music directory.
+            report_interval: Seconds between two counter reports of a
+                             worker.
+            log_file: The file path the workers append their log to.
+                      None writes it to stderr.
+            options: Extra keyword arguments for the servers.
+        """
+
+        self.workers = workers
+        self.restarts = 0
+        self.catalog = None
+        self.__server_class = server_class
+        self.__address = address
+        self.__local = os.path.abspath(local)
+        self.__poll_interval = poll_interval
+        self.__report_interval = report_interval
+        # The supervisor changes its directory before the workers start.
+        self.__log_file = log_file and os.path.abspath(log_file)
+        # The bandwidth caps hold for all the workers together.
+        self.__shaping_state = None
+        if options.get("max_rate") or options.get("max_client_rate"):
+            self.__shaping_state = shaping.shared_state()
+        self.__options = options
+        self.__processes = []
+        self.__stats = {}
+        # The counters are drained by the supervisor loop and by the
+        # threads calling stats(), like the metrics exporter.
+        self.__stats_lock = threading.Lock()
+        self.__stats_queue = multiprocessing.Queue()
+        self.__index_dir = None
+        self.__index_path = None
+        self.__stopping = False
+
+    def __spawn(self) -> multiprocessing.Process:
+        """Starts a new worker process."""
+
+        process = multiprocessing.Process(
+            target=run_worker, daemon=True,
+            args=(self.__server_class, self.__address, self.__local,
+                  self.__options, self.__index_path, self.__stats_queue,
+                  self.__report_interval, self.__log_file,
+                  self.__shaping_state))
+        process.start()
+        return process
+
+    def __drain(self) -> None:
+        """Reads the pending counter reports of the workers."""
+
+        with self.__stats_lock:
+            while True:
+                try:
+                    pid, stats = self.__stats_queue.get_nowait()
+                except queue.Empty:
+                    return
+                self.__stats[pid] = stats
+
+    def start(self) -> None:
+        """Publishes the catalog, starts the workers and supervises them
+        until stop() is called.
+
+        Raises:
+            ValueError: When the workers can't bind the address.
+            OSError: When the music directory can't be used.
+        """
+
+        os.chdir(self.__local)
+        # The library is watched before the catalog is built, so the
+        # changes made meanwhile aren't missed.
+        watcher = create_watcher()
+        self.catalog = MusicCatalog(poll_interval=0, index=LibraryIndex(
+            filename=self.__options.get("index")))
+        self.catalog.build()
+        self.__index_dir = tempfile.mkdtemp(prefix="music_sender_")
+        self.__index_path = os.path.join(self.__index_dir, "catalog.idx")
+        generation = 1
+        write_index(self.__index_path, self.catalog.entries(), generation)
+        self.__processes = [self.__spawn() for _ in range(self.workers)]
+        while not self.__stopping:
+            changed, written = watcher.wait(self.__poll_interval)
+            if written:
+                self.catalog.index.update(written)
+            if changed and self.catalog.refresh():
+                generation += 1
+                write_index(self.__index_path, self.catalog.entries(),
+                            generation)
+            self.__drain()
+            for i, process in enumerate(self.__processes):
+                if process.is_alive() or self.__stopping:
+                    continue
+                if process.exitcode == BAD_ADDRESS:
+                    self.stop()
+                    raise ValueError(f"Address {self.__address} can't be "
+                                     "used.")
+                if process.exitcode == BAD_AMBIENT:
+                    self.stop()
+                    raise OSError(f"{self.__local} can't be used.")
+                logger.error("Worker %d exited with code %s. Restarting it.",
+                             process.pid, process.exitcode)
+                self.restarts += 1
+                self.__processes[i] = self.__spawn()
+
+    def stop(self) -> None:
+        """Stops the workers, collecting their last counters."""
+
+        self.__stopping = True
+        for process in self.__processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in self.__processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.__drain()
+        if self.__index_dir is not None:
+            shutil.rmtree(self.__index_dir, ignore_errors=True)
+
+    def stats(self) -> dict:
+        """Returns the combined counters of the workers.
+
+        Returns:
+            A dict with the sum of every worker counter, the number of
+            workers and how many of them were restarted.
+        """
+
+        self.__drain()
+        with self.__stats_lock:
+            reports = list(self.__stats.values())
+        combined = {"workers": self.workers, "restarts": self.restarts}
+        combined.update(combine(reports))
+        return combined
@@ -0,0 +1,217 @@
+"""Loopback servers for the tests.
+
+A server changes its working directory to its music directory, and so
+does a client, so every test server runs in its own process, like in
+the benchmarks. The tests talk to it through a real loopback socket.
+"""
+
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import unittest
+
+from music_sender import log
+from music_sender.aioserver import AsyncMusicSenderServer
+from music_sender.client import MusicSenderClient
+from music_sender.server import MusicSenderServer
+from music_sender.workers import WorkerSupervisor
+
+HOST = "127.0.0.1"
+
+
+class LoopbackClient(MusicSenderClient):
+    """A MusicSenderClient that accepts the loopback address."""
+
+    HOST_PATTERN = r"127\.0\.0\.1"
+
+
+class LoopbackServer(MusicSenderServer):
+    """A MusicSenderServer that accepts the loopback address."""
+
+    HOST_PATTERN = r"127\.0\.0\.1"
+
+
+class AsyncLoopbackServer(AsyncMusicSenderServer):
+    """An AsyncMusicSenderServer that accepts the loopback address."""
+
+    HOST_PATTERN = r"127\.0\.0\.1"
+
+
+ENGINES = {
+    "threading": LoopbackServer,
+    "asyncio": AsyncLoopbackServer,
+}
+
+
+def serve(engine: str, port: int, local: str, options: dict,
+          workers: int = 1, log_file: str = None,
+          log_level: str = "warning") -> None:
+    """Runs a server engine on loopback, or a WorkerSupervisor of it
+    when there are more workers. Target of the server process."""
+
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+    log.setup(log_level, log_file and open(log_file, "a"))
+    if workers > 1:
+        server = WorkerSupervisor(ENGINES[engine], (HOST, port), local,
+                                  workers, poll_interval=0.2,
+                                  report_interval=0.2, log_file=log_file,
+                                  **options)
+    else:
+        server = ENGINES[engine]((HOST, port), local, **options)
+        if not server.set_ambient():
+            raise SystemExit(1)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+def free_port() -> int:
+    """Returns a free loopback port."""
+
+    with socket.socket() as probe:
+        probe.bind((HOST, 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_port(address: (str, int), timeout: float = 10.0) -> None:
+    """Waits until a server accepts connections on the address.
+
+    Raises:
+        TimeoutError: When the server isn't up after the timeout.
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(address, timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"No server on {address}.")
+            time.sleep(0.02)
+
+
+def wait_until(condition, timeout: float = 10.0) -> bool:
+    """Polls a condition until it's true or the timeout expires.
+
+    Returns:
+        The last value of the condition.
+    """
+
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return condition()
+        time.sleep(0.05)
+    return True
+
+
+class LoopbackTestCase(unittest.TestCase):
+    """Serves a temporary music library on loopback.
+
+    The library is written by make_library() before the server starts.
+    Subclasses pick the server with ENGINE and its keyword arguments
+    with OPTIONS, or start it themselves in setUpServer().
+
+    Attributes:
+        library: The music directory of the server.
+        local: The working directory of the clients.
+        address: The server address.
+    """
+
+    ENGINE = "threading"
+    OPTIONS = {}
+
+    def setUp(self):
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        work = tempfile.mkdtemp(prefix="music_sender_test_")
+        self.addCleanup(shutil.rmtree, work, ignore_errors=True)
+        self.library = os.path.join(work, "library")
+        self.local = os.path.join(work, "client")
+        os.makedirs(self.library)
+        os.makedirs(self.local)
+        self.make_library()
+        self.address = (HOST, free_port())
+        self.setUpServer()
+
+    def setUpServer(self) -> None:
+        """Starts the server of every test."""
+
+        self.start_server()
+
+    def make_library(self) -> None:
+        """Writes the musics of the library. Overridden by the tests."""
+
+    def write(self, name: str, data: bytes) -> None:
+        """Writes a music into the library."""
+
+        path = os.path.join(self.library, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as music:
+            music.write(data)
+
+    def start_server(self, workers: int = 1, log_file: str = None,
+                     log_level: str = "warning", address: (str, int) = None,
+                     library: str = None,
+                     **options) -> multiprocessing.Process:
+        """Starts the server process, stopped by the test cleanup.
+
+        Args:
+            workers: The number of worker processes.
+            log_file: The file the server log is appended to. None
+                      writes it to stderr.
+            log_level: The log level of the server.
+            address: The server address. Defaults to address.
+            library: The music directory. Defaults to library.
+            options: Keyword arguments of the server, added to OPTIONS.
+        """
+
+        address = address or self.address
+        # Not a daemon, so it may start worker processes.
+        process = multiprocessing.Process(
+            target=serve,
+            args=(self.ENGINE, address[1], library or self.library,
+                  {**self.OPTIONS, **options}, workers, log_file,
+                  log_level))
+        process.start()
+        self.addCleanup(stop_process, process)
+        wait_for_port(address)
+        return process
+
+    def client(self, client_class=LoopbackClient, address=None,
+               **options):
+        """Creates a client working in the client directory and
+        connects it, by default to address. It's closed by the test
+        cleanup."""
+
+        client = client_class(address or self.address, self.local,
+                              **options)
+        self.assertTrue(client.set_ambient())
+        self.addCleanup(client.client.close)
+        return client
+
+    def ids(self, client) -> dict:
+        """Returns the track IDs of the server musics by name."""
+
+        return {entry["name"]: entry["id"] for entry in client.manifest()}
+
+
+def stop_process(process: multiprocessing.Process) -> None:
+    """Stops a server process, letting a supervisor stop its workers."""
+
+    if process.is_alive():
+        os.kill(process.pid, signal.SIGINT)
+    process.join(5)
+    if process.is_alive():
+        process.terminate()
+    process.join(5)
+    if process.is_alive():
+        process.kill()
+        process.join()
@@ -0,0 +1,58 @@
+"""Tests of the asyncio server engine."""
+
+import concurrent.futures
+import os
+import socket
+import unittest
+
+from tests.loopback import LoopbackTestCase
+
+
+class AsyncServerTest(LoopbackTestCase):
+    """Checks the clients served at once by the event loop."""
+
+    ENGINE = "asyncio"
+
+    def make_library(self):
+        self.musics = {f"{i}.mp3": os.urandom(100 * 1024 + i)
+                       for i in range(16)}
+        for name, data in self.musics.items():
+            self.write(name, data)
+
+    def test_concurrent_clients(self):
+        client = self.client()
+        ids = self.ids(client)
+        clients = [client.clone() for _ in ids]
+
+        def download(client, name):
+            client.ensure_session()
+            return client.copy(ids[name])
+
+        with concurrent.futures.ThreadPoolExecutor(len(ids)) as pool:
+            results = list(pool.map(download, clients, ids))
+        for other in clients:
+            other.client.close()
+        self.assertEqual(sorted(results),
+                         sorted((name, True) for name in self.musics))
+        for name, data in self.musics.items():
+            with open(name, "rb") as music:
+                self.assertEqual(music.read(), data)
+        self.assertEqual(client.stats()["connections"], len(ids) + 1)
+
+    def test_legacy_client(self):
+        name = self.client().raw_available()[0][1]
+        with socket.create_connection(self.address, timeout=5) as legacy:
+            # A bare command, with no handshake, and the music until the
+            # server closes the connection.
+            legacy.sendall(b"--copy 1")
+            answer = b""
+            while True:
+                chunk = legacy.recv(65536)
+                if not chunk:
+                    break
+                answer += chunk
+        self.assertEqual(answer, name.encode() + self.musics[name])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""Tests of the batched downloads of many musics on one stream."""
+
+import os
+import unittest
+
+from music_sender.sync import SyncEngine
+from tests.loopback import LoopbackTestCase
+
+
+class CopyManyTest(LoopbackTestCase):
+    """Checks the musics streamed by a single --copy-many."""
+
+    def make_library(self):
+        self.musics = {f"Album/{i}.mp3": os.urandom(30 * 1024 + i)
+                       for i in range(8)}
+        for name, data in self.musics.items():
+            self.write(name, data)
+
+    def assertDownloaded(self, names) -> None:
+        for name in names:
+            with open(name, "rb") as music:
+                self.assertEqual(music.read(), self.musics[name])
+
+    def test_one_request(self):
+        client = self.client()
+        ids = self.ids(client)
+        names = sorted(ids)
+        results = list(client.copy_many([ids[name] for name in names]))
+        self.assertEqual(results, [(name, True) for name in names])
+        self.assertDownloaded(names)
+        stats = client.stats()
+        self.assertEqual(stats["connections"], 1)
+        self.assertEqual(stats["commands"]["--copy-many"]["count"], 1)
+
+    def test_unknown_track(self):
+        client = self.client()
+        ids = self.ids(client)
+        unknown = max(ids.values()) + 100
+        results = list(client.copy_many(
+            [ids["Album/0.mp3"], unknown, ids["Album/1.mp3"]]))
+        # The stream goes on after the music that doesn't exist.
+        self.assertEqual(results, [("Album/0.mp3", True), ("", False),
+                                   ("Album/1.mp3", True)])
+        self.assertDownloaded(["Album/0.mp3", "Album/1.mp3"])
+        self.assertEqual(len(client.raw_available()), len(self.musics))
+
+    def test_engine_batches(self):
+        client = self.client()
+        engine = SyncEngine(client, jobs=2, batch=4)
+        results = list(engine.run(client.pending()))
+        self.assertTrue(all(result.successful for result in results))
+        self.assertDownloaded(self.musics)
+        commands = client.stats()["commands"]
+        self.assertEqual(commands["--copy-many"]["count"], 2)
+        self.assertNotIn("--copy", commands)
+
+
+class AsyncCopyManyTest(CopyManyTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+"""Tests of the benchmark suite, its libraries and its network emulation."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from benchmarks import library, suite
+from benchmarks.netem import NetemProxy
+from tests.loopback import LoopbackTestCase
+
+
+class LibraryTest(unittest.TestCase):
+    """Checks the synthetic libraries."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="music_sender_test_")
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def test_parse_size(self):
+        self.assertEqual(library.parse_size("512"), 512)
+        self.assertEqual(library.parse_size("4k"), 4096)
+        self.assertEqual(library.parse_size("1.5M"), 1536 * 1024)
+        with self.assertRaises(ValueError):
+            library.parse_size("big")
+
+    def test_bad_distribution(self):
+        for spec in ("fixed", "uniform:1K", "normal:1M:0.5"):
+            with self.assertRaises(ValueError):
+                library.parse_distribution(spec)
+
+    def test_reproducible(self):
+        first = library.make_library(os.path.join(self.root, "a"), 12,
+                                     "uniform:1K:8K", seed=3)
+        second = library.make_library(os.path.join(self.root, "b"), 12,
+                                      "uniform:1K:8K", seed=3)
+        self.assertEqual(first, second)
+        self.assertEqual(first["files"], 12)
+        path = first["largest"]
+        with open(os.path.join(self.root, "a", path), "rb") as music, \
+                open(os.path.join(self.root, "b", path), "rb") as other:
+            self.assertEqual(music.read(), other.read())
+        self.assertEqual(
+            os.path.getsize(os.path.join(self.root, "a", path)),
+            first["largest_bytes"])
+
+
+class CompareTest(unittest.TestCase):
+    """Checks the regressions reported against a baseline."""
+
+    def test_compare(self):
+        baseline = {"results": {"sync": {
+            "seconds": 10.0, "mib_per_second": 100.0, "files": 50,
+            "client_seconds": {"p95_ms": 0}}}}
+        current = {"results": {"sync": {
+            "seconds": 10.5, "mib_per_second": 80.0, "files": 40,
+            "client_seconds": {"p95_ms": 5}}}}
+        changes = {name: (change, regression) for
+                   name, _, _, change, regression in suite.compare(
+                       baseline, current, 0.1)}
+        # Counts and zero baselines aren't compared.
+        self.assertEqual(set(changes),
+                         {"sync.seconds", "sync.mib_per_second"})
+        self.assertAlmostEqual(changes["sync.seconds"][0], 0.05)
+        self.assertFalse(changes["sync.seconds"][1])
+        self.assertAlmostEqual(changes["sync.mib_per_second"][0], -0.2)
+        self.assertTrue(changes["sync.mib_per_second"][1])
+
+
+class SuiteTest(LoopbackTestCase):
+    """Runs the benchmark scenarios against a loopback server."""
+
+    def make_library(self):
+        self.summary = library.make_library(self.library, 6, "fixed:16K")
+
+    def setUp(self):
+        super().setUp()
+        self.work = os.path.dirname(self.library)
+
+    def test_catalog(self):
+        result = suite.bench_catalog(self.address, self.work, 3)
+        self.assertEqual(set(result), {"raw_available", "query", "manifest"})
+        self.assertEqual(result["manifest"]["count"], 3)
+
+    def test_throughput(self):
+        result = suite.bench_throughput(self.address, self.work, 2,
+                                        self.summary["largest"])
+        self.assertEqual(result["bytes"], 16 * 1024)
+        self.assertEqual(result["seconds"]["count"], 2)
+
+    def test_sync(self):
+        result = suite.bench_sync(self.address, self.work, 2, 4)
+        self.assertEqual((result["files"], result["failed"]), (6, 0))
+        self.assertEqual(result["bytes"], self.summary["bytes"])
+
+    def test_delayed_proxy(self):
+        proxy = NetemProxy(self.address, delay=0.05)
+        proxy.start()
+        self.addCleanup(proxy.stop)
+        client = self.client(address=proxy.address)
+        started = time.monotonic()
+        self.assertEqual(len(client.raw_available()), 6)
+        # A request and its reply are delayed once each.
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        result = suite.bench_sync(proxy.address, self.work, 2, 4)
+        self.assertEqual((result["files"], result["failed"]), (6, 0))
+
+
+class AsyncSuiteTest(SuiteTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
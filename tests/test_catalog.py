@@ -0,0 +1,90 @@
+"""Tests of the server catalog and its search index."""
+
+import os
+import unittest
+
+from music_sender.catalog import SearchIndex
+from tests.loopback import LoopbackTestCase, wait_until
+
+
+class SearchIndexTest(unittest.TestCase):
+    """Checks the substring and prefix matching of SearchIndex."""
+
+    def setUp(self):
+        self.index = SearchIndex((
+            (1, "Artist/Blue Moon.mp3"), (2, "Artist/Moonlight.flac"),
+            (3, "Other/Honeymoon (Live).MP3"), (4, "Other/Sun.wav")))
+
+    def test_substring(self):
+        self.assertEqual(self.index.match("moon"), [0, 1, 2])
+        self.assertEqual(self.index.match("MOON"), [0, 1, 2])
+        self.assertEqual(self.index.match("other/"), [2, 3])
+        self.assertEqual(self.index.match("nothing"), [])
+
+    def test_substring_within_a_name(self):
+        # A search never spans two names.
+        self.assertEqual(self.index.match("mp3\nartist"), [])
+        self.assertEqual(self.index.match("mp3 artist"), [])
+
+    def test_prefix(self):
+        self.assertEqual(self.index.match("moon", prefix=True), [0, 1])
+        self.assertEqual(self.index.match("honey", prefix=True), [2])
+        self.assertEqual(self.index.match("oon", prefix=True), [])
+
+    def test_prefix_every_word(self):
+        self.assertEqual(self.index.match("art moon", prefix=True), [0, 1])
+        self.assertEqual(self.index.match("Blue Mo", prefix=True), [0])
+        self.assertEqual(self.index.match("live honey", prefix=True), [2])
+        # The extension isn't a word of the name.
+        self.assertEqual(self.index.match("mp3", prefix=True), [])
+
+    def test_query(self):
+        self.assertEqual(self.index.query("moon", extension="mp3"),
+                         (2, [(1, "Artist/Blue Moon.mp3"),
+                              (3, "Other/Honeymoon (Live).MP3")]))
+        self.assertEqual(self.index.query(offset=1, limit=2),
+                         (4, [(2, "Artist/Moonlight.flac"),
+                              (3, "Other/Honeymoon (Live).MP3")]))
+
+    def test_lowercase_longer_than_name(self):
+        # "İ".lower() is two code points, so the lowercase text is
+        # longer than the names.
+        index = SearchIndex(((1, "İİİİ.mp3"), (2, "Other.mp3")))
+        self.assertEqual(index.match("mp3"), [0, 1])
+        self.assertEqual(index.match("other"), [1])
+
+
+
+class CatalogTest(LoopbackTestCase):
+    """Checks that the served catalog follows the library."""
+
+    def make_library(self):
+        self.write("A.mp3", b"a" * 1000)
+        self.write("B.mp3", b"b" * 1000)
+
+    def names(self, client) -> [str]:
+        return sorted(name for _, name in client.raw_available())
+
+    def test_listing(self):
+        client = self.client()
+        self.assertEqual(self.names(client), ["A.mp3", "B.mp3"])
+        # The next request is served from the same catalog.
+        self.assertEqual(client.raw_available(), client.raw_available())
+
+    def test_added_and_removed(self):
+        client = self.client()
+        track_id = self.ids(client)["B.mp3"]
+        self.write("C.mp3", b"c" * 1000)
+        os.remove(os.path.join(self.library, "A.mp3"))
+        self.assertTrue(wait_until(
+            lambda: self.names(client) == ["B.mp3", "C.mp3"]))
+        # The music that stayed keeps its track ID.
+        self.assertIn((track_id, "B.mp3"), client.raw_available())
+
+
+class AsyncCatalogTest(CatalogTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
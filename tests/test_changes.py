@@ -0,0 +1,64 @@
+"""Tests of the incremental catalog sync with version tokens."""
+
+import os
+import unittest
+
+from music_sender import protocol
+from tests.loopback import LoopbackTestCase, wait_until
+
+
+class ChangesTest(LoopbackTestCase):
+    """Checks the manifest changes sent since a catalog version."""
+
+    def make_library(self):
+        for name in ("A.mp3", "B.mp3", "C.mp3"):
+            self.write(name, os.urandom(1000))
+
+    def changes(self, client, epoch: str, version: int) -> dict:
+        frame_type, payload = client._request(f"--changes {epoch} {version}")
+        self.assertEqual(frame_type, protocol.REPLY)
+        return protocol.decode(payload)
+
+    def test_only_changes(self):
+        client = self.client()
+        ids = self.ids(client)
+        epoch, version = client.catalog.epoch, client.catalog.version
+        unchanged = self.changes(client, epoch, version)
+        self.assertEqual((unchanged["reset"], unchanged["changes"]),
+                         (False, []))
+        os.remove(os.path.join(self.library, "A.mp3"))
+        self.write("D.mp3", os.urandom(1000))
+        self.assertTrue(wait_until(
+            lambda: sorted(self.ids(client)) == ["B.mp3", "C.mp3", "D.mp3"]))
+        answer = self.changes(client, epoch, version)
+        self.assertFalse(answer["reset"])
+        self.assertGreater(answer["version"], version)
+        self.assertEqual(
+            sorted((entry["id"], entry["name"])
+                   for entry in answer["changes"]),
+            sorted([(ids["A.mp3"], None),
+                    (self.ids(client)["D.mp3"], "D.mp3")]))
+
+    def test_other_epoch(self):
+        client = self.client()
+        answer = self.changes(client, "other", 1)
+        self.assertTrue(answer["reset"])
+        self.assertEqual(sorted(entry["name"] for entry in answer["changes"]),
+                         ["A.mp3", "B.mp3", "C.mp3"])
+
+    def test_cached_manifest(self):
+        client = self.client()
+        manifest = client.manifest()
+        # Another client of the same directory starts from the cache.
+        other = self.client()
+        self.assertEqual(other.catalog.version, client.catalog.version)
+        self.assertEqual(other.catalog.manifest(), manifest)
+        self.assertEqual(other.manifest(), manifest)
+
+
+class AsyncChangesTest(ChangesTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
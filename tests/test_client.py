@@ -0,0 +1,148 @@
+"""Tests of the client sessions against a loopback server."""
+
+import argparse
+import contextlib
+import io
+import os
+import threading
+import unittest
+
+from music_sender import client as client_module
+from tests.loopback import HOST, LoopbackTestCase, free_port, wait_until
+
+
+class SessionTest(LoopbackTestCase):
+    """Checks that a session stays usable after a failed transfer."""
+
+    def make_library(self):
+        self.write("A.mp3", os.urandom(200 * 1024))
+        self.write("B.mp3", os.urandom(100 * 1024))
+
+    def test_unexpected_music(self):
+        client = self.client()
+        ids = self.ids(client)
+        # The partial download doesn't belong to the requested music, so
+        # its FILE frame is left unread.
+        with open("B.mp3.part", "wb") as part:
+            part.write(b"x" * 1000)
+        self.assertEqual(client.copy(ids["A.mp3"], "B.mp3"),
+                         ("A.mp3", False))
+        # The session is opened again, like the sync engines do, and
+        # the next answers aren't mixed with the music data.
+        client.ensure_session()
+        self.assertEqual(self.ids(client), ids)
+        self.assertEqual(client.copy(ids["B.mp3"]), ("B.mp3", True))
+
+
+class AsyncSessionTest(SessionTest):
+    ENGINE = "asyncio"
+
+
+class StreamingTest(LoopbackTestCase):
+    """Checks that the musics are received through a small buffer."""
+
+    def make_library(self):
+        self.data = os.urandom(1024 * 1024 + 3)
+        self.write("Album/A.mp3", self.data)
+
+    def test_small_buffer(self):
+        client = self.client(chunk_size=4096)
+        track_id = self.ids(client)["Album/A.mp3"]
+        self.assertEqual(client.copy(track_id), ("Album/A.mp3", True))
+        with open("Album/A.mp3", "rb") as music:
+            self.assertEqual(music.read(), self.data)
+        self.assertFalse(os.path.exists("Album/A.mp3.part"))
+
+
+class InterruptedTransferTest(LoopbackTestCase):
+    """Checks the downloads the server stops in the middle of."""
+
+    def make_library(self):
+        self.data = os.urandom(1024 * 1024)
+        self.write("A.mp3", self.data)
+
+    def setUpServer(self):
+        # Slow enough to be stopped in the middle of a transfer.
+        self.server = self.start_server(max_client_rate=256 * 1024)
+
+    def interrupt(self, client, track_id: int) -> int:
+        """Kills the server in the middle of a download.
+
+        Returns:
+            The size of the partial download.
+        """
+
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(client.copy(track_id, "A.mp3")))
+        thread.start()
+        self.assertTrue(wait_until(
+            lambda: os.path.exists("A.mp3.part")
+            and os.path.getsize("A.mp3.part") > 0))
+        self.server.kill()
+        thread.join(10)
+        self.assertEqual(results, [("A.mp3", False)])
+        return os.path.getsize("A.mp3.part")
+
+    def test_no_truncated_music(self):
+        client = self.client()
+        received = self.interrupt(client, self.ids(client)["A.mp3"])
+        # Only the partial download is left, with the received bytes.
+        self.assertFalse(os.path.exists("A.mp3"))
+        self.assertLess(received, len(self.data))
+        with open("A.mp3.part", "rb") as part:
+            self.assertEqual(part.read(), self.data[:received])
+
+    def test_resume(self):
+        client = self.client()
+        track_id = self.ids(client)["A.mp3"]
+        received = self.interrupt(client, track_id)
+        # A new server on the same library sends only the missing bytes.
+        address = (HOST, free_port())
+        self.start_server(address=address)
+        client = self.client(address=address)
+        self.assertEqual(client.copy(track_id, "A.mp3"), ("A.mp3", True))
+        with open("A.mp3", "rb") as music:
+            self.assertEqual(music.read(), self.data)
+        self.assertFalse(os.path.exists("A.mp3.part"))
+        self.assertEqual(client.stats()["bytes_sent"],
+                         len(self.data) - received)
+
+
+class ArgumentsTest(unittest.TestCase):
+    """Checks the validation of the command line."""
+
+    def parse(self, *argv: str) -> argparse.Namespace:
+        parser = argparse.ArgumentParser()
+        client_module.add_arguments(parser)
+        with contextlib.redirect_stderr(io.StringIO()):
+            return parser.parse_args(argv)
+
+    def test_counts(self):
+        args = self.parse("-a", "-j", "4", "-b", "8", "--retries", "0")
+        self.assertEqual((args.jobs, args.batch, args.retries), (4, 8, 0))
+        for argv in (("-j", "0"), ("--batch", "0"), ("-j", "x"),
+                     ("--retries", "-1"), ("--segments", "0"),
+                     ("--chunk-size", "0")):
+            with self.subTest(argv=argv):
+                with self.assertRaises(SystemExit):
+                    self.parse("-a", *argv)
+
+    def test_mixed_actions(self):
+        for argv in (("-s", "-a"), ("-s", "-v"), ("-c", "1", "-d")):
+            with self.subTest(argv=argv):
+                with self.assertRaises(SystemExit):
+                    self.parse(*argv)
+
+    def test_mixed_stats(self):
+        # Arguments that didn't come from the parser.
+        args = self.parse()
+        args.stats = args.automatic = True
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            client_module.handle_args(None, args)
+        self.assertIn("Don't mix options", output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+"""Tests of the compressed blocks."""
+
+import os
+import unittest
+
+from music_sender import compression
+from music_sender.protocol import ProtocolError
+from tests.loopback import LoopbackTestCase
+
+
+class BlockDecoderTest(unittest.TestCase):
+    """Checks the decompression of the blocks of every codec."""
+
+    def decode(self, codec: str, block: bytes, limit: int,
+               chunk: int = 4096) -> bytes:
+        """Decodes a block in chunks, like the client receives it."""
+
+        decoder = compression.BlockDecoder(codec)
+        parts = []
+        for start in range(0, len(block), chunk):
+            data = decoder.decode(block[start:start + chunk], limit)
+            limit -= len(data)
+            parts.append(data)
+        return b"".join(parts)
+
+    def test_round_trip(self):
+        data = os.urandom(1024) * (compression.BLOCK_SIZE // 1024)
+        for codec, compress in compression.COMPRESSORS.items():
+            with self.subTest(codec=codec):
+                self.assertEqual(self.decode(codec, compress(data),
+                                             len(data)), data)
+
+    def test_larger_than_block_size(self):
+        # A block that decompresses to much more than the block size,
+        # with a limit that doesn't bound it.
+        data = bytes(16 * compression.BLOCK_SIZE)
+        for codec, compress in compression.COMPRESSORS.items():
+            with self.subTest(codec=codec):
+                with self.assertRaises(ProtocolError):
+                    self.decode(codec, compress(data), len(data))
+
+    def test_larger_than_limit(self):
+        data = bytes(compression.BLOCK_SIZE)
+        for codec, compress in compression.COMPRESSORS.items():
+            with self.subTest(codec=codec):
+                with self.assertRaises(ProtocolError):
+                    self.decode(codec, compress(data), 1000)
+
+    def test_corrupt(self):
+        for codec in compression.COMPRESSORS:
+            with self.subTest(codec=codec):
+                with self.assertRaises(ValueError):
+                    self.decode(codec, b"garbage!" * 16, 1000)
+
+    @unittest.skipUnless(compression.zstandard, "zstandard isn't installed")
+    def test_zstd_bomb(self):
+        # The whole bomb is given at once, the output still stays near
+        # the block size.
+        size = 64 * compression.BLOCK_SIZE
+        block = compression.COMPRESSORS["zstd"](bytes(size))
+        decoder = compression.BlockDecoder("zstd")
+        with self.assertRaises(ProtocolError):
+            decoder.decode(block, size)
+
+    def test_unsupported_codec(self):
+        with self.assertRaises(ValueError):
+            compression.BlockDecoder("brotli")
+
+
+class CompressedTransferTest(LoopbackTestCase):
+    """Checks the raw PCM musics sent compressed on a slow link."""
+
+    # The upload cap gives the server the link rate from the start.
+    OPTIONS = {"max_client_rate": 4 * 1024 * 1024}
+
+    def make_library(self):
+        # A quiet 16 bit stereo PCM, with some noise in the low bits.
+        noise = os.urandom(compression.MIN_SIZE // 4)
+        self.wav = bytes(byte & 0x07 for byte in noise) * 4 + b"end"
+        self.mp3 = os.urandom(compression.MIN_SIZE)
+        self.write("quiet.wav", self.wav)
+        self.write("noise.mp3", self.mp3)
+
+    def download(self, client, name: str) -> bytes:
+        self.assertEqual(client.copy(self.ids(client)[name]), (name, True))
+        self.assertFalse(os.path.exists(name + ".part"))
+        with open(name, "rb") as music:
+            return music.read()
+
+    def test_compressed(self):
+        client = self.client()
+        self.assertEqual(self.download(client, "quiet.wav"), self.wav)
+        stats = client.stats()
+        self.assertEqual(stats["compression_musics"], 1)
+        self.assertEqual(stats["compression_bytes_in"], len(self.wav))
+        self.assertLess(stats["compression_bytes_out"], len(self.wav) / 2)
+        # Only the compressed bytes went through the link.
+        self.assertEqual(stats["bytes_sent"], stats["compression_bytes_out"])
+
+    def test_not_compressible(self):
+        client = self.client()
+        self.assertEqual(self.download(client, "noise.mp3"), self.mp3)
+        self.assertEqual(client.stats()["compression_musics"], 0)
+
+    def test_client_without_compression(self):
+        client = self.client(compression=False)
+        self.assertEqual(self.download(client, "quiet.wav"), self.wav)
+        self.assertEqual(client.stats()["compression_musics"], 0)
+
+
+class AsyncCompressedTransferTest(CompressedTransferTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+"""Tests of the delta transfer."""
+
+import io
+import random
+import tempfile
+import unittest
+
+from music_sender import delta
+from music_sender.commands import CommandProcessor
+
+
+def rebuild(old: bytes, new: bytes, operations: [list], block: int) -> bytes:
+    """Rebuilds the new version from the client blocks like the client
+    does."""
+
+    rebuilt = bytearray()
+    for operation, start, count in operations:
+        if operation == delta.COPY:
+            rebuilt += old[start * block:(start + count) * block]
+        else:
+            rebuilt += new[start:start + count]
+    return bytes(rebuilt)
+
+
+class DeltaTest(unittest.TestCase):
+    """Checks that the operations rebuild the new version of a music."""
+
+    def setUp(self):
+        self.random = random.Random(0)
+        self.old = self.random.randbytes(300 * 1024 + 123)
+
+    def round_trip(self, old: bytes, new: bytes) -> ([list], int):
+        block = delta.block_size(len(old))
+        signatures = delta.parse_signature(
+            delta.signature(io.BytesIO(old), len(old), block))
+        with tempfile.TemporaryFile() as new_file:
+            new_file.write(new)
+            new_file.flush()
+            operations, literal = delta.delta(new_file, len(new), signatures,
+                                              block, len(old))
+        self.assertEqual(rebuild(old, new, operations, block), new)
+        self.assertEqual(literal, sum(count for operation, _, count
+                                      in operations
+                                      if operation == delta.DATA))
+        return operations, literal
+
+    def test_unchanged(self):
+        _, literal = self.round_trip(self.old, self.old)
+        self.assertEqual(literal, 0)
+
+    def test_changed_head(self):
+        # A longer tag shifts the rest of the music.
+        new = b"TAG" * 700 + self.old[1000:]
+        _, literal = self.round_trip(self.old, new)
+        self.assertLess(literal, 2 * delta.block_size(len(self.old)) + 2100)
+
+    def test_changed_tail(self):
+        new = self.old[:-500] + self.random.randbytes(2000)
+        _, literal = self.round_trip(self.old, new)
+        self.assertLess(literal, 2 * delta.block_size(len(self.old)) + 2000)
+
+    def test_short_last_block(self):
+        # The size isn't a multiple of the block size, so the last block
+        # is shorter and can only match the end of the new version.
+        block = delta.block_size(len(self.old))
+        self.assertTrue(len(self.old) % block)
+        middle = len(self.old) // 2
+        new = self.old[:middle] + b"x" * 10 + self.old[middle + 10:]
+        operations, literal = self.round_trip(self.old, new)
+        self.assertLessEqual(literal, 2 * block)
+        self.assertEqual(operations[-1][0], delta.COPY)
+        self.assertEqual(operations[-1][1] + operations[-1][2],
+                         -(-len(self.old) // block))
+
+    def test_new_version_smaller_than_a_block(self):
+        operations, literal = self.round_trip(self.old, self.old[:100])
+        self.assertEqual(operations, [[delta.DATA, 0, 100]])
+
+    def test_empty_new_version(self):
+        self.assertEqual(self.round_trip(self.old, b""), ([], 0))
+
+    def test_max_literal(self):
+        new = self.random.randbytes(len(self.old))
+        block = delta.block_size(len(self.old))
+        signatures = delta.parse_signature(
+            delta.signature(io.BytesIO(self.old), len(self.old), block))
+        with tempfile.TemporaryFile() as new_file:
+            new_file.write(new)
+            new_file.flush()
+            self.assertEqual(
+                delta.delta(new_file, len(new), signatures, block,
+                            len(self.old), max_literal=1024),
+                ([[delta.DATA, 0, len(new)]], len(new)))
+
+    def test_bad_signature(self):
+        with self.assertRaises(ValueError):
+            delta.parse_signature(b"\0" * (delta.SIGNATURE.size + 1))
+
+
+class GetDeltaTest(unittest.TestCase):
+    """Checks the parsing of the --delta command."""
+
+    def command(self, block: int, size: int, count: int = None) -> bytes:
+        if count is None:
+            count = -(-size // block)
+        return f"--delta 3 {block} {size}\n".encode() \
+            + b"\0" * delta.SIGNATURE.size * count
+
+    def test_valid(self):
+        track_id, block, size, signatures = CommandProcessor.get_delta(
+            self.command(4096, 10000))
+        self.assertEqual((track_id, block, size), (3, 4096, 10000))
+        self.assertEqual(len(signatures), 3)
+
+    def test_block_out_of_range(self):
+        for block in (0, 1, delta.MIN_BLOCK - 1, delta.MAX_BLOCK + 1):
+            with self.assertRaises(ValueError):
+                CommandProcessor.get_delta(self.command(block, 10000, 1))
+
+    def test_too_many_blocks(self):
+        size = delta.MIN_BLOCK * (delta.MAX_BLOCKS + 1)
+        with self.assertRaises(ValueError):
+            CommandProcessor.get_delta(self.command(delta.MIN_BLOCK, size))
+
+    def test_signature_count(self):
+        for count in (0, 2, 4):
+            with self.assertRaises(ValueError):
+                CommandProcessor.get_delta(self.command(4096, 10000, count))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+"""Tests of the hot track cache."""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from music_sender import hotcache
+from music_sender.hotcache import HotCache
+from tests.loopback import LoopbackTestCase, wait_until
+
+
+class HotCacheTest(unittest.TestCase):
+    """Checks the copies of the musics requested last."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="music_sender_test_")
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.cache = HotCache(4096, os.path.join(self.root, "cache"),
+                              max_entry=2048)
+        self.addCleanup(self.cache.close)
+
+    def write(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.root, name)
+        with open(path, "wb") as music:
+            music.write(data)
+        return path
+
+    def read(self, path: str) -> bytes:
+        with self.cache.open(path) as music:
+            return music.read()
+
+    def test_hit(self):
+        path = self.write("a.mp3", b"a" * 1000)
+        self.assertEqual(self.read(path), b"a" * 1000)
+        self.assertEqual(self.read(path), b"a" * 1000)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual((stats["entries"], stats["size"]), (1, 1000))
+
+    def test_changed_music(self):
+        path = self.write("a.mp3", b"a" * 1000)
+        self.read(path)
+        self.write("a.mp3", b"b" * 1500)
+        self.assertEqual(self.read(path), b"b" * 1500)
+        stats = self.cache.stats()
+        self.assertEqual((stats["misses"], stats["size"]), (2, 1500))
+
+    def test_eviction(self):
+        paths = [self.write(f"{i}.mp3", bytes([i]) * 1500) for i in range(3)]
+        for path in paths:
+            self.read(path)
+        # The least recently used copy made room for the last one.
+        stats = self.cache.stats()
+        self.assertEqual((stats["evictions"], stats["entries"]), (1, 2))
+        self.read(paths[2])
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_large_music(self):
+        path = self.write("master.wav", b"m" * 3000)
+        self.assertEqual(self.read(path), b"m" * 3000)
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_coalesced(self):
+        path = self.write("a.mp3", b"a" * 1000)
+        copying = threading.Event()
+        release = threading.Event()
+        copyfile = shutil.copyfile
+
+        def slow_copy(source, destination):
+            copying.set()
+            release.wait(10)
+            return copyfile(source, destination)
+
+        results = []
+        with mock.patch.object(hotcache.shutil, "copyfile", slow_copy):
+            threads = [threading.Thread(
+                target=lambda: results.append(self.read(path)))
+                for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            self.assertTrue(copying.wait(10))
+            # The other requests wait for the first copy.
+            self.assertTrue(wait_until(
+                lambda: self.cache.stats()["coalesced"] == 3))
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(results, [b"a" * 1000] * 4)
+        stats = self.cache.stats()
+        self.assertEqual((stats["misses"], stats["hits"]), (1, 3))
+
+
+class ServerCacheTest(LoopbackTestCase):
+    """Checks that the server sends the musics through the cache."""
+
+    OPTIONS = {"cache_size": 1024 * 1024}
+
+    def make_library(self):
+        self.data = os.urandom(50 * 1024)
+        self.write("A.mp3", self.data)
+
+    def test_cached_downloads(self):
+        client = self.client()
+        track_id = self.ids(client)["A.mp3"]
+        for _ in range(2):
+            self.assertEqual(client.copy(track_id), ("A.mp3", True))
+            with open("A.mp3", "rb") as music:
+                self.assertEqual(music.read(), self.data)
+            os.remove("A.mp3")
+        stats = client.stats()
+        self.assertEqual((stats["cache_misses"], stats["cache_hits"]),
+                         (1, 1))
+
+
+class AsyncServerCacheTest(ServerCacheTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
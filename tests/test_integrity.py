@@ -0,0 +1,83 @@
+"""Tests of the size and hash checks of the downloaded musics."""
+
+import os
+import unittest
+
+from tests.loopback import LoopbackClient, LoopbackTestCase
+
+
+class CorruptingClient(LoopbackClient):
+    """A client whose first download arrives with a flipped byte."""
+
+    corrupt = 1
+
+    def _receive_data(self, *args):
+        for chunk in super()._receive_data(*args):
+            if self.corrupt:
+                self.corrupt -= 1
+                chunk = bytes([chunk[0] ^ 0xFF]) + bytes(chunk[1:])
+            yield chunk
+
+
+class IntegrityTest(LoopbackTestCase):
+    """Checks that corrupt musics are discarded and downloaded again."""
+
+    def make_library(self):
+        self.musics = {name: os.urandom(40 * 1024)
+                       for name in ("A.mp3", "B.mp3")}
+        for name, data in self.musics.items():
+            self.write(name, data)
+
+    def assertDownloaded(self, name) -> None:
+        with open(name, "rb") as music:
+            self.assertEqual(music.read(), self.musics[name])
+
+    def rot(self, name: str) -> None:
+        """Changes a music of the server without changing its size or
+        mtime, so the library index keeps its old hash."""
+
+        path = os.path.join(self.library, name)
+        stat = os.stat(path)
+        with open(path, "r+b") as music:
+            music.write(b"\0" * 16)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    def test_corrupt_once(self):
+        client = self.client(CorruptingClient)
+        self.assertEqual(client.copy(self.ids(client)["A.mp3"]),
+                         ("A.mp3", True))
+        self.assertDownloaded("A.mp3")
+        self.assertFalse(os.path.exists("A.mp3.part"))
+        self.assertEqual(client.stats()["commands"]["--copy"]["count"], 2)
+
+    def test_always_corrupt(self):
+        client = self.client()
+        track_id = self.ids(client)["A.mp3"]
+        # The first download stores the hash in the library index.
+        self.assertEqual(client.copy(track_id), ("A.mp3", True))
+        os.remove("A.mp3")
+        self.rot("A.mp3")
+        self.assertEqual(client.copy(track_id), ("A.mp3", False))
+        self.assertFalse(os.path.exists("A.mp3"))
+        self.assertFalse(os.path.exists("A.mp3.part"))
+        # Like any failed transfer, the last one has closed the session.
+        client.ensure_session()
+        self.assertEqual(client.stats()["commands"]["--copy"]["count"],
+                         2 + client.INTEGRITY_RETRIES)
+
+    def test_corrupt_in_batch(self):
+        client = self.client(CorruptingClient)
+        ids = self.ids(client)
+        results = list(client.copy_many([ids["A.mp3"], ids["B.mp3"]]))
+        # The stream goes on after the corrupt music.
+        self.assertEqual(results, [("A.mp3", False), ("B.mp3", True)])
+        self.assertFalse(os.path.exists("A.mp3.part"))
+        self.assertDownloaded("B.mp3")
+
+
+class AsyncIntegrityTest(IntegrityTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
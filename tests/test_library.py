@@ -0,0 +1,103 @@
+"""Tests of the persistent library index."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from music_sender.library import LibraryIndex
+from tests.loopback import HOST, LoopbackTestCase, free_port
+
+
+class LibraryIndexTest(unittest.TestCase):
+    """Checks the tracks of a library with subdirectories."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="music_sender_test_")
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        for name in ("Artist/Album/1.mp3", "Artist/Album/2.flac",
+                     "Other/3.wav", "top.mp3", ".hidden/4.mp3",
+                     "Artist/cover.jpg"):
+            self.write(name)
+
+    def write(self, name: str, data: bytes = b"music") -> None:
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as music:
+            music.write(data)
+
+    def index(self) -> LibraryIndex:
+        index = LibraryIndex(self.root)
+        self.addCleanup(index.close)
+        return index
+
+    def test_recursive(self):
+        index = self.index()
+        self.assertTrue(index.reconcile())
+        self.assertEqual(sorted(path for _, path in index.tracks()),
+                         ["Artist/Album/1.mp3", "Artist/Album/2.flac",
+                          "Other/3.wav", "top.mp3"])
+
+    def test_stable_ids(self):
+        index = self.index()
+        index.reconcile()
+        ids = {path: track_id for track_id, path in index.tracks()}
+        os.remove(os.path.join(self.root, "Other/3.wav"))
+        self.write("Artist/Album/0.mp3")
+        self.assertTrue(index.reconcile())
+        tracks = {path: track_id for track_id, path in index.tracks()}
+        self.assertNotIn("Other/3.wav", tracks)
+        self.assertNotIn(tracks["Artist/Album/0.mp3"], ids.values())
+        for path in ("Artist/Album/1.mp3", "Artist/Album/2.flac",
+                     "top.mp3"):
+            self.assertEqual(tracks[path], ids[path])
+
+    def test_persistent(self):
+        index = self.index()
+        index.reconcile()
+        tracks = index.tracks()
+        version = index.version()
+        index.close()
+        # A new index on the same database finds no track changes.
+        index = self.index()
+        index.reconcile()
+        self.assertEqual(index.tracks(), tracks)
+        self.assertEqual(index.version(), version)
+
+    def test_rewritten_in_place(self):
+        index = self.index()
+        index.reconcile()
+        version = index.version()
+        self.write("top.mp3", b"a longer music")
+        self.assertTrue(index.update(["top.mp3", "missing.mp3"]))
+        self.assertEqual(index.entry("top.mp3")["size"], 14)
+        self.assertGreater(index.version(), version)
+
+
+class RestartTest(LoopbackTestCase):
+    """Checks that a server restart keeps the track IDs."""
+
+    def make_library(self):
+        self.write("B/b.mp3", os.urandom(1000))
+        self.write("C/c.mp3", os.urandom(1000))
+
+    def setUpServer(self):
+        self.server = self.start_server()
+
+    def test_restart(self):
+        ids = self.ids(self.client())
+        self.server.kill()
+        self.server.join()
+        self.write("A/a.mp3", os.urandom(1000))
+        address = (HOST, free_port())
+        self.start_server(address=address)
+        client = self.client(address=address)
+        restarted = self.ids(client)
+        self.assertEqual(restarted, {**ids, "A/a.mp3": restarted["A/a.mp3"]})
+        self.assertNotIn(restarted["A/a.mp3"], ids.values())
+        self.assertEqual(client.copy(restarted["B/b.mp3"]),
+                         ("B/b.mp3", True))
+
+
+if __name__ == "__main__":
+    unittest.main()
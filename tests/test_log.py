@@ -0,0 +1,115 @@
+"""Tests of the server log."""
+
+import atexit
+import io
+import logging
+import os
+import unittest
+
+from music_sender import log
+from tests.loopback import LoopbackTestCase, wait_until
+from tests.test_server import ImpatientClient
+
+
+class SetupTest(unittest.TestCase):
+    """Checks the records written by the background thread."""
+
+    def setUp(self):
+        logger = logging.getLogger(log.LOGGER)
+        state = (logger.handlers[:], logger.level, logger.propagate)
+
+        def restore():
+            logger.handlers[:], logger.level, logger.propagate = state
+
+        self.addCleanup(restore)
+        self.stream = io.StringIO()
+        self.logger = logging.getLogger(log.LOGGER + ".test")
+
+    def setup(self, level: str, color: bool = False) -> None:
+        self.listener = log.setup(level, self.stream, color)
+
+    def lines(self) -> [str]:
+        """Writes the pending records and returns the written lines."""
+
+        self.listener.stop()
+        atexit.unregister(self.listener.stop)
+        return self.stream.getvalue().splitlines()
+
+    def test_levels(self):
+        self.setup("info")
+        self.logger.debug("Hidden %s", "record")
+        self.logger.info("Shown %s", "record")
+        lines = self.lines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(" INFO [*] Shown record"))
+
+    def test_fields(self):
+        self.setup("debug")
+        request_log = log.RequestLogger(self.logger, {"client": "1.2.3.4"})
+        request_log.bind(command="--copy").debug("Command received")
+        request_log.debug("Connected")
+        lines = self.lines()
+        self.assertTrue(lines[0].endswith(
+            "[*] Command received [client=1.2.3.4 command=--copy]"))
+        self.assertTrue(lines[1].endswith("[*] Connected [client=1.2.3.4]"))
+
+    def test_color(self):
+        self.setup("warning", color=True)
+        self.logger.warning("Careful")
+        self.assertEqual(self.lines(), ["\033[;31m[*] Careful\033[m"])
+
+
+class WorkerLogTest(LoopbackTestCase):
+    """Checks that the workers write their records to the log file."""
+
+    def setUpServer(self):
+        self.log_file = os.path.join(os.path.dirname(self.library),
+                                     "server.log")
+        self.start_server(workers=2, log_file=self.log_file,
+                          log_level="debug")
+
+    def make_library(self):
+        self.write("A.mp3", b"a" * 1000)
+
+    def read_log(self) -> str:
+        with open(self.log_file) as log_file:
+            return log_file.read()
+
+    def test_worker_records(self):
+        client = self.client()
+        self.assertEqual(client.copy(self.ids(client)["A.mp3"]),
+                         ("A.mp3", True))
+        # The commands are only served, and logged, by the workers.
+        self.assertTrue(wait_until(
+            lambda: "Command received" in self.read_log()))
+        self.assertIn("command=--copy", self.read_log())
+
+
+class ServerLogTest(LoopbackTestCase):
+    """Checks the level of the server log file."""
+
+    def setUpServer(self):
+        self.log_file = os.path.join(os.path.dirname(self.library),
+                                     "server.log")
+        self.start_server(log_file=self.log_file, log_level="info",
+                          max_connections=1)
+
+    def test_no_debug_records(self):
+        client = self.client()
+        client.raw_available()
+        rejected = ImpatientClient(self.address, self.local)
+        self.assertFalse(rejected.set_ambient())
+        rejected.client.close()
+        self.assertTrue(wait_until(lambda: os.path.getsize(self.log_file)))
+        with open(self.log_file) as log_file:
+            records = log_file.read()
+        self.assertIn("INFO [*] Server busy, client rejected.", records)
+        self.assertNotIn("Command received", records)
+
+
+class AsyncServerLogTest(ServerLogTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+"""Tests of the comparison of the libraries by content hash."""
+
+import os
+import unittest
+
+from tests.loopback import LoopbackTestCase
+
+
+class CompareTest(LoopbackTestCase):
+    """Checks the changes found between the client and the server."""
+
+    def make_library(self):
+        self.musics = {name: os.urandom(4096 + i) for i, name in
+                       enumerate(("same.mp3", "stale.mp3", "corrupt.mp3",
+                                  "renamed.mp3", "missing.mp3"))}
+        for name, data in self.musics.items():
+            self.write(name, data)
+        self.local_write("same.mp3", self.musics["same.mp3"])
+        self.local_write("stale.mp3", os.urandom(4097))
+        self.local_write("corrupt.mp3", self.musics["corrupt.mp3"][:100])
+        self.local_write("old name.mp3", self.musics["renamed.mp3"])
+
+    def local_write(self, name: str, data: bytes) -> None:
+        with open(os.path.join(self.local, name), "wb") as music:
+            music.write(data)
+
+    def test_compare(self):
+        client = self.client()
+        ids = self.ids(client)
+        self.assertEqual(client.compare(), {
+            "missing": [(ids["missing.mp3"], "missing.mp3")],
+            "stale": [(ids["stale.mp3"], "stale.mp3")],
+            "corrupt": [(ids["corrupt.mp3"], "corrupt.mp3")],
+            "renamed": [(ids["renamed.mp3"], "old name.mp3",
+                         "renamed.mp3")]})
+
+    def test_pending(self):
+        client = self.client()
+        ids = self.ids(client)
+        self.assertEqual(sorted(client.pending()), sorted(
+            (ids[name], name)
+            for name in ("missing.mp3", "stale.mp3", "corrupt.mp3")))
+        # The renamed music is moved instead of downloaded again.
+        self.assertFalse(os.path.exists("old name.mp3"))
+        with open("renamed.mp3", "rb") as music:
+            self.assertEqual(music.read(), self.musics["renamed.mp3"])
+        for track_id, name in client.pending():
+            self.assertEqual(client.copy(track_id, name), (name, True))
+        self.assertEqual(client.compare(), {
+            "missing": [], "stale": [], "corrupt": [], "renamed": []})
+
+
+if __name__ == "__main__":
+    unittest.main()
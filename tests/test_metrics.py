@@ -0,0 +1,118 @@
+"""Tests of the server metrics, the exporter and --stats."""
+
+import argparse
+import contextlib
+import io
+import os
+import unittest
+import urllib.error
+import urllib.request
+
+from music_sender import client as client_module
+from music_sender import metrics
+from tests.loopback import HOST, LoopbackTestCase
+
+
+class MetricsTest(unittest.TestCase):
+    """Checks the counters and their text rendering."""
+
+    def test_histogram(self):
+        server_metrics = metrics.Metrics()
+        server_metrics.observe("--copy", 0.003)
+        server_metrics.observe("--copy", 2.0)
+        server_metrics.error(b"not-available")
+        server_metrics.add_bytes(1000)
+        snapshot = server_metrics.snapshot()
+        histogram = snapshot["commands"]["--copy"]
+        self.assertEqual(histogram["count"], 2)
+        self.assertAlmostEqual(histogram["sum"], 2.003)
+        self.assertEqual(histogram["buckets"][1], 1)
+        self.assertEqual(histogram["buckets"][7], 1)
+        self.assertEqual(snapshot["errors"], {"not-available": 1})
+        self.assertEqual(snapshot["bytes_sent"], 1000)
+
+    def test_combine(self):
+        combined = metrics.combine([
+            {"bytes_sent": 10, "uptime": 5.0, "errors": {"a": 1},
+             "commands": {"--copy": {"count": 1, "buckets": [1, 0]}}},
+            {"bytes_sent": 20, "uptime": 7.0, "errors": {"a": 2, "b": 1},
+             "commands": {"--copy": {"count": 2, "buckets": [0, 2]}}}])
+        self.assertEqual(combined, {
+            "bytes_sent": 30, "uptime": 7.0, "errors": {"a": 3, "b": 1},
+            "commands": {"--copy": {"count": 3, "buckets": [1, 2]}}})
+
+    def test_render(self):
+        server_metrics = metrics.Metrics()
+        server_metrics.observe("--copy", 0.003)
+        text = metrics.render({**server_metrics.snapshot(),
+                               "open_connections": 2})
+        self.assertIn("# TYPE music_sender_open_connections gauge\n"
+                      "music_sender_open_connections 2\n", text)
+        self.assertIn("music_sender_bytes_sent_total 0\n", text)
+        self.assertIn('music_sender_command_seconds_bucket{command="--copy",'
+                      'le="0.005"} 1\n', text)
+        self.assertIn('music_sender_command_seconds_bucket{command="--copy",'
+                      'le="+Inf"} 1\n', text)
+        self.assertIn('music_sender_command_seconds_count{command="--copy"}'
+                      ' 1\n', text)
+
+
+class ExporterTest(unittest.TestCase):
+    """Checks the HTTP exporter."""
+
+    def setUp(self):
+        self.exporter = metrics.MetricsExporter(
+            lambda: {"bytes_sent": 42}, (HOST, 0))
+        self.exporter.start()
+        self.addCleanup(self.exporter.stop)
+        self.url = "http://{}:{}".format(*self.exporter.address)
+
+    def test_metrics(self):
+        url = self.url + "/metrics"
+        with urllib.request.urlopen(url, timeout=5) as answer:
+            self.assertEqual(answer.status, 200)
+            self.assertIn(b"music_sender_bytes_sent_total 42\n",
+                          answer.read())
+
+    def test_not_found(self):
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(self.url + "/other", timeout=5)
+        self.assertEqual(error.exception.code, 404)
+        error.exception.close()
+
+
+class StatsTest(LoopbackTestCase):
+    """Checks the counters the server sends to --stats."""
+
+    def make_library(self):
+        self.data = os.urandom(20 * 1024)
+        self.write("A.mp3", self.data)
+
+    def test_stats(self):
+        client = self.client()
+        track_id = self.ids(client)["A.mp3"]
+        self.assertEqual(client.copy(track_id), ("A.mp3", True))
+        self.assertEqual(client.copy(track_id + 100), ("", False))
+        stats = client.stats()
+        self.assertEqual(stats["bytes_sent"], len(self.data))
+        self.assertEqual(stats["commands"]["--copy"]["count"], 2)
+        self.assertEqual(stats["errors"], {"not-available": 1})
+        self.assertEqual(stats["catalog_size"], 1)
+
+    def test_stats_command(self):
+        client = self.client()
+        parser = argparse.ArgumentParser()
+        client_module.add_arguments(parser)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            client_module.handle_args(client, parser.parse_args(["-s"]))
+        self.assertIn("connections: 1\n", output.getvalue())
+        self.assertIn("bytes_sent: 0\n", output.getvalue())
+
+
+class AsyncStatsTest(StatsTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
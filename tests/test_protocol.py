@@ -0,0 +1,73 @@
+"""Tests of the framed protocol."""
+
+import socket
+import unittest
+
+from music_sender import protocol
+
+
+class FrameTest(unittest.TestCase):
+    """Checks the encoding and decoding of frames."""
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+        self.receiver.settimeout(5)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_header_round_trip(self):
+        header = protocol.pack_header(protocol.EVENT, 2 ** 40)
+        self.assertEqual(len(header), protocol.HEADER.size)
+        self.assertEqual(protocol.unpack_header(header),
+                         (protocol.EVENT, 2 ** 40))
+
+    def test_bad_magic(self):
+        header = b"XX" + protocol.pack_header(protocol.HELLO, 0)[2:]
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.unpack_header(header)
+
+    def test_frame_round_trip(self):
+        payload = protocol.encode({"name": "Música.mp3", "size": 3})
+        protocol.send_frame(self.sender, protocol.REPLY, payload)
+        protocol.send_frame(self.sender, protocol.HEARTBEAT)
+        frame_type, received = protocol.recv_frame(self.receiver)
+        self.assertEqual(frame_type, protocol.REPLY)
+        self.assertEqual(protocol.decode(received),
+                         {"name": "Música.mp3", "size": 3})
+        self.assertEqual(protocol.recv_frame(self.receiver),
+                         (protocol.HEARTBEAT, b""))
+
+    def test_file_frame(self):
+        with open(__file__, "rb") as file:
+            data = file.read()
+            protocol.send_file(self.sender, file, 100, 10)
+        self.assertEqual(protocol.recv_frame(self.receiver),
+                         (protocol.FILE, data[10:110]))
+
+    def test_oversized_frame(self):
+        for length in (protocol.MAX_FRAME + 1, 2 ** 40, 2 ** 64 - 1):
+            # Only the header is sent: the payload must not be waited for.
+            self.sender.sendall(protocol.pack_header(protocol.COMMAND,
+                                                     length))
+            with self.assertRaises(protocol.ProtocolError):
+                protocol.recv_frame(self.receiver)
+
+    def test_max_length(self):
+        self.sender.sendall(protocol.pack_header(protocol.REPLY, 10)
+                            + b"x" * 10)
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.recv_frame(self.receiver, 9)
+        protocol.check_length(protocol.MAX_FRAME)
+        protocol.check_length(protocol.MAX_FRAME + 1, protocol.MAX_REPLY)
+
+    def test_closed_connection(self):
+        self.sender.sendall(protocol.pack_header(protocol.REPLY, 10) + b"abc")
+        self.sender.close()
+        with self.assertRaises(ConnectionError):
+            protocol.recv_frame(self.receiver)
+
+
+if __name__ == "__main__":
+    unittest.main()
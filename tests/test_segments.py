@@ -0,0 +1,51 @@
+"""Tests of the segmented downloads of large musics."""
+
+import os
+import unittest
+
+from tests.loopback import LoopbackTestCase
+
+
+class SegmentedTest(LoopbackTestCase):
+    """Checks the musics downloaded in ranges on many connections."""
+
+    def make_library(self):
+        self.musics = {"large.mp3": os.urandom(1024 * 1024 + 5),
+                       "small.mp3": os.urandom(10 * 1024)}
+        for name, data in self.musics.items():
+            self.write(name, data)
+
+    def test_segments(self):
+        client = self.client(segments=4, segment_threshold=256 * 1024)
+        ids = self.ids(client)
+        self.assertTrue(client.should_segment(ids["large.mp3"]))
+        self.assertFalse(client.should_segment(ids["small.mp3"]))
+        self.assertEqual(client.copy(ids["large.mp3"]), ("large.mp3", True))
+        with open("large.mp3", "rb") as music:
+            self.assertEqual(music.read(), self.musics["large.mp3"])
+        self.assertFalse(os.path.exists("large.mp3.part"))
+        stats = client.stats()
+        # Every range was requested on its own connection.
+        self.assertEqual(stats["commands"]["--copy"]["count"], 4)
+        self.assertEqual(stats["connections"], 4)
+        self.assertEqual(stats["bytes_sent"], len(self.musics["large.mp3"]))
+
+    def test_below_threshold(self):
+        client = self.client(segments=4, segment_threshold=256 * 1024)
+        self.assertEqual(client.copy(self.ids(client)["small.mp3"]),
+                         ("small.mp3", True))
+        stats = client.stats()
+        self.assertEqual(stats["commands"]["--copy"]["count"], 1)
+        self.assertEqual(stats["connections"], 1)
+
+    def test_one_segment(self):
+        client = self.client(segments=1, segment_threshold=256 * 1024)
+        self.assertFalse(client.should_segment(self.ids(client)["large.mp3"]))
+
+
+class AsyncSegmentedTest(SegmentedTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
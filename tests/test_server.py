@@ -0,0 +1,137 @@
+"""Tests of the server sessions."""
+
+import os
+import socket
+import threading
+import time
+import unittest
+
+from tests.loopback import LoopbackClient, LoopbackTestCase, wait_until
+
+
+class ImpatientClient(LoopbackClient):
+    """A client that gives up on the first BUSY answer."""
+
+    MAX_BUSY = 0
+
+
+class IdleTimeoutTest(LoopbackTestCase):
+    """Checks that an idle connection is closed by the server."""
+
+    OPTIONS = {"idle_timeout": 0.5}
+
+    def test_silent_client(self):
+        with socket.create_connection(self.address, timeout=5) as silent:
+            started = time.monotonic()
+            # The client never sends its handshake.
+            self.assertEqual(silent.recv(1), b"")
+        self.assertLess(time.monotonic() - started, 4)
+
+
+class AsyncIdleTimeoutTest(IdleTimeoutTest):
+    ENGINE = "asyncio"
+
+
+class PersistentSessionTest(LoopbackTestCase):
+    """Checks that many requests are served on a single connection."""
+
+    OPTIONS = {"max_requests": 3}
+
+    def make_library(self):
+        self.write("A.mp3", os.urandom(10 * 1024))
+        self.write("B.mp3", os.urandom(10 * 1024))
+
+    def test_one_connection(self):
+        client = self.client()
+        self.assertEqual(client.session["max_requests"], 3)
+        ids = self.ids(client)
+        self.assertEqual(client.copy(ids["A.mp3"]), ("A.mp3", True))
+        self.assertEqual(client.stats()["connections"], 1)
+
+    def test_request_limit(self):
+        client = self.client()
+        for _ in range(3):
+            client.raw_available()
+        # The server has closed the session after its last request.
+        with self.assertRaises(ConnectionError):
+            client.raw_available()
+        client.ensure_session()
+        self.assertEqual(len(client.raw_available()), 2)
+        self.assertEqual(client.stats()["connections"], 2)
+
+
+class AsyncPersistentSessionTest(PersistentSessionTest):
+    ENGINE = "asyncio"
+
+
+
+class ConnectionLimitTest(LoopbackTestCase):
+    """Checks the connections rejected by a full server."""
+
+    OPTIONS = {"max_connections": 1, "retry_after": 0.2}
+
+    def test_rejected(self):
+        first = self.client()
+        impatient = ImpatientClient(self.address, self.local)
+        self.addCleanup(impatient.client.close)
+        self.assertFalse(impatient.set_ambient())
+        stats = first.stats()
+        self.assertEqual(stats["open_connections"], 1)
+        self.assertGreaterEqual(stats["rejected"], 1)
+
+    def test_retry_after(self):
+        first = self.client()
+        timer = threading.Timer(0.5, first.client.close)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        # The client waits as long as it's told until the slot is free.
+        second = self.client()
+        self.assertGreaterEqual(second.stats()["rejected"], 1)
+
+    def test_legacy_client(self):
+        self.client()
+        with socket.create_connection(self.address, timeout=5) as legacy:
+            legacy.sendall(b"--raw-available")
+            self.assertEqual(legacy.recv(16), b"busy")
+
+
+class TransferLimitTest(LoopbackTestCase):
+    """Checks the transfers rejected while every slot is taken."""
+
+    OPTIONS = {"max_transfers": 1, "retry_after": 0.2,
+               "max_client_rate": 256 * 1024, "compression": False}
+
+    def make_library(self):
+        self.write("slow.mp3", os.urandom(384 * 1024))
+        self.write("fast.mp3", os.urandom(1024))
+
+    def test_busy_transfer(self):
+        slow = self.client()
+        ids = self.ids(slow)
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(slow.copy(ids["slow.mp3"])))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.assertTrue(wait_until(lambda: os.path.exists("slow.mp3.part")))
+        impatient = self.client(ImpatientClient)
+        self.assertEqual(impatient.copy(ids["fast.mp3"]), ("", False))
+        # The session goes on, and the transfer is admitted once the
+        # slow one has ended.
+        patient = self.client()
+        self.assertEqual(patient.copy(ids["fast.mp3"]), ("fast.mp3", True))
+        thread.join()
+        self.assertEqual(results, [("slow.mp3", True)])
+        self.assertGreaterEqual(patient.stats()["rejected"], 2)
+
+
+class AsyncConnectionLimitTest(ConnectionLimitTest):
+    ENGINE = "asyncio"
+
+
+class AsyncTransferLimitTest(TransferLimitTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
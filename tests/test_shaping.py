@@ -0,0 +1,94 @@
+"""Tests of the bandwidth shaping."""
+
+import concurrent.futures
+import multiprocessing
+import os
+import time
+import unittest
+
+from music_sender import shaping
+from tests.loopback import LoopbackTestCase
+
+MiB = 1024 * 1024
+
+
+def reserve(state, size: int, count: int) -> None:
+    """Reserves count chunks of a shared client bucket. Target of the
+    process of the tests."""
+
+    shaper = shaping.Shaper(max_client_rate=MiB, state=state)
+    bucket, = shaper.buckets("10.0.0.1")
+    for _ in range(count):
+        bucket.reserve(size)
+
+
+class TokenBucketTest(unittest.TestCase):
+    """Checks the reservations of the buckets."""
+
+    def test_turns(self):
+        bucket = shaping.TokenBucket(MiB, burst=64 * 1024)
+        # After an idle time the burst is sent at once, and then every
+        # chunk waits for its turn.
+        self.assertEqual(bucket.reserve(64 * 1024), 0.0)
+        waits = [bucket.reserve(64 * 1024) for _ in range(4)]
+        for wait, expected in zip(waits, (0, 1, 2, 3)):
+            self.assertAlmostEqual(wait, expected / 16, delta=0.01)
+
+    def test_client_buckets(self):
+        shaper = shaping.Shaper(max_rate=10 * MiB, max_client_rate=MiB)
+        first = shaper.buckets("10.0.0.1")
+        self.assertEqual(len(first), 2)
+        self.assertIs(shaper.buckets("10.0.0.1")[0], first[0])
+        self.assertIsNot(shaper.buckets("10.0.0.2")[0], first[0])
+        self.assertIs(shaper.buckets("10.0.0.2")[1], first[1])
+        self.assertEqual(len(shaping.Shaper(max_rate=MiB).buckets("a")),
+                         1)
+
+    def test_shared_state(self):
+        state = shaping.shared_state()
+        process = multiprocessing.Process(target=reserve,
+                                          args=(state, 64 * 1024, 8))
+        process.start()
+        process.join()
+        # The other process has reserved half a second of the bucket.
+        bucket, = shaping.Shaper(max_client_rate=MiB,
+                                 state=state).buckets("10.0.0.1")
+        self.assertGreater(bucket.reserve(64 * 1024), 0.2)
+        # Other hosts have their own bucket.
+        bucket, = shaping.Shaper(max_client_rate=MiB,
+                                 state=state).buckets("10.0.0.2")
+        self.assertEqual(bucket.reserve(64 * 1024), 0.0)
+
+
+class WorkerShapingTest(LoopbackTestCase):
+    """Checks that the client cap holds across the worker processes."""
+
+    def setUpServer(self):
+        self.start_server(workers=2, max_client_rate=MiB,
+                          compression=False)
+
+    def make_library(self):
+        for i in range(8):
+            self.write(f"{i}.mp3", os.urandom(256 * 1024))
+
+    def test_parallel_downloads(self):
+        client = self.client()
+        ids = sorted(self.ids(client).items())
+        clients = [client.clone() for _ in ids]
+
+        def download(client, track):
+            client.ensure_session()
+            return client.copy(track[1])
+
+        started = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(len(ids)) as pool:
+            results = list(pool.map(download, clients, ids))
+        seconds = time.monotonic() - started
+        self.assertTrue(all(successful for _, successful in results))
+        # 2 MiB at 1 MiB/s, less the bursts, whatever worker serves
+        # every connection.
+        self.assertGreater(seconds, 1.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
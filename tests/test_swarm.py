@@ -0,0 +1,90 @@
+"""Tests of the swarm downloads from many mirrors."""
+
+import os
+import shutil
+import threading
+import unittest
+
+from music_sender.swarm import SwarmEngine
+from tests.loopback import (HOST, LoopbackClient, LoopbackTestCase,
+                            free_port)
+
+
+class BrokenClient(LoopbackClient):
+    """A client whose transfers fail with an unexpected error."""
+
+    def copy(self, option, music_name=None):
+        raise RuntimeError("Broken client.")
+
+
+class SwarmTest(LoopbackTestCase):
+    """Checks the downloads from two mirrors with the same library."""
+
+    def make_library(self):
+        self.musics = {"A/small.mp3": os.urandom(100 * 1024),
+                       "A/large.mp3": os.urandom(3 * 1024 * 1024 + 17)}
+        for name, data in self.musics.items():
+            self.write(name, data)
+
+    def setUpServer(self):
+        self.start_server()
+        mirror_library = os.path.join(os.path.dirname(self.library),
+                                      "mirror")
+        shutil.copytree(self.library, mirror_library)
+        self.mirror = (HOST, free_port())
+        self.mirror_process = self.start_server(address=self.mirror,
+                                                library=mirror_library)
+
+    def clients(self, client_class=LoopbackClient) -> list:
+        return [self.client(client_class, segment_threshold=1024 * 1024),
+                self.client(client_class, address=self.mirror,
+                            segment_threshold=1024 * 1024)]
+
+    def test_ranges_from_every_mirror(self):
+        clients = self.clients()
+        engine = SwarmEngine(clients, jobs=2, segment_size=512 * 1024)
+        results = list(engine.run(clients[0].pending()))
+        self.assertEqual(sorted(result.name for result in results
+                                if result.successful), sorted(self.musics))
+        for name, data in self.musics.items():
+            with open(name, "rb") as music:
+                self.assertEqual(music.read(), data)
+        # The large music was split in ranges served by both mirrors.
+        self.assertTrue(all(mirror.served for mirror in engine.mirrors))
+
+    def test_dead_mirror(self):
+        clients = self.clients()
+        engine = SwarmEngine(clients, jobs=2, segment_size=512 * 1024)
+        self.mirror_process.kill()
+        self.mirror_process.join()
+        results = list(engine.run(clients[0].pending()))
+        # The other mirror serves every music.
+        self.assertTrue(all(result.successful for result in results))
+        self.assertEqual(len(results), len(self.musics))
+        self.assertFalse(engine.mirrors[1].alive)
+        for name, data in self.musics.items():
+            with open(name, "rb") as music:
+                self.assertEqual(music.read(), data)
+
+    def test_worker_error(self):
+        clients = self.clients(BrokenClient)
+        engine = SwarmEngine(clients, jobs=2)
+        errors = []
+
+        def run():
+            try:
+                list(engine.run(clients[0].pending()))
+            except RuntimeError as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(20)
+        # run() raises the error instead of waiting for the result of
+        # the music forever.
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+"""Tests of the concurrent downloads of the sync engine."""
+
+import os
+import unittest
+
+from music_sender.sync import SyncEngine
+from tests.loopback import LoopbackClient, LoopbackTestCase
+
+
+class FailingClient(LoopbackClient):
+    """A client whose downloads always fail."""
+
+    def copy(self, option, music_name=None):
+        return music_name or "", False
+
+
+class SyncEngineTest(LoopbackTestCase):
+    """Checks the downloads of an engine with many jobs."""
+
+    def make_library(self):
+        self.musics = {f"Album {i % 3}/{i}.mp3": os.urandom(20 * 1024 + i)
+                       for i in range(12)}
+        for name, data in self.musics.items():
+            self.write(name, data)
+
+    def test_parallel_downloads(self):
+        client = self.client()
+        engine = SyncEngine(client, jobs=4)
+        results = list(engine.run(client.pending()))
+        self.assertEqual(sorted(result.name for result in results),
+                         sorted(self.musics))
+        self.assertTrue(all(result.successful and result.attempts == 1
+                            for result in results))
+        self.assertEqual((engine.done, engine.failed), (12, 0))
+        self.assertEqual(engine.bytes_received,
+                         sum(map(len, self.musics.values())))
+        for name, data in self.musics.items():
+            with open(name, "rb") as music:
+                self.assertEqual(music.read(), data)
+        # Nothing is left to be downloaded.
+        self.assertEqual(client.pending(), [])
+
+    def test_retries(self):
+        client = self.client(FailingClient)
+        engine = SyncEngine(client, jobs=2, retries=2, backoff=0.01)
+        results = list(engine.run(client.pending()[:3]))
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(not result.successful and result.attempts == 3
+                            for result in results))
+        self.assertEqual((engine.done, engine.failed), (3, 3))
+
+    def test_bad_arguments(self):
+        client = self.client()
+        for arguments in ({"jobs": 0}, {"batch": 0}, {"retries": -1}):
+            with self.subTest(**arguments):
+                with self.assertRaises(ValueError):
+                    SyncEngine(client, **arguments)
+
+
+class AsyncSyncEngineTest(SyncEngineTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
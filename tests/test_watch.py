@@ -0,0 +1,92 @@
+"""Tests of the library watchers and the --watch mode."""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from music_sender.sync import SyncEngine
+from music_sender.watcher import InotifyWatcher, PollingWatcher
+from tests.loopback import LoopbackTestCase
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "Linux only")
+class InotifyWatcherTest(unittest.TestCase):
+    """Checks the changes reported by inotify."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="music_sender_test_")
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        os.makedirs(os.path.join(self.root, "Artist"))
+        self.watcher = InotifyWatcher(self.root, settle=0.05)
+        self.addCleanup(self.watcher.close)
+
+    def write(self, name: str) -> None:
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as music:
+            music.write(b"music")
+
+    def test_nothing_changed(self):
+        self.assertEqual(self.watcher.wait(0.1), (False, set()))
+
+    def test_written(self):
+        self.write("Artist/a.mp3")
+        self.assertEqual(self.watcher.wait(1), (True, {"Artist/a.mp3"}))
+
+    def test_new_directory(self):
+        os.makedirs(os.path.join(self.root, "New"))
+        self.assertEqual(self.watcher.wait(1), (True, set()))
+        # The new directory is watched too.
+        self.write("New/b.mp3")
+        self.assertEqual(self.watcher.wait(1), (True, {"New/b.mp3"}))
+
+    def test_hidden(self):
+        self.write(".hidden.mp3")
+        self.assertEqual(self.watcher.wait(0.2), (False, set()))
+
+
+class PollingWatcherTest(unittest.TestCase):
+    """Checks that polling reports a possible change every timeout."""
+
+    def test_timeout(self):
+        started = time.monotonic()
+        self.assertEqual(PollingWatcher().wait(0.1), (True, set()))
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+
+class WatchTest(LoopbackTestCase):
+    """Checks that a watching client downloads the pushed changes."""
+
+    OPTIONS = {"heartbeat": 0.2}
+
+    def make_library(self):
+        self.write("A.mp3", os.urandom(10 * 1024))
+
+    def test_pushed_changes(self):
+        client = self.client()
+        engine = SyncEngine(client.clone())
+        # The engine client opens its own session later.
+        self.addCleanup(lambda: engine.client.client.close())
+        watch = client.watch(engine)
+        self.addCleanup(watch.close)
+        # The musics the client is missing are downloaded first.
+        self.assertEqual(next(watch).name, "A.mp3")
+        # The session outlives a few heartbeats without changes.
+        time.sleep(1)
+        data = os.urandom(10 * 1024)
+        self.write("B.mp3", data)
+        result = next(watch)
+        self.assertEqual((result.name, result.successful), ("B.mp3", True))
+        with open("B.mp3", "rb") as music:
+            self.assertEqual(music.read(), data)
+
+
+class AsyncWatchTest(WatchTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
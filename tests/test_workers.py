@@ -0,0 +1,64 @@
+"""Tests of the SO_REUSEPORT worker processes."""
+
+import os
+import signal
+import unittest
+
+from tests.loopback import LoopbackClient, LoopbackTestCase, wait_until
+
+
+class WorkerSupervisorTest(LoopbackTestCase):
+    """Checks the workers started by a supervisor."""
+
+    def setUpServer(self):
+        self.start_server(workers=2)
+
+    def make_library(self):
+        self.write("A.mp3", os.urandom(10 * 1024))
+
+    def catalogs(self, count: int = 24) -> dict:
+        """Returns the catalog names of the workers that served new
+        connections, by process ID."""
+
+        catalogs = {}
+        for _ in range(count):
+            client = LoopbackClient(self.address, self.local)
+            # A connection may reach a killed worker before its socket
+            # is closed.
+            if client.set_ambient():
+                catalogs[client.stats()["pid"]] = sorted(
+                    name for _, name in client.raw_available())
+            client.client.close()
+        return catalogs
+
+    def pids(self) -> set:
+        """Returns the workers that served new connections."""
+
+        return set(self.catalogs())
+
+    def test_balanced_connections(self):
+        self.assertEqual(len(self.pids()), 2)
+
+    def test_restart_crashed_worker(self):
+        killed = self.pids().pop()
+        os.kill(killed, signal.SIGKILL)
+        # The supervisor starts a new worker in its place.
+        self.assertTrue(wait_until(
+            lambda: len(self.pids() - {killed}) == 2))
+
+    def test_shared_catalog(self):
+        self.write("B.mp3", os.urandom(10 * 1024))
+        # Every worker serves the catalog published by the supervisor.
+        self.assertTrue(wait_until(lambda: list(self.catalogs().values())
+                                   == [["A.mp3", "B.mp3"]] * 2))
+        client = self.client()
+        self.assertEqual(client.copy(self.ids(client)["B.mp3"]),
+                         ("B.mp3", True))
+
+
+class AsyncWorkerSupervisorTest(WorkerSupervisorTest):
+    ENGINE = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()